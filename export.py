@@ -0,0 +1,24 @@
+import torch
+
+from go_ai import measurements, models, utils
+from go_ai.policies import baselines
+
+utils.config_log()
+args = utils.hyperparameters()
+assert args.baseline or args.latest_checkpoint, 'export the baseline or the latest checkpoint'
+savetype = 'baseline' if args.baseline else 'checkpoint'
+
+# Model
+args.device = 'cpu'
+args.quantize = False
+_, model = baselines.create_policy(args, 'Model')
+
+# Export
+scripted = models.export_model(model)
+outpath = models.get_modelpath(args, savetype, scripted=True)
+torch.jit.save(scripted, outpath)
+utils.log_info(f'Saved export to {outpath}')
+
+# Accuracy and latency versus fp32
+comparison = measurements.compare_export(model, scripted)
+utils.log_info(f'\n{comparison.to_string()}')
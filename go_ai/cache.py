@@ -0,0 +1,88 @@
+import collections
+
+import numpy as np
+
+from go_ai import data
+
+
+class OutputCache:
+    """
+    Bounded LRU cache in front of RLNet._numpy. States are keyed by the hash of their canonical symmetry,
+    so the 8 symmetries of a position share one entry. Policy logits are stored in the canonical symmetry
+    and mapped back to the symmetry of every request
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(self.entries)}
+
+    def numpy(self, states, mode, np_func):
+        """
+        Same as np_func(states, mode), which is only called on the states that aren't cached
+        """
+        states = np.asarray(states)
+        n, size = len(states), states.shape[-1]
+        syms, hashes = data.canonical_symmetries(data.pack_states(states), size)
+        pi_logits = np.empty((n, size ** 2 + 1), dtype=np.float32) if mode != 'critic' else None
+        val_logits = np.empty((n, 1), dtype=np.float32) if mode != 'actor' else None
+
+        # Lookup
+        missing = []
+        for i, state_hash in enumerate(hashes):
+            key = (mode, state_hash)
+            entry = self.entries.get(key)
+            if entry is None:
+                missing.append(i)
+                continue
+            self.entries.move_to_end(key)
+            canon_pi_logits, val = entry
+            if pi_logits is not None:
+                pi_logits[i] = canon_pi_logits
+            if val_logits is not None:
+                val_logits[i] = val
+        self.hits += n - len(missing)
+        self.misses += len(missing)
+
+        # Evaluate and store the rest
+        if len(missing) > 0:
+            missing = np.array(missing)
+            outputs = np_func(states[missing], mode)
+            new_pi_logits, new_val_logits = None, None
+            if mode == 'actor_critic':
+                new_pi_logits, new_val_logits = outputs
+            elif mode == 'actor':
+                new_pi_logits = outputs
+            else:
+                new_val_logits = outputs
+
+            if new_pi_logits is not None:
+                new_pi_logits = data.batch_symmetric_pis(new_pi_logits, syms[missing])
+                pi_logits[missing] = new_pi_logits
+            if new_val_logits is not None:
+                val_logits[missing] = new_val_logits
+
+            for j, i in enumerate(missing):
+                self.entries[(mode, hashes[i])] = (None if new_pi_logits is None else new_pi_logits[j],
+                                                   None if new_val_logits is None else new_val_logits[j])
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+        # Return
+        if pi_logits is not None:
+            pi_logits = data.batch_inverse_symmetric_pis(pi_logits, syms)
+        if pi_logits is None:
+            return val_logits
+        elif val_logits is None:
+            return pi_logits
+        else:
+            return pi_logits, val_logits
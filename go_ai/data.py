@@ -1,16 +1,60 @@
-import collections
+import functools
+import json
 import os
-import pickle
-import random
+import queue
+import threading
 
 import gym
 import numpy as np
+import torch
 from mpi4py import MPI
+from scipy import ndimage
+
+from go_ai import engine
 
 go_env = gym.make('gym_go:go-v0', size=0)
 GoVars = go_env.govars
 GoGame = go_env.gogame
 
+# Implementations of the GoGame API
+ENGINES = {'gym': go_env.gogame, 'native': engine}
+
+
+def set_engine(name):
+    """
+    Selects the implementation of the Go rules behind GoGame
+    """
+    global GoGame
+    GoGame = ENGINES[name]
+
+
+def pack_states(states):
+    """
+    Every channel of a state is binary, so a state is stored as a bit per point of each channel
+    :param states: Array of states of shape (..., channels, size, size)
+    :return: uint8 array of shape (..., ceil(channels * size * size / 8))
+    """
+    states = np.asarray(states)
+    flat = states.reshape(states.shape[:-3] + (-1,))
+    return np.packbits(flat > 0, axis=-1)
+
+
+def unpack_states(packed, size):
+    """
+    Inverse of pack_states
+    :return: float32 array of shape (..., channels, size, size)
+    """
+    packed = np.asarray(packed)
+    flat = np.unpackbits(packed, axis=-1, count=GoVars.NUM_CHNLS * size * size)
+    return flat.reshape(packed.shape[:-1] + (GoVars.NUM_CHNLS, size, size)).astype(np.float32)
+
+
+def packed_size(size):
+    """
+    :return: Number of bytes of a packed state
+    """
+    return (GoVars.NUM_CHNLS * size * size + 7) // 8
+
 
 def batch_invalid_moves(states):
     """
@@ -38,34 +82,331 @@ def batch_invalid_values(states):
     return invalid_values
 
 
+def batch_game_ended(states):
+    """
+    :param states: Array of states of shape (..., channels, size, size)
+    :return: Boolean array of shape (...) that is true where the game has ended
+    """
+    return np.all(states[..., GoVars.DONE_CHNL, :, :] == 1, axis=(-2, -1))
+
+
+def batch_adjacent(stones):
+    """
+    :param stones: Boolean boards of shape (batch, size, size)
+    :return: Boolean boards of the points orthogonally next to the stones
+    """
+    adj = np.zeros_like(stones)
+    adj[:, 1:] |= stones[:, :-1]
+    adj[:, :-1] |= stones[:, 1:]
+    adj[:, :, 1:] |= stones[:, :, :-1]
+    adj[:, :, :-1] |= stones[:, :, 1:]
+    return adj
+
+
+def batch_label(boards):
+    """
+    Labels the orthogonally connected regions of every board in one pass, without connecting regions across boards
+    :param boards: Boolean boards of shape (batch, size, size)
+    :return: Labels of the same shape, where 0 is the background, and the number of labels
+    """
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[1] = ndimage.generate_binary_structure(2, 1)
+    return ndimage.label(boards, structure)
+
+
+def batch_neighbor_labels(labels):
+    """
+    :param labels: Labels of shape (batch, size, size)
+    :return: Labels of the 4 orthogonal neighbors of every point of shape (4, batch, size, size). 0 off the board
+    """
+    padded = np.pad(labels, ((0, 0), (1, 1), (1, 1)))
+    return np.stack([padded[:, :-2, 1:-1], padded[:, 2:, 1:-1], padded[:, 1:-1, :-2], padded[:, 1:-1, 2:]])
+
+
+def batch_liberties(states):
+    """
+    Same as GoGame.get_num_liberties for a whole stack of states, which counts the empty points next to each color
+    :param states: Array of states of shape (..., channels, size, size)
+    :return: Black liberties and white liberties, each of shape (...)
+    """
+    states = np.asarray(states)
+    lead_shape = states.shape[:-3]
+    states = states.reshape((-1,) + states.shape[-3:])
+    black = states[:, GoVars.BLACK] > 0
+    white = states[:, GoVars.WHITE] > 0
+    empties = ~(black | white)
+
+    black_libs = np.sum(batch_adjacent(black) & empties, axis=(1, 2))
+    white_libs = np.sum(batch_adjacent(white) & empties, axis=(1, 2))
+    return black_libs.reshape(lead_shape), white_libs.reshape(lead_shape)
+
+
+def batch_areas(states):
+    """
+    Same as GoGame.areas for a whole stack of states. The empty regions of all the boards are labeled in one pass
+    :param states: Array of states of shape (..., channels, size, size)
+    :return: Black areas and white areas, each of shape (...)
+    """
+    states = np.asarray(states)
+    lead_shape = states.shape[:-3]
+    states = states.reshape((-1,) + states.shape[-3:])
+    black = states[:, GoVars.BLACK] > 0
+    white = states[:, GoVars.WHITE] > 0
+    empties = ~(black | white)
+
+    labels, num_labels = batch_label(empties)
+
+    # Points next to a stone of each color
+    black_adj = batch_adjacent(black)
+    white_adj = batch_adjacent(white)
+
+    # A region belongs to a color if only that color borders it
+    black_claim = np.bincount(labels.ravel(), weights=black_adj.ravel(), minlength=num_labels + 1) > 0
+    white_claim = np.bincount(labels.ravel(), weights=white_adj.ravel(), minlength=num_labels + 1) > 0
+    black_only = black_claim & ~white_claim
+    white_only = white_claim & ~black_claim
+    black_only[0] = white_only[0] = False
+
+    black_area = np.sum(black | black_only[labels], axis=(1, 2))
+    white_area = np.sum(white | white_only[labels], axis=(1, 2))
+    return black_area.reshape(lead_shape), white_area.reshape(lead_shape)
+
+
+def batch_winning(states):
+    """
+    Same as GoGame.winning for a whole stack of states
+    :return: Integer array of shape (...) that is 1 where black wins, -1 where white wins and 0 on ties
+    """
+    black_area, white_area = batch_areas(states)
+    return np.sign(black_area - white_area).astype(np.int)
+
+
 def batch_win_children(batch_children):
-    batch_win = []
-    for children in batch_children:
-        win = []
-        for state in children:
-            if GoGame.game_ended(state):
-                win.append(GoGame.winning(state))
-            else:
-                win.append(0)
-        batch_win.append(win)
-    return np.array(batch_win)
+    """
+    :param batch_children: Padded children of shape (batch, actions, channels, size, size)
+    :return: Array of shape (batch, actions) with the winner of the ended children and 0 for the other children
+    """
+    batch_children = np.asarray(batch_children)
+    ended = batch_game_ended(batch_children)
+    batch_win = np.zeros(ended.shape, dtype=np.int)
+    if ended.any():
+        # Only score the ended children
+        batch_win[ended] = batch_winning(batch_children[ended])
+    return batch_win
 
 
 def batch_padded_children(states):
-    all_children = []
-    all_valid_moves = batch_valid_moves(states)
-    for state, valid_moves in zip(states, all_valid_moves):
-        chilren = GoGame.children(state, canonical=True, padded=True)
-        all_children.append(chilren)
+    """
+    Every valid move of every state is applied in one call to batch_next_states
+    :return: Array of the canonical children of every state of shape (batch, actions, channels, size, size),
+    where invalid moves have zero states
+    """
+    states = np.asarray(states)
+    bsz, channels, size, _ = states.shape
+    parents, actions = np.nonzero(batch_valid_moves(states) > 0)
+    all_children = np.zeros((bsz, size ** 2 + 1, channels, size, size), dtype=np.float32)
+    all_children[parents, actions] = batch_next_states(states[parents], actions, canonical=True)
     return all_children
 
 
+def batch_turns(states):
+    """
+    :param states: Array of states of shape (batch, channels, size, size)
+    :return: The player to move of every state
+    """
+    return np.max(states[:, GoVars.TURN_CHNL], axis=(1, 2)).astype(np.int64)
+
+
+def swap_colors(states):
+    """
+    :return: The states with the black and white channels swapped
+    """
+    channels = np.arange(GoVars.NUM_CHNLS)
+    channels[[GoVars.BLACK, GoVars.WHITE]] = channels[[GoVars.WHITE, GoVars.BLACK]]
+    return states[:, channels]
+
+
+def batch_canonical_form(states):
+    """
+    Same as GoGame.canonical_form for a whole stack of states
+    """
+    states = np.array(states)
+    white = batch_turns(states) == GoVars.WHITE
+    states[white] = swap_colors(states[white])
+    states[white, GoVars.TURN_CHNL] = GoVars.BLACK
+    return states
+
+
+def batch_compute_invalid_moves(ours, theirs):
+    """
+    Same as the invalid moves GoGame computes for the player to move, for a whole stack of boards.
+    An empty point is valid if it has a liberty, connects to one of our groups with another liberty or captures one of
+    their groups in atari
+    :param ours: Boolean boards of the stones of the player to move of shape (batch, size, size)
+    :param theirs: Boolean boards of the stones of the other player
+    :return: Boolean boards that are true on the invalid moves, not counting ko
+    """
+    empties = ~(ours | theirs)
+    our_labels, num_ours = batch_label(ours)
+    their_labels, num_theirs = batch_label(theirs)
+    labels = np.where(theirs, their_labels + num_ours, our_labels)
+
+    # Liberties of every group. An empty point counts once for every group next to it
+    adj_labels = np.sort(batch_neighbor_labels(labels), axis=0)
+    distinct = np.ones(adj_labels.shape, dtype=bool)
+    distinct[1:] = adj_labels[1:] != adj_labels[:-1]
+    liberties = distinct & (adj_labels > 0) & empties[np.newaxis]
+    num_liberties = np.bincount(adj_labels[liberties], minlength=num_ours + num_theirs + 1)
+
+    # Groups that make a move next to them valid
+    ours_label = np.arange(len(num_liberties)) <= num_ours
+    saves = np.where(ours_label, num_liberties > 1, num_liberties == 1)
+    saves[0] = False
+
+    valid = empties & (batch_adjacent(empties) | np.any(saves[adj_labels], axis=0))
+    return ~valid
+
+
+def batch_next_states(states, actions, canonical=False):
+    """
+    Same as GoGame.next_state for a whole stack of states, where every state takes its own action.
+    The groups of all the boards are labeled together, so the stack is advanced with a fixed number of numpy calls
+    :param states: Array of states of shape (batch, channels, size, size)
+    :param actions: 1D actions of shape (batch,), where size^2 is a pass
+    :return: The next states
+    """
+    states = np.asarray(states)
+    actions = np.asarray(actions, dtype=np.int64)
+    bsz, _, size, _ = states.shape
+    turns = batch_turns(states)
+    prev_passed = np.any(states[:, GoVars.PASS_CHNL] == 1, axis=(1, 2))
+
+    # From the perspective of the player to move
+    canonical_states = batch_canonical_form(states)
+    ours = canonical_states[:, GoVars.BLACK] > 0
+    theirs = canonical_states[:, GoVars.WHITE] > 0
+
+    passes = actions == size ** 2
+    movers = np.flatnonzero(~passes)
+    rows, cols = np.divmod(actions[movers], size)
+    assert not np.any(canonical_states[movers, GoVars.INVD_CHNL, rows, cols]), "Invalid move"
+
+    # Whether all the neighbors of the move are stones of the other player
+    padded = np.pad(theirs, ((0, 0), (1, 1), (1, 1)), constant_values=True)
+    surrounded = np.zeros(bsz, dtype=bool)
+    surrounded[movers] = (padded[movers, rows, cols + 1] & padded[movers, rows + 2, cols + 1]
+                          & padded[movers, rows + 1, cols] & padded[movers, rows + 1, cols + 2])
+
+    # Place the stones and capture the groups of the other player that are left without liberties
+    ours[movers, rows, cols] = True
+    empties = ~(ours | theirs)
+    labels, num_labels = batch_label(theirs)
+    free = np.zeros(num_labels + 1, dtype=bool)
+    free[labels[theirs & batch_adjacent(empties)]] = True
+    captured = theirs & ~free[labels]
+    theirs &= ~captured
+
+    # Capturing a single stone with a surrounded stone is ko
+    label_boards = np.zeros(num_labels + 1, dtype=np.int64)
+    label_boards[labels] = np.arange(bsz)[:, np.newaxis, np.newaxis]
+    captured_groups = np.bincount(label_boards[np.unique(labels[captured])], minlength=bsz)
+    ko = np.flatnonzero(surrounded & (captured_groups == 1) & (np.sum(captured, axis=(1, 2)) == 1))
+    ko_rows, ko_cols = np.divmod(np.argmax(captured[ko].reshape(len(ko), size ** 2), axis=1), size)
+
+    # Canonical next states, which belong to the other player
+    invalid = batch_compute_invalid_moves(theirs, ours)
+    invalid[ko, ko_rows, ko_cols] = True
+    next_states = np.zeros_like(states)
+    next_states[:, GoVars.BLACK] = theirs
+    next_states[:, GoVars.WHITE] = ours
+    next_states[:, GoVars.INVD_CHNL] = invalid
+    next_states[:, GoVars.PASS_CHNL] = passes[:, np.newaxis, np.newaxis]
+    ended = batch_game_ended(states) | (passes & prev_passed)
+    next_states[:, GoVars.DONE_CHNL] = ended[:, np.newaxis, np.newaxis]
+
+    if not canonical:
+        # White moves next where black just moved
+        white = turns == GoVars.BLACK
+        next_states[white] = swap_colors(next_states[white])
+        next_states[white, GoVars.TURN_CHNL] = GoVars.WHITE
+    return next_states
+
+
+@functools.lru_cache(maxsize=None)
+def symmetry_tables(size):
+    """
+    Permutations of the 8 dihedral symmetries of the board. Applying symmetry i to a flattened board is
+    new_board[j] = board[point_perms[i, j]]
+    :return: Point permutations (8 x size^2), action permutations that keep the pass move in place (8 x size^2 + 1)
+    and the inverse of the action permutations, which map actions of the original board to the symmetric board
+    """
+    points = np.arange(size ** 2).reshape(size, size)
+    point_perms = []
+    for i in range(4):
+        x = np.rot90(points, i)
+        point_perms.append(x.flatten())
+        point_perms.append(np.flip(x, 1).flatten())
+    point_perms = np.array(point_perms)
+
+    passes = np.full((8, 1), size ** 2)
+    action_perms = np.concatenate([point_perms, passes], axis=1)
+    inverse_action_perms = np.argsort(action_perms, axis=1)
+    return point_perms, action_perms, inverse_action_perms
+
+
+def random_symmetries(n):
+    return np.random.randint(8, size=n)
+
+
+def batch_symmetric_states(states, syms):
+    """
+    Applies symmetry syms[i] to states[i] in one gather
+    """
+    bsz, channels, size, _ = states.shape
+    point_perms, _, _ = symmetry_tables(size)
+    flat = states.reshape(bsz, channels, size ** 2)
+    flat = np.take_along_axis(flat, point_perms[syms][:, np.newaxis], axis=2)
+    return flat.reshape(states.shape)
+
+
+def batch_symmetric_actions(actions, syms, size):
+    _, _, inverse_action_perms = symmetry_tables(size)
+    return inverse_action_perms[syms, actions]
+
+
+def batch_symmetric_pis(pis, syms):
+    """
+    :param pis: Values over the actions like action probabilities or logits
+    """
+    size = int(np.sqrt(pis.shape[1] - 1))
+    _, action_perms, _ = symmetry_tables(size)
+    return np.take_along_axis(pis, action_perms[syms], axis=1)
+
+
+def batch_inverse_symmetric_pis(pis, syms):
+    """
+    Inverse of batch_symmetric_pis
+    """
+    size = int(np.sqrt(pis.shape[1] - 1))
+    _, _, inverse_action_perms = symmetry_tables(size)
+    return np.take_along_axis(pis, inverse_action_perms[syms], axis=1)
+
+
+def batch_symmetric_children(children, syms):
+    """
+    :param children: Padded children of shape (batch, actions, channels, size, size)
+    """
+    bsz, actionsize = children.shape[:2]
+    _, action_perms, _ = symmetry_tables(children.shape[-1])
+    flat = children.reshape((-1,) + children.shape[2:])
+    flat = batch_symmetric_states(flat, np.repeat(syms, actionsize)).reshape(bsz, actionsize, -1)
+    flat = np.take_along_axis(flat, action_perms[syms][:, :, np.newaxis], axis=1)
+    return flat.reshape(children.shape)
+
+
 def batch_random_symmetries(states):
     assert len(states.shape) == 4
-    processed_states = []
-    for state in states:
-        processed_states.append(GoGame.random_symmetry(state))
-    return np.array(processed_states)
+    return batch_symmetric_states(states, random_symmetries(len(states)))
 
 
 def batch_combine_state_actions(states, actions):
@@ -89,94 +430,580 @@ def replay_to_events(replay):
     return trans_trajs
 
 
-def events_to_numpy(events):
-    if len(events) == 0:
-        return [], [], [], [], [], []
-    unzipped = list(zip(*events))
+def replay_dtype(size):
+    """
+    Record of a position in the replay store. Duplicate positions are merged into one record, whose outcome and pi
+    are averaged over its occurrences and whose weight is the number of occurrences
+    """
+    return np.dtype([
+        ('state', np.uint8, (packed_size(size),)),
+        ('next_state', np.uint8, (packed_size(size),)),
+        ('action', np.int16),
+        ('reward', np.float32),
+        ('terminal', np.uint8),
+        ('win', np.float32),
+        ('black_won', np.float32),
+        ('weight', np.uint32),
+        ('pi', np.float32, (size ** 2 + 1,)),
+    ])
+
+
+def replay_to_records(replay):
+    """
+    :param replay: List of trajectories
+    :return: Structured array of all the positions of the trajectories in order
+    """
+    size = replay[0].size
+    records = np.empty(sum(len(traj) for traj in replay), dtype=replay_dtype(size))
+    start = 0
+    for traj in replay:
+        n = len(traj)
+        black_won = traj.get_winner()
+        turns = np.arange(n) % 2
+        end = start + n
+        records['state'][start:end] = traj.states
+        records['next_state'][start:end - 1] = traj.states[1:]
+        records['next_state'][end - 1] = pack_states(traj.get_next_state(n - 1))
+        records['action'][start:end] = traj.actions
+        records['reward'][start:end] = traj.rewards
+        records['terminal'][start:end] = np.arange(n) == n - 1
+        records['win'][start:end] = np.where(turns == 0, black_won, -black_won)
+        records['black_won'][start:end] = black_won
+        records['pi'][start:end] = traj.pis
+        start = end
+    records['weight'] = 1
+    return records
+
+
+@functools.lru_cache(maxsize=None)
+def position_keys(size):
+    """
+    Random keys of every feature of a state under every symmetry. The hash of symmetry i of a state is the
+    sum of the keys of its features, so the hashes of all 8 symmetries are one matrix product
+    :return: uint64 array of shape (channels * size^2, 8)
+    """
+    rng = np.random.RandomState(size)
+    keys = rng.randint(0, np.iinfo(np.uint64).max, size=(GoVars.NUM_CHNLS, size ** 2), dtype=np.uint64)
+    point_perms, _, _ = symmetry_tables(size)
+    # Point k of a state is point inverse_perms[i, k] of its symmetry i
+    inverse_perms = np.argsort(point_perms, axis=1)
+    return keys[:, inverse_perms].transpose(0, 2, 1).reshape(-1, 8)
 
-    states = np.array(list(unzipped[0]), dtype=np.float32)
-    actions = np.array(list(unzipped[1]), dtype=np.int)
-    rewards = np.array(list(unzipped[2]), dtype=np.float32).reshape((-1,))
-    next_states = np.array(list(unzipped[3]), dtype=np.float32)
-    terminals = np.array(list(unzipped[4]), dtype=np.uint8)
-    wins = np.array(list(unzipped[5]), dtype=np.int)
-    pis = np.array(list(unzipped[6]), dtype=np.float32)
+
+def canonical_symmetries(packed, size):
+    """
+    :param packed: Packed states
+    :return: For every state, the symmetry whose hash is smallest and that hash
+    """
+    bits = np.unpackbits(packed, axis=-1, count=GoVars.NUM_CHNLS * size * size).astype(np.uint64)
+    hashes = bits @ position_keys(size)
+    syms = np.argmin(hashes, axis=1)
+    return syms, hashes[np.arange(len(hashes)), syms]
+
+
+def dedup_records(records, size):
+    """
+    Maps every position to its canonical symmetry and merges the positions that have the same canonical state and
+    action. The merged record averages the outcomes, rewards and pis of its occurrences, weighted by their weights
+    :return: Merged records with the positions of black wins first, and the number of those positions
+    """
+    syms, hashes = canonical_symmetries(records['state'], size)
+    canon = np.empty_like(records)
+    canon[:] = records
+    canon['state'] = pack_states(batch_symmetric_states(unpack_states(records['state'], size), syms))
+    canon['next_state'] = pack_states(batch_symmetric_states(unpack_states(records['next_state'], size), syms))
+    canon['action'] = batch_symmetric_actions(records['action'], syms, size)
+    canon['pi'] = batch_symmetric_pis(records['pi'], syms)
+
+    keys = np.stack([hashes, canon['action'].astype(np.uint64)], axis=1)
+    _, first, groups = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    groups = groups.flatten()
+    weights = canon['weight'].astype(np.float64)
+    group_weights = np.bincount(groups, weights=weights)
+
+    merged = canon[first]
+    merged['weight'] = group_weights
+    for field in ['reward', 'win', 'black_won']:
+        merged[field] = np.bincount(groups, weights=weights * canon[field]) / group_weights
+    pis = np.zeros(merged['pi'].shape)
+    np.add.at(pis, groups, weights[:, np.newaxis] * canon['pi'])
+    merged['pi'] = pis / group_weights[:, np.newaxis]
+
+    black_wins = merged['black_won'] > 0
+    merged = merged[np.argsort(~black_wins, kind='stable')]
+    return merged, int(black_wins.sum())
+
+
+def load_manifest(replay_dir):
+    with open(os.path.join(replay_dir, 'manifest.json'), 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(replay_dir, manifest):
+    """
+    Atomically replaces the manifest so readers never see a partial one
+    """
+    path = os.path.join(replay_dir, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+
+
+INDEX_DTYPE = np.dtype([('shard', np.int32), ('offset', np.int32), ('weight', np.uint32)])
+
+
+def weight_path(replay_dir, shard):
+    """
+    Every shard has a file with the weight of each of its positions, so the index is built without reading the shards
+    """
+    return os.path.join(replay_dir, shard['name'][:-len('.npy')] + '.weight.npy')
+
+
+def load_index(replay_dir, manifest):
+    """
+    Index of every position in the replay store, from the manifest and the weight files of the shards.
+    The positions of black wins come first, like they do in every shard
+    :return: Shard number, offset and weight of every position
+    """
+    black_wins = [np.zeros(0, dtype=INDEX_DTYPE)]
+    black_nonwins = [np.zeros(0, dtype=INDEX_DTYPE)]
+    for i, shard in enumerate(manifest['shards']):
+        entries = np.empty(shard['positions'], dtype=INDEX_DTYPE)
+        entries['shard'] = i
+        entries['offset'] = np.arange(shard['positions'])
+        entries['weight'] = np.load(weight_path(replay_dir, shard))
+        black_wins.append(entries[:shard['black_wins']])
+        black_nonwins.append(entries[shard['black_wins']:])
+    return np.concatenate(black_wins + black_nonwins)
+
+
+def sample_positions(replay_dir, size, shards, positions):
+    """
+    Reads only the sampled positions from the memory-mapped shards
+    :param size: Board size
+    :param positions: Index entries of the positions
+    :return: Numpy arrays of the states, actions, rewards, next states, terminals, wins and pis
+    """
+    states, actions, rewards, next_states, terminals, wins, pis = None, None, None, None, None, None, None
+    for shard_num in np.unique(positions['shard']):
+        shard = np.load(os.path.join(replay_dir, shards[shard_num]['name']), mmap_mode='r')
+        where = np.nonzero(positions['shard'] == shard_num)[0]
+        offsets = positions['offset'][where]
+        records = shard[offsets]
+
+        if states is None:
+            n = len(positions)
+            states = np.empty((n, GoVars.NUM_CHNLS, size, size), dtype=np.float32)
+            actions = np.empty(n, dtype=np.int)
+            rewards = np.empty(n, dtype=np.float32)
+            next_states = np.empty_like(states)
+            terminals = np.empty(n, dtype=np.uint8)
+            wins = np.empty(n, dtype=np.float32)
+            pis = np.empty((n,) + records['pi'].shape[1:], dtype=np.float32)
+
+        states[where] = unpack_states(records['state'], size)
+        actions[where] = records['action']
+        rewards[where] = records['reward']
+        next_states[where] = unpack_states(records['next_state'], size)
+        terminals[where] = records['terminal']
+        wins[where] = records['win']
+        pis[where] = records['pi']
+
+    if states is None:
+        return [], [], [], [], [], [], []
 
     return states, actions, rewards, next_states, terminals, wins, pis
 
 
-def load_replay(replay_path):
+def sample_index(replay_dir, batches, batchsize):
+    """
+    Samples evenly between the positions of black wins and black non-wins through the index.
+    Within each, positions are sampled proportionally to their weights
+    :return: Manifest, index entries of the sampled positions in random order, len of total data that was sampled
+    """
+    manifest = load_manifest(replay_dir)
+    replay_len = sum(shard['games'] for shard in manifest['shards'])
+    index = load_index(replay_dir, manifest)
+
+    num_black_wins = manifest['black_wins']
+    num_black_nonwins = len(index) - num_black_wins
+    n = min(num_black_wins, num_black_nonwins)
+    sample_size = min(batchsize * batches // 2, n)
+    weights = index['weight'].astype(np.float64)
+    black_win_p = weights[:num_black_wins] / weights[:num_black_wins].sum() if n > 0 else None
+    black_nonwin_p = weights[num_black_wins:] / weights[num_black_wins:].sum() if n > 0 else None
+    sample_idcs = np.concatenate([
+        np.random.choice(num_black_wins, sample_size, replace=False, p=black_win_p),
+        num_black_wins + np.random.choice(num_black_nonwins, sample_size, replace=False, p=black_nonwin_p)
+    ])
+    np.random.shuffle(sample_idcs)
+
+    return manifest, index[sample_idcs], replay_len
+
+
+def prepare_batch(replay_dir, size, shards, positions):
+    """
+    Reads and augments a training batch. Every sample gets a random symmetry that also permutes its action and pi.
+    The next states get their own random symmetries
+    :return: Tensors of the states, actions, rewards, next states, terminals, wins and pis
+    """
+    states, actions, rewards, next_states, terminals, wins, pis = sample_positions(replay_dir, size, shards, positions)
+
+    syms = random_symmetries(len(states))
+    states = batch_symmetric_states(states, syms)
+    actions = batch_symmetric_actions(actions, syms, size)
+    pis = batch_symmetric_pis(pis, syms)
+    next_states = batch_random_symmetries(next_states)
+
+    batch = states, actions, rewards, next_states, terminals, wins, pis
+    return tuple(torch.from_numpy(np.ascontiguousarray(component)) for component in batch)
+
+
+class BatchStream:
+    """
+    Iterates over training batches that worker threads read, augment and convert to tensors in the background.
+    At most `prefetch` prepared batches are held in memory
+    """
+
+    def __init__(self, replay_dir, manifest, batch_positions, workers=2, prefetch=4):
+        self.replay_dir = replay_dir
+        self.size = manifest['size']
+        self.shards = manifest['shards']
+        self.batch_positions = batch_positions
+        self.workers = workers
+        self.prefetch = prefetch
+        self.last_key = None
+
+    def __len__(self):
+        return len(self.batch_positions)
+
+    def _work(self, tasks, batches, stop):
+        while not stop.is_set():
+            try:
+                task = tasks.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                key, positions = self._sample(task)
+                batch = key, prepare_batch(self.replay_dir, self.size, self.shards, positions)
+            except Exception as e:
+                batch = e
+            # Give up on the batch if the consumer stopped early
+            while not stop.is_set():
+                try:
+                    batches.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def __iter__(self):
+        tasks = queue.Queue()
+        for task in self.batch_positions:
+            tasks.put(task)
+        batches = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        threads = [threading.Thread(target=self._work, args=(tasks, batches, stop), daemon=True)
+                   for _ in range(min(self.workers, len(self)))]
+        for thread in threads:
+            thread.start()
+        try:
+            for _ in range(len(self)):
+                batch = batches.get()
+                if isinstance(batch, Exception):
+                    raise batch
+                self.last_key, batch = batch
+                yield batch
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _sample(self, task):
+        """
+        :return: Key of the batch for update_priorities, index entries of the positions of the batch
+        """
+        return None, task
+
+
+class SumTree:
+    """
+    Binary tree over non-negative priorities where every node is the sum of its children.
+    Sampling proportionally to the priorities and updating priorities is O(log n)
+    """
+
+    def __init__(self, priorities):
+        self.size = len(priorities)
+        self.capacity = 1
+        while self.capacity < self.size:
+            self.capacity *= 2
+        self.nodes = np.zeros(2 * self.capacity)
+        self.nodes[self.capacity:self.capacity + self.size] = priorities
+        level = self.capacity
+        while level > 1:
+            self.nodes[level // 2:level] = self.nodes[level:2 * level:2] + self.nodes[level + 1:2 * level:2]
+            level //= 2
+
+    def total(self):
+        return self.nodes[1]
+
+    def prefix(self, n):
+        """
+        :return: Sum of the first n priorities
+        """
+        if n >= self.capacity:
+            return self.total()
+        total = 0
+        node = n + self.capacity
+        while node > 1:
+            if node % 2 == 1:
+                total += self.nodes[node - 1]
+            node //= 2
+        return total
+
+    def find(self, masses):
+        """
+        :param masses: Array of prefix sums in [0, total)
+        :return: Indices of the priorities whose ranges contain the masses
+        """
+        masses = np.array(masses, dtype=np.float64)
+        nodes = np.ones(len(masses), dtype=np.int64)
+        for _ in range(self.capacity.bit_length() - 1):
+            left = 2 * nodes
+            go_right = masses >= self.nodes[left]
+            masses -= self.nodes[left] * go_right
+            nodes = left + go_right
+        return np.minimum(nodes - self.capacity, self.size - 1)
+
+    def update(self, idcs, priorities):
+        nodes = np.asarray(idcs) + self.capacity
+        self.nodes[nodes] = priorities
+        nodes = np.unique(nodes // 2)
+        while len(nodes) > 0 and nodes[-1] >= 1:
+            self.nodes[nodes] = self.nodes[2 * nodes] + self.nodes[2 * nodes + 1]
+            nodes = np.unique(nodes[nodes > 1] // 2)
+
+
+def priority_path(replay_dir, shard):
     """
-    Loads replay data from a directory.
-    :param replay_path:
-    :param worker_rank: If specified, loads only that specific worker's data. Otherwise it loads all data from all workers
-    :return:
+    Every shard has a file with the latest priority of each of its positions, which is NaN until it's trained on
     """
-    with open(replay_path, 'rb') as f:
-        replay = pickle.load(f)
-    return replay
+    return os.path.join(replay_dir, shard['name'][:-len('.npy')] + '.prio.npy')
+
 
+class PrioritizedIndex:
+    """
+    Sum tree over the priorities of the positions of the replay store in index order.
+    Positions that were never trained on get the highest priority
+    """
 
-def mpi_sample_eventdata(comm: MPI.Intracomm, replay_path, batches, batchsize):
+    def __init__(self, replay_dir, manifest, index, alpha, eps=1e-3):
+        self.index = index
+        self.alpha = alpha
+        self.eps = eps
+        self.num_black_wins = manifest['black_wins']
+        self.lock = threading.Lock()
+
+        self.shard_priorities = []
+        priorities = np.empty(len(index), dtype=np.float32)
+        for shard_num, shard in enumerate(manifest['shards']):
+            path = priority_path(replay_dir, shard)
+            if not os.path.exists(path):
+                np.save(path, np.full(shard['positions'], np.nan, dtype=np.float32))
+            shard_priorities = np.load(path, mmap_mode='r+')
+            self.shard_priorities.append(shard_priorities)
+            where = index['shard'] == shard_num
+            priorities[where] = shard_priorities[index['offset'][where]]
+
+        new = np.isnan(priorities)
+        max_priority = priorities[~new].max() if (~new).any() else 1
+        priorities[new] = max_priority
+        self.tree = SumTree(self._scale(np.arange(len(index)), priorities))
+
+    def _scale(self, idcs, priorities):
+        """
+        Merged positions count once per occurrence
+        """
+        return self.index['weight'][idcs] * (np.abs(priorities) + self.eps) ** self.alpha
+
+    def sample(self, batchsize):
+        """
+        Samples evenly between the positions of black wins and black non-wins,
+        proportionally to the priorities within each
+        :return: Indices into the index
+        """
+        buckets = [(0, self.num_black_wins), (self.num_black_wins, len(self.index))]
+        if any(start == end for start, end in buckets):
+            return np.zeros(0, dtype=np.int64)
+
+        idcs = []
+        with self.lock:
+            for (start, end), n in zip(buckets, [batchsize // 2, batchsize - batchsize // 2]):
+                low, high = self.tree.prefix(start), self.tree.prefix(end)
+                # Stratified over the mass of the bucket
+                masses = low + (np.arange(n) + np.random.rand(n)) / n * (high - low)
+                idcs.append(np.clip(self.tree.find(masses), start, end - 1))
+        idcs = np.concatenate(idcs)
+        np.random.shuffle(idcs)
+        return idcs
+
+    def update(self, idcs, priorities):
+        with self.lock:
+            self.tree.update(idcs, self._scale(idcs, priorities))
+        positions = self.index[idcs]
+        for shard_num in np.unique(positions['shard']):
+            where = positions['shard'] == shard_num
+            self.shard_priorities[shard_num][positions['offset'][where]] = priorities[where]
+
+    def flush(self):
+        for shard_priorities in self.shard_priorities:
+            shard_priorities.flush()
+
+
+class PrioritizedBatchStream(BatchStream):
+    """
+    Samples every batch from the sum tree when it's prepared, so the priorities of earlier batches
+    already shape later ones
     """
-    :param replay_path:
-    :param batches:
-    :param batchsize:
+
+    def __init__(self, replay_dir, manifest, pindex, batches, batchsize, workers=2, prefetch=4):
+        super().__init__(replay_dir, manifest, [batchsize] * batches, workers, prefetch)
+        self.pindex = pindex
+
+    def _sample(self, task):
+        idcs = self.pindex.sample(task)
+        return idcs, self.pindex.index[idcs]
+
+    def update_priorities(self, losses):
+        """
+        :param losses: Per-sample losses of the last batch
+        """
+        self.pindex.update(self.last_key, np.asarray(losses))
+
+    def __iter__(self):
+        try:
+            yield from super().__iter__()
+        finally:
+            self.pindex.flush()
+
+
+def mpi_stream_eventdata(comm: MPI.Intracomm, replay_dir, batches, batchsize, workers=2, alpha=None):
+    """
+    Every worker samples concurrently through the index of the replay store, and only reads the sampled positions
+    from the memory-mapped shards. The batches are prepared in the background
+    while the caller trains on earlier ones
+    :param alpha: If specified, samples positions with probability proportional to their loss to the power of alpha
+    :return: Stream of batches of sample data, len of total data that was sampled
+    """
+    if alpha is not None:
+        manifest = load_manifest(replay_dir)
+        replay_len = sum(shard['games'] for shard in manifest['shards'])
+        index = load_index(replay_dir, manifest)
+        pindex = PrioritizedIndex(replay_dir, manifest, index, alpha)
+        num_batches = batches if 0 < manifest['black_wins'] < len(index) else 0
+        stream = PrioritizedBatchStream(replay_dir, manifest, pindex, num_batches, batchsize, workers)
+        return stream, replay_len
+
+    manifest, positions, replay_len = sample_index(replay_dir, batches, batchsize)
+    splits = max(len(positions) // batchsize, 1)
+    batch_positions = np.array_split(positions, splits) if len(positions) > 0 else []
+    stream = BatchStream(replay_dir, manifest, batch_positions, workers)
+
+    return stream, replay_len
+
+
+def mpi_sample_eventdata(comm: MPI.Intracomm, replay_dir, batches, batchsize):
+    """
+    Same as mpi_stream_eventdata, but with all the batches prepared up front
     :return: Batches of sample data, len of total data that was sampled
     """
-    # Workers sample data one at a time to avoid memory issues
-    rank = comm.Get_rank()
-    world_size = comm.Get_size()
-    sample_data = None
-    replay_len = None
-    for worker in range(world_size):
-        if rank == worker:
-            replay = load_replay(replay_path)
-            replay_len = len(replay)
-            # Seperate into black wins and black non-wins to ensure even sampling between the two
-            black_wins = list(filter(lambda traj: traj.get_winner() == 1, replay))
-            black_nonwins = list(filter(lambda traj: traj.get_winner() != 1, replay))
-            black_wins = replay_to_events(black_wins)
-            black_nonwins = replay_to_events(black_nonwins)
-            n = min(len(black_wins), len(black_nonwins))
-            sample_size = min(batchsize * batches // 2, n)
-            sample_data = random.sample(black_wins, sample_size) + random.sample(black_nonwins, sample_size)
-            # Save memory
-            del replay
-        comm.Barrier()
-
-    random.shuffle(sample_data)
-    sample_data = events_to_numpy(sample_data)
-
-    sample_size = len(sample_data[0])
-    for component in sample_data:
-        assert len(component) == sample_size
-
-    splits = max(sample_size // batchsize, 1)
-    batched_sampledata = [np.array_split(component, splits) for component in sample_data]
-    batched_sampledata = list(zip(*batched_sampledata))
-
-    return batched_sampledata, replay_len
+    stream, replay_len = mpi_stream_eventdata(comm, replay_dir, batches, batchsize)
+    return list(stream), replay_len
+
+
+def write_shard(replay_dir, name, replays):
+    """
+    Merges the duplicate positions of the games and saves them as a shard, along with its weight and priority files
+    :return: Manifest entry of the shard
+    """
+    records, num_black_wins = dedup_records(replay_to_records(replays), replays[0].size)
+    entry = {'name': name, 'games': len(replays), 'positions': len(records), 'black_wins': num_black_wins}
+    np.save(os.path.join(replay_dir, name), records)
+    np.save(weight_path(replay_dir, entry), records['weight'])
+    np.save(priority_path(replay_dir, entry), np.full(len(records), np.nan, dtype=np.float32))
+    return entry
+
+
+def add_shards(args, manifest, new_shards):
+    """
+    Adds the shards, which are already on disk, to the manifest and evicts the oldest shards beyond args.replaysize
+    games. Only touches the manifest and the files of the evicted shards
+    """
+    shards = manifest['shards'] + new_shards
+
+    # Evict the oldest shards. Never evict the new ones
+    num_games = sum(shard['games'] for shard in shards)
+    while num_games > args.replaysize and len(shards) > len(new_shards):
+        oldest = shards.pop(0)
+        num_games -= oldest['games']
+        for path in [os.path.join(args.replay_dir, oldest['name']), weight_path(args.replay_dir, oldest),
+                     priority_path(args.replay_dir, oldest)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    manifest['shards'] = shards
+    manifest['black_wins'] = sum(shard['black_wins'] for shard in shards)
+    manifest['next'] += 1
+    save_manifest(args.replay_dir, manifest)
+
+
+def append_replay(args, replays):
+    """
+    Appends the games to the replay store from a single process
+    """
+    manifest = load_manifest(args.replay_dir)
+    new_shards = []
+    if len(replays) > 0:
+        new_shards.append(write_shard(args.replay_dir, f"{manifest['next']:06d}.npy", replays))
+    add_shards(args, manifest, new_shards)
 
 
 def mpi_disk_append_replay(comm: MPI.Intracomm, args, replays):
-    rank = comm.Get_rank()
-    for worker in range(comm.Get_size()):
-        if rank == worker:
-            if os.path.exists(args.replay_path):
-                all_replays = load_replay(args.replay_path)
-                all_replays.extend(replays)
-            else:
-                all_replays = replays
+    """
+    Every worker merges the duplicate positions of its games and appends them to the replay store as its own shard.
+    Workers write in parallel, so an append costs O(new games). The first worker adds the shards to the manifest and
+    evicts the oldest shards beyond args.replaysize games.
 
-            with open(args.replay_path, 'wb') as f:
-                pickle.dump(all_replays, f)
-        comm.Barrier()
+    With args.merge_workers, the first worker gathers the games of every worker instead and writes them as one shard,
+    so duplicates also merge across workers. Positions never merge with the ones already in the store
+    """
+    rank = comm.Get_rank()
+    manifest = load_manifest(args.replay_dir)
+    if args.merge_workers:
+        gathered = comm.gather(replays, root=0)
+        if rank == 0:
+            all_replays = [traj for worker_replays in gathered for traj in worker_replays]
+            new_shards = []
+            if len(all_replays) > 0:
+                new_shards.append(write_shard(args.replay_dir, f"{manifest['next']:06d}.npy", all_replays))
+            add_shards(args, manifest, new_shards)
+    else:
+        entry = None
+        if len(replays) > 0:
+            entry = write_shard(args.replay_dir, f"{manifest['next']:06d}-{rank:03d}.npy", replays)
+
+        entries = comm.gather(entry, root=0)
+        if rank == 0:
+            add_shards(args, manifest, [entry for entry in entries if entry is not None])
+    comm.Barrier()
 
 
 def reset_replay(args):
-    if os.path.exists(args.replay_path):
-        os.remove(args.replay_path)
-    replay_buffer = collections.deque(maxlen=args.replaysize)
-    with open(args.replay_path, 'wb') as f:
-        pickle.dump(replay_buffer, f)
+    """
+    Empties the replay store
+    """
+    os.makedirs(args.replay_dir, exist_ok=True)
+    for name in os.listdir(args.replay_dir):
+        if name.endswith('.npy') or name.startswith('manifest.json'):
+            os.remove(os.path.join(args.replay_dir, name))
+    save_manifest(args.replay_dir, {'size': args.size, 'next': 0, 'shards': [], 'black_wins': 0})
@@ -0,0 +1,399 @@
+"""
+Go engine that keeps the groups of the board up to date as moves are played, instead of relabeling the whole board on
+every move like gym_go does. Implements the parts of gym_go's GoGame API that go_ai uses with the same rules, so this
+module can stand in for GoGame (see data.set_engine)
+"""
+import functools
+
+import gym
+import numpy as np
+
+_go_env = gym.make('gym_go:go-v0', size=0)
+GoVars = _go_env.govars
+GymGoGame = _go_env.gogame
+
+EMPTY = -1
+
+
+@functools.lru_cache(maxsize=None)
+def neighbors(size):
+    """
+    :return: Tuple of the orthogonal neighbors of every point of the flattened board
+    """
+    adj = []
+    for point in range(size ** 2):
+        row, col = divmod(point, size)
+        candidates = [(point - size, row > 0), (point + size, row < size - 1),
+                      (point - 1, col > 0), (point + 1, col < size - 1)]
+        adj.append(tuple(neighbor for neighbor, on_board in candidates if on_board))
+    return tuple(adj)
+
+
+@functools.lru_cache(maxsize=None)
+def zobrist_keys(size):
+    """
+    :return: Random keys of a black and of a white stone on every point (2 x size^2), of the ko point on every point
+    (size^2,) and of white to move, the pass flag and the game over flag
+    """
+    rng = np.random.RandomState(size)
+    keys = rng.randint(0, np.iinfo(np.int64).max, size=(3, size ** 2), dtype=np.int64).tolist()
+    flags = rng.randint(0, np.iinfo(np.int64).max, size=3, dtype=np.int64).tolist()
+    return keys[:2], keys[2], flags
+
+
+class Board:
+    """
+    Mutable board of a game in progress.
+
+    Connected stones share a union-find root, which owns the stones and the set of liberties of their group. Playing a
+    move only touches the groups next to it. The Zobrist hash of the stones is kept up to date the same way.
+
+    The search tree keys its transposition table by position_hash, which adds the turn, the ko point and the flags to
+    the hash of the stones.
+
+    The valid moves are kept too. An empty point with an empty neighbor is always valid unless it's the ko point, so
+    after a move only the points around the changed stones and the enclosed empty points, whose validity depends on
+    the turn and on the liberties of the groups around them, are checked again
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.neighbors = neighbors(size)
+        self.keys, self.ko_keys, self.flag_keys = zobrist_keys(size)
+
+        self.colors = [EMPTY] * (size ** 2)
+        self.parents = list(range(size ** 2))
+        self.stones = {}
+        self.liberties = {}
+        self.hash = 0
+        self.valid = [True] * (size ** 2)
+        # Empty points without an empty neighbor
+        self.enclosed = set()
+
+        self.turn = GoVars.BLACK
+        self.passed = False
+        self.done = False
+        self.ko = None
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Builds the groups of a state. The ko point isn't a channel of the state, but it's the only empty point that's
+        marked invalid even though a stone there would have a liberty or capture something
+        """
+        size = state.shape[-1]
+        board = cls(size)
+        colors = board.colors
+        for color in (GoVars.BLACK, GoVars.WHITE):
+            for point in np.flatnonzero(state[color] > 0).tolist():
+                colors[point] = color
+                board.stones[point] = [point]
+                board.liberties[point] = set()
+                board.hash ^= board.keys[color][point]
+
+        # Connect every stone to the stones after it, then collect the liberties of the whole groups
+        for point, color in enumerate(colors):
+            if color == EMPTY:
+                continue
+            for neighbor in board.neighbors[point]:
+                if neighbor > point and colors[neighbor] == color:
+                    root, other = board.find(point), board.find(neighbor)
+                    if root != other:
+                        board._union(root, other)
+        for point, color in enumerate(colors):
+            if color == EMPTY:
+                continue
+            liberties = board.liberties[board.find(point)]
+            liberties.update(neighbor for neighbor in board.neighbors[point] if colors[neighbor] == EMPTY)
+
+        board.turn = int(np.max(state[GoVars.TURN_CHNL]))
+        board.passed = bool(np.any(state[GoVars.PASS_CHNL] == 1))
+        board.done = bool(np.any(state[GoVars.DONE_CHNL] == 1))
+        for point in np.flatnonzero(state[GoVars.INVD_CHNL] > 0).tolist():
+            if colors[point] == EMPTY and board.is_valid(point):
+                board.ko = point
+                break
+
+        board._update_valid(range(size ** 2))
+        return board
+
+    def copy(self):
+        board = Board.__new__(Board)
+        board.__dict__.update(self.__dict__)
+        board.colors = self.colors[:]
+        board.parents = self.parents[:]
+        board.stones = {root: stones[:] for root, stones in self.stones.items()}
+        board.liberties = {root: set(liberties) for root, liberties in self.liberties.items()}
+        board.valid = self.valid[:]
+        board.enclosed = set(self.enclosed)
+        return board
+
+    # =================
+    # Groups
+    # =================
+    def find(self, point):
+        parents = self.parents
+        while parents[point] != point:
+            # Path halving
+            parents[point] = parents[parents[point]]
+            point = parents[point]
+        return point
+
+    def _union(self, root, other):
+        """
+        Merges the smaller group into the larger one
+        :return: Root of the merged group
+        """
+        if len(self.stones[root]) < len(self.stones[other]):
+            root, other = other, root
+        self.parents[other] = root
+        self.stones[root].extend(self.stones.pop(other))
+        self.liberties[root] |= self.liberties.pop(other)
+        return root
+
+    def _remove(self, root):
+        """
+        Removes a group from the board. Its stones become liberties of the groups around it
+        :return: Points of the removed stones
+        """
+        color = self.colors[root]
+        stones = self.stones.pop(root)
+        del self.liberties[root]
+        for point in stones:
+            self.colors[point] = EMPTY
+            self.hash ^= self.keys[color][point]
+        for point in stones:
+            for neighbor in self.neighbors[point]:
+                if self.colors[neighbor] != EMPTY:
+                    self.liberties[self.find(neighbor)].add(point)
+        return stones
+
+    # =================
+    # Moves
+    # =================
+    def is_valid(self, action):
+        """
+        Whether the player to move can play the action. Suicide isn't allowed
+        """
+        if action is None or action == self.size ** 2:
+            return True
+        if self.colors[action] != EMPTY or action == self.ko:
+            return False
+        for neighbor in self.neighbors[action]:
+            color = self.colors[neighbor]
+            if color == EMPTY:
+                return True
+            # Connecting to our group with another liberty or capturing their group in atari
+            num_liberties = len(self.liberties[self.find(neighbor)])
+            if (color == self.turn) == (num_liberties > 1):
+                return True
+        return False
+
+    def valid_moves(self):
+        return np.array(self.valid + [True], dtype=float)
+
+    def _update_valid(self, changed):
+        """
+        Checks the valid moves again after a move
+        :param changed: Points whose stones changed and their neighbors
+        """
+        colors = self.colors
+        for point in changed:
+            if colors[point] == EMPTY and all(colors[neighbor] != EMPTY for neighbor in self.neighbors[point]):
+                self.enclosed.add(point)
+            else:
+                self.enclosed.discard(point)
+        for point in self.enclosed.union(changed):
+            self.valid[point] = self.is_valid(point)
+
+    def play(self, action):
+        """
+        Plays the action for the player to move and passes the turn
+        :param action: 1D action. size^2 or None is a pass
+        :return: Points of the captured stones
+        """
+        captured = []
+        changed = set() if self.ko is None else {self.ko}
+        if action is None or action == self.size ** 2:
+            self.done = self.done or self.passed
+            self.passed = True
+            self.ko = None
+        else:
+            assert self.is_valid(action), ("Invalid move", divmod(action, self.size))
+            player, opponent = self.turn, 1 - self.turn
+            colors = self.colors
+            surrounded = all(colors[neighbor] == opponent for neighbor in self.neighbors[action])
+
+            colors[action] = player
+            self.parents[action] = action
+            self.stones[action] = [action]
+            self.liberties[action] = {neighbor for neighbor in self.neighbors[action] if colors[neighbor] == EMPTY}
+            self.hash ^= self.keys[player][action]
+
+            root = action
+            killed_groups = 0
+            for neighbor in self.neighbors[action]:
+                color = colors[neighbor]
+                if color == EMPTY:
+                    # Empty to begin with, or captured by an earlier neighbor
+                    continue
+                other = self.find(neighbor)
+                self.liberties[other].discard(action)
+                if color == player:
+                    if other != root:
+                        root = self._union(root, other)
+                elif len(self.liberties[other]) <= 0:
+                    captured.extend(self._remove(other))
+                    killed_groups += 1
+
+            # Retaking a single stone that just captured a single stone is ko
+            self.passed = False
+            self.ko = None
+            if surrounded and killed_groups == 1 and len(captured) == 1:
+                self.ko = captured[0]
+
+            for point in [action] + captured:
+                changed.add(point)
+                changed.update(self.neighbors[point])
+
+        self.turn = 1 - self.turn
+        self._update_valid(changed)
+        return captured
+
+    def position_hash(self):
+        """
+        :return: Zobrist hash of the stones, the player to move, the ko point and the flags
+        """
+        white_key, pass_key, done_key = self.flag_keys
+        position_hash = self.hash
+        if self.turn == GoVars.WHITE:
+            position_hash ^= white_key
+        if self.ko is not None:
+            position_hash ^= self.ko_keys[self.ko]
+        if self.passed:
+            position_hash ^= pass_key
+        if self.done:
+            position_hash ^= done_key
+        return position_hash
+
+    # =================
+    # Results
+    # =================
+    def areas(self):
+        """
+        :return: Black area and white area. Empty regions count towards the only color that borders them
+        """
+        colors = self.colors
+        areas = [colors.count(GoVars.BLACK), colors.count(GoVars.WHITE)]
+        seen = set()
+        for start, color in enumerate(colors):
+            if color != EMPTY or start in seen:
+                continue
+            region = [start]
+            seen.add(start)
+            borders = set()
+            for point in region:
+                for neighbor in self.neighbors[point]:
+                    if colors[neighbor] != EMPTY:
+                        borders.add(colors[neighbor])
+                    elif neighbor not in seen:
+                        seen.add(neighbor)
+                        region.append(neighbor)
+            if len(borders) == 1:
+                areas[borders.pop()] += len(region)
+        return tuple(areas)
+
+    def winning(self, komi=0):
+        black_area, white_area = self.areas()
+        return int(np.sign(black_area - white_area - komi))
+
+    def state(self, canonical=False):
+        """
+        :param canonical: Whether the stones of the player to move go in the black channel
+        :return: The board as a gym_go state
+        """
+        size = self.size
+        state = np.zeros((GoVars.NUM_CHNLS, size, size))
+        colors = np.array(self.colors).reshape(size, size)
+        state[GoVars.BLACK] = colors == GoVars.BLACK
+        state[GoVars.WHITE] = colors == GoVars.WHITE
+        state[GoVars.TURN_CHNL] = self.turn
+        state[GoVars.INVD_CHNL] = np.logical_not(self.valid).reshape(size, size)
+        state[GoVars.PASS_CHNL] = self.passed
+        state[GoVars.DONE_CHNL] = self.done
+
+        if canonical and self.turn == GoVars.WHITE:
+            channels = np.arange(GoVars.NUM_CHNLS)
+            channels[GoVars.BLACK] = GoVars.WHITE
+            channels[GoVars.WHITE] = GoVars.BLACK
+            state = state[channels]
+            state[GoVars.TURN_CHNL] = GoVars.BLACK
+        return state
+
+
+# =================
+# GoGame API
+# =================
+def init_state(size):
+    return Board(size).state()
+
+
+def next_state(state, action1d, canonical=False):
+    board = Board.from_state(state)
+    board.play(action1d)
+    return board.state(canonical)
+
+
+def children(state, canonical=False, padded=True):
+    """
+    The groups of the state are built once and every child plays its move on a copy of them
+    """
+    board = Board.from_state(state)
+    valid_move_idcs = np.flatnonzero(valid_moves(state))
+    children = []
+    for move in valid_move_idcs:
+        child = board.copy()
+        child.play(move)
+        children.append(child.state(canonical))
+
+    if padded:
+        padded_children = np.zeros((action_size(state), *state.shape))
+        padded_children[valid_move_idcs] = children
+        children = padded_children
+    return children
+
+
+def valid_moves(state):
+    return np.append(1 - state[GoVars.INVD_CHNL].flatten(), 1)
+
+
+def action_size(state=None, board_size: int = None):
+    if state is not None:
+        board_size = state.shape[-1]
+    return board_size ** 2 + 1
+
+
+def turn(state):
+    return int(np.max(state[GoVars.TURN_CHNL]))
+
+
+def prev_player_passed(state):
+    return bool(np.any(state[GoVars.PASS_CHNL] == 1))
+
+
+def game_ended(state):
+    return int(np.any(state[GoVars.DONE_CHNL] == 1))
+
+
+def areas(state):
+    return Board.from_state(state).areas()
+
+
+def winning(state, komi=0):
+    return Board.from_state(state).winning(komi)
+
+
+# Helpers that don't depend on the rules
+get_symmetries = GymGoGame.get_symmetries
+random_weighted_action = GymGoGame.random_weighted_action
+action_2d_to_1d = GymGoGame.action_2d_to_1d
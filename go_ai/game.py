@@ -1,22 +1,27 @@
+import numpy as np
 from tqdm import tqdm
 
-from go_ai import policies, data
+from go_ai import policies, data, engine
 
 
 class Trajectory:
     def __init__(self):
+        # States are bit-packed to save memory
+        self.size = None
         self.states = []
         self.actions = []
         self.rewards = []
-        self.children = []
         self.pis = []
 
     def get_events(self):
+        """
+        Regenerates the next states, which aren't stored to save memory
+        """
         events = []
         black_won = self.get_winner()
         n = len(self)
-        zipped = zip(self.states, self.actions, self.rewards, self.children, self.pis)
-        for i, (state, action, reward, children, pi) in enumerate(zipped):
+        zipped = zip(self.get_states(), self.actions, self.rewards, self.pis)
+        for i, (state, action, reward, pi) in enumerate(zipped):
             turn = i % 2
             if turn == 0:
                 won = black_won
@@ -25,17 +30,31 @@ class Trajectory:
 
             terminal = i == n - 1
 
-            events.append((state, action, reward, children, terminal, won, pi))
+            events.append((state, action, reward, self.get_next_state(i), terminal, won, pi))
 
         return events
 
-    def add_event(self, state, action, reward, children, pi):
-        self.states.append(state)
+    def add_event(self, state, action, reward, pi):
+        self.size = state.shape[-1]
+        self.states.append(data.pack_states(state))
         self.actions.append(action)
         self.rewards.append(reward)
-        self.children.append(children)
         self.pis.append(pi)
 
+    def get_next_state(self, i):
+        """
+        :return: The canonical state after the action of the i'th event
+        """
+        if i + 1 < len(self.states):
+            return self.get_state(i + 1)
+        return data.GoGame.next_state(self.get_state(i), self.actions[i], canonical=True)
+
+    def get_state(self, i):
+        return data.unpack_states(self.states[i], self.size)
+
+    def get_states(self):
+        return data.unpack_states(np.array(self.states), self.size)
+
     def set_win(self, black_won):
         self.rewards[-1] = black_won
 
@@ -46,12 +65,150 @@ class Trajectory:
         n = len(self.states)
         assert len(self.actions) == n
         assert len(self.rewards) == n
-        assert len(self.children) == n
         assert len(self.pis) == n
 
         return n
 
 
+class BatchGoEnv:
+    """
+    Boards of games played in lockstep. Their canonical states are stacked in one array and every step advances all
+    the boards that are still playing with one call to data.batch_next_states. With the native engine, every game
+    keeps an engine.Board instead, which plays its moves incrementally
+    """
+
+    def __init__(self, size, n, reward_method='real'):
+        self.size = size
+        self.reward_method = reward_method
+        self.states = np.zeros((n, data.GoVars.NUM_CHNLS, size, size), dtype=np.float32)
+        self.turns = np.zeros(n, dtype=np.int64)
+        self.boards = None
+
+        # What the policies see of every board
+        self.envs = [BoardEnv(self, i) for i in range(n)]
+        self.reset()
+
+    @classmethod
+    def like(cls, go_env, n):
+        """
+        :return: n boards with the size and the reward method of the gym environment
+        """
+        reward_method = getattr(go_env.reward_method, 'value', go_env.reward_method)
+        return cls(go_env.size, n, reward_method)
+
+    def reset(self):
+        self.states[:] = 0
+        self.turns[:] = data.GoVars.BLACK
+        if data.GoGame is engine:
+            self.boards = [engine.Board(self.size) for _ in self.envs]
+        else:
+            self.boards = None
+
+    def step(self, idcs, actions):
+        """
+        Plays actions[j] on board idcs[j]
+        :return: Canonical states, valid moves, rewards and whether the game ended of those boards
+        """
+        idcs = np.asarray(idcs, dtype=np.int64)
+        if self.boards is None:
+            states = data.batch_next_states(self.states[idcs], actions, canonical=True)
+        else:
+            for i, action in zip(idcs, actions):
+                self.boards[i].play(int(action))
+            states = np.array([self.boards[i].state(canonical=True) for i in idcs], dtype=np.float32)
+        self.states[idcs] = states
+        self.turns[idcs] = 1 - self.turns[idcs]
+
+        dones = data.batch_game_ended(states)
+        return states, data.batch_valid_moves(states), self.rewards(idcs, dones), dones
+
+    def winning(self, idcs=None):
+        """
+        :return: 1 where black is winning, -1 where white is winning and 0 on ties
+        """
+        if idcs is None:
+            idcs = np.arange(len(self.envs))
+        # The canonical black stones belong to the player to move
+        winning = data.batch_winning(self.states[idcs])
+        return np.where(self.turns[idcs] == data.GoVars.BLACK, winning, -winning)
+
+    def rewards(self, idcs, dones):
+        """
+        Same as the rewards of the gym environment for black
+        """
+        if self.reward_method == 'real':
+            return np.where(dones, self.winning(idcs), 0)
+
+        assert self.reward_method == 'heuristic'
+        black_area, white_area = data.batch_areas(self.states[idcs])
+        area_difference = np.where(self.turns[idcs] == data.GoVars.BLACK, 1, -1) * (black_area - white_area)
+        final = np.where(area_difference > 0, 1, -1) * self.size ** 2
+        return np.where(dones, final, area_difference)
+
+    def __len__(self):
+        return len(self.envs)
+
+
+class BoardEnv:
+    """
+    One board of a BatchGoEnv, with the parts of the gym environment that the policies use
+    """
+
+    def __init__(self, boards, index):
+        self.boards = boards
+        self.index = index
+        self.size = boards.size
+
+    def canonical_state(self):
+        return self.boards.states[self.index].copy()
+
+    def get_state(self):
+        state = self.canonical_state()
+        if self.turn() == data.GoVars.WHITE:
+            state = data.swap_colors(state[np.newaxis])[0]
+            state[data.GoVars.TURN_CHNL] = data.GoVars.WHITE
+        return state
+
+    def turn(self):
+        return self.boards.turns[self.index]
+
+    def valid_moves(self):
+        return data.batch_valid_moves(self.boards.states[self.index, np.newaxis])[0]
+
+    def game_ended(self):
+        return data.batch_game_ended(self.boards.states[self.index, np.newaxis])[0]
+
+    def winning(self):
+        return self.boards.winning([self.index])[0]
+
+
+class EnvList:
+    """
+    Gym environments behind the same interface as BatchGoEnv. They're stepped one at a time
+    """
+
+    def __init__(self, go_envs):
+        self.envs = list(go_envs)
+        self.size = self.envs[0].size
+
+    def step(self, idcs, actions):
+        rewards, dones = [], []
+        for i, action in zip(idcs, actions):
+            _, reward, done, _ = self.envs[i].step(action)
+            rewards.append(reward)
+            dones.append(done)
+        states = np.array([self.envs[i].canonical_state() for i in idcs])
+        return states, data.batch_valid_moves(states), np.array(rewards), np.array(dones)
+
+    def winning(self, idcs=None):
+        if idcs is None:
+            idcs = range(len(self.envs))
+        return np.array([self.envs[i].winning() for i in idcs])
+
+    def __len__(self):
+        return len(self.envs)
+
+
 def pit(go_env, black_policy: policies.Policy, white_policy: policies.Policy):
     """
     Pits two policies against each other and returns the results
@@ -68,64 +225,92 @@ def pit(go_env, black_policy: policies.Policy, white_policy: policies.Policy):
 
             Trajectory is empty list if get_trajectory is None
     """
-    num_steps = 0
-    state = go_env.canonical_state()
+    return batch_pit(EnvList([go_env]), black_policy, white_policy)[0]
+
 
-    max_steps = 2 * (go_env.size ** 2)
+def batch_pit(boards, black_policy: policies.Policy, white_policy: policies.Policy):
+    """
+    Plays a game on every board in lockstep. At every step, each policy is asked for the actions of all the
+    games waiting on it at once, so their searches share network calls, and all the boards are stepped together
+    :param boards: BatchGoEnv or EnvList
+    :param black_policy:
+    :param white_policy:
+    :return: List of the results of every game, in the same form as pit
+    """
+    go_envs = boards.envs
+    n = len(go_envs)
+    num_steps = [0 for _ in range(n)]
+    states = [go_env.canonical_state() for go_env in go_envs]
+    max_steps = 2 * (boards.size ** 2)
 
-    traj = Trajectory()
+    trajs = [Trajectory() for _ in range(n)]
 
-    done = False
+    # Start the policies without any search trees from previous games
+    for go_env in go_envs:
+        black_policy.reset(go_env)
+        white_policy.reset(go_env)
 
-    while not done:
-        # Get turn
-        curr_turn = go_env.turn()
+    dones = [False for _ in range(n)]
 
-        # Get an action
-        if curr_turn == data.GoVars.BLACK:
-            pi = black_policy(go_env, step=num_steps)
-        else:
-            assert curr_turn == data.GoVars.WHITE
-            pi = white_policy(go_env, step=num_steps)
+    while not all(dones):
+        # Get an action for every game that's still going
+        active = [i for i in range(n) if not dones[i]]
+        pis = {}
+        for policy, turn in [(black_policy, data.GoVars.BLACK), (white_policy, data.GoVars.WHITE)]:
+            waiting = [i for i in active if go_envs[i].turn() == turn]
+            if len(waiting) > 0:
+                waiting_pis = policy.batch_call([go_envs[i] for i in waiting])
+                pis.update(zip(waiting, waiting_pis))
 
-        action = data.GoGame.random_weighted_action(pi)
+        # Execute actions in every environment at once
+        actions = [data.GoGame.random_weighted_action(pis[i]) for i in active]
+        next_states, _, rewards, step_dones = boards.step(active, actions)
 
-        # Execute actions in environment and MCT tree
-        padded_children = go_env.children(canonical=True, padded=True)
-        _, reward, done, _ = go_env.step(action)
+        for i, action, next_state, reward, done in zip(active, actions, next_states, rewards, step_dones):
+            go_env = go_envs[i]
 
-        # End if we've reached max steps
-        if num_steps >= max_steps:
-            done = True
+            # Reuse the searched subtree of the action
+            black_policy.step(go_env, action)
+            if white_policy is not black_policy:
+                white_policy.step(go_env, action)
 
-        # Add to memory cache
-        traj.add_event(state, action, reward, padded_children, pi)
+            # End if we've reached max steps
+            if num_steps[i] >= max_steps:
+                done = True
 
-        # Increment steps
-        num_steps += 1
+            # Add to memory cache
+            trajs[i].add_event(states[i], action, reward, pis[i])
 
-        # Setup for next event
-        state = padded_children[action]
+            # Increment steps
+            num_steps[i] += 1
 
-    assert done
+            # Setup for next event
+            states[i] = next_state
+            dones[i] = done
 
-    # Determine who won
-    black_won = go_env.winning()
+    results = []
+    for go_env, black_won, steps, traj in zip(go_envs, boards.winning(), num_steps, trajs):
+        # Free the search trees
+        black_policy.reset(go_env)
+        white_policy.reset(go_env)
 
-    traj.set_win(black_won)
+        traj.set_win(black_won)
+        results.append((black_won, steps, traj))
 
-    return black_won, num_steps, traj
+    return results
 
 
 def play_games(go_env, first_policy: policies.Policy, second_policy: policies.Policy, episodes,
-               progress=True):
+               progress=True, lockstep=1):
     """
 
-    :param go_env:
+    :param go_env: Gym environment with the board size and the reward method of the games
     :param first_policy:
     :param second_policy:
     :param episodes:
     :param progress:
+    :param lockstep: Number of boards of a BatchGoEnv that are played at the same time with batch_pit. With 1, the
+    games are played one at a time on the gym environment
     :return:
     """
     replay = []
@@ -133,22 +318,36 @@ def play_games(go_env, first_policy: policies.Policy, second_policy: policies.Po
     first_wins = 0
     black_wins = 0
     if progress:
-        pbar = tqdm(range(1, episodes + 1), desc="{} vs. {}".format(first_policy, second_policy), leave=True)
+        pbar = tqdm(total=episodes, desc="{} vs. {}".format(first_policy, second_policy), leave=True)
     else:
-        pbar = range(1, episodes + 1)
-    for i in pbar:
-        go_env.reset()
-        if i % 2 == 0:
-            black_won, steps, traj = pit(go_env, first_policy, second_policy)
-            first_won = black_won
-        else:
-            black_won, steps, traj = pit(go_env, second_policy, first_policy)
-            first_won = -black_won
-        black_wins += int(black_won == 1)
-        first_wins += int(first_won == 1)
-        all_steps.append(steps)
-        replay.append(traj)
-        if isinstance(pbar, tqdm):
-            pbar.set_postfix_str("{:.1f}% WIN".format(100 * first_wins / i))
+        pbar = None
+
+    lockstep = max(1, min(lockstep, episodes))
+
+    # Every other game the first policy plays black
+    for first_black, games in [(True, episodes // 2), (False, episodes - episodes // 2)]:
+        for start in range(0, games, lockstep):
+            if lockstep > 1:
+                boards = BatchGoEnv.like(go_env, min(lockstep, games - start))
+            else:
+                go_env.reset()
+                boards = EnvList([go_env])
+            if first_black:
+                results = batch_pit(boards, first_policy, second_policy)
+            else:
+                results = batch_pit(boards, second_policy, first_policy)
+
+            for black_won, steps, traj in results:
+                first_won = black_won if first_black else -black_won
+                black_wins += int(black_won == 1)
+                first_wins += int(first_won == 1)
+                all_steps.append(steps)
+                replay.append(traj)
+            if pbar is not None:
+                pbar.update(len(results))
+                pbar.set_postfix_str("{:.1f}% WIN".format(100 * first_wins / len(replay)))
+
+    if pbar is not None:
+        pbar.close()
 
     return first_wins / episodes, black_wins / episodes, replay, all_steps
@@ -0,0 +1,248 @@
+import multiprocessing as mp
+import os
+import time
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+import torch
+
+from go_ai import data
+from go_ai.policies import baselines
+
+MODES = ['critic', 'actor', 'actor_critic']
+
+# Slot header fields
+REQUEST, RESPONSE, COUNT, MODE = range(4)
+
+# Server header fields. The heartbeat is the time in milliseconds of the last iteration of the server loop, or -1
+# once the server has stopped
+SHUTDOWN, VERSION, HEARTBEAT = range(3)
+
+
+def slot_layout(size, clients, capacity):
+    """
+    Layout of the shared memory. Every client owns a slot with a buffer for one request and its response.
+    A request is pending while its sequence number is ahead of the response's
+    :return: List of (name, shape, dtype) of every array in the shared memory
+    """
+    actionsize = size ** 2 + 1
+    return [
+        ('server', (3,), np.int64),
+        ('headers', (clients, 4), np.int64),
+        ('states', (clients, capacity, data.GoVars.NUM_CHNLS, size, size), np.float32),
+        ('pi_logits', (clients, capacity, actionsize), np.float32),
+        ('val_logits', (clients, capacity, 1), np.float32),
+    ]
+
+
+def map_arrays(buffer, size, clients, capacity):
+    arrays = {}
+    offset = 0
+    for name, shape, dtype in slot_layout(size, clients, capacity):
+        arrays[name] = np.ndarray(shape, dtype, buffer=buffer, offset=offset)
+        offset += arrays[name].nbytes
+    return arrays
+
+
+def shared_bytes(size, clients, capacity):
+    return sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for _, shape, dtype in
+               slot_layout(size, clients, capacity))
+
+
+class InferenceServer:
+    """
+    Local process that owns a model and evaluates the states of several clients together.
+    Clients write their states into their slot of a shared memory block. The server waits until it has maxbatch
+    states or the oldest request is older than the deadline, then evaluates every pending request of the same mode
+    in a single forward pass
+    """
+
+    def __init__(self, args, clients, capacity=None, maxbatch=None, wait=None):
+        """
+        :param args: Hyperparameters to create and load the model, like in baselines.create_policy
+        :param clients: Number of clients
+        :param capacity: Max number of states of a single request. Clients split bigger requests
+        :param maxbatch: Number of states at which the server stops waiting for more requests
+        :param wait: Seconds the server waits for more requests after the first one arrives
+        """
+        self.size = args.size
+        self.clients = clients
+        self.capacity = capacity if capacity is not None else args.server_batch
+        self.maxbatch = maxbatch if maxbatch is not None else args.server_batch
+        self.wait = wait if wait is not None else args.server_wait / 1000
+
+        self.shm = shared_memory.SharedMemory(create=True, size=shared_bytes(self.size, clients, self.capacity))
+        self.arrays = map_arrays(self.shm.buf, self.size, clients, self.capacity)
+        for array in self.arrays.values():
+            array.fill(0)
+
+        context = mp.get_context('spawn')
+        self.process = context.Process(target=serve, args=(args, self.handle(), self.maxbatch, self.wait),
+                                       daemon=True)
+
+        # The server can't join the MPI job of the worker that starts it, so it runs as its own MPI singleton
+        mpi_env = {key: value for key, value in os.environ.items() if key.startswith(('OMPI_', 'PMIX_'))}
+        for key in mpi_env:
+            del os.environ[key]
+        try:
+            self.process.start()
+        finally:
+            os.environ.update(mpi_env)
+
+    def handle(self):
+        """
+        :return: Picklable description of the shared memory for clients in other processes
+        """
+        return self.shm.name, self.size, self.clients, self.capacity
+
+    def client(self, slot):
+        return InferenceClient(self.handle(), slot)
+
+    def reload(self):
+        """
+        Tells the server to reload the weights of the checkpoint before its next forward pass
+        """
+        self.arrays['server'][VERSION] += 1
+
+    def close(self):
+        self.arrays['server'][SHUTDOWN] = 1
+        self.process.join()
+        del self.arrays
+        self.shm.close()
+        self.shm.unlink()
+
+
+class InferenceClient:
+    """
+    Submits states to an inference server through a slot of its shared memory. Drops in behind RLNet.create_numpy
+    """
+
+    def __init__(self, handle, slot, untrack=False, timeout=60):
+        """
+        :param untrack: Whether this process has its own resource tracker, which would otherwise unlink the shared
+        memory when this process exits. Processes spawned by the server's process share its tracker
+        :param timeout: Seconds without a heartbeat of the server after which a request fails
+        """
+        name, size, clients, capacity = handle
+        assert 0 <= slot < clients, (slot, clients)
+        self.shm = shared_memory.SharedMemory(name=name)
+        if untrack:
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.arrays = map_arrays(self.shm.buf, size, clients, capacity)
+        self.slot = slot
+        self.capacity = capacity
+        self.timeout = timeout
+
+    def numpy(self, states, mode):
+        """
+        Same as RLNet._numpy, but evaluated by the server
+        """
+        all_pi_logits = [self.arrays['pi_logits'][self.slot, :0]]
+        all_val_logits = [self.arrays['val_logits'][self.slot, :0]]
+        for start in range(0, len(states), self.capacity):
+            pi_logits, val_logits = self.request(states[start:start + self.capacity], mode)
+            all_pi_logits.append(pi_logits)
+            all_val_logits.append(val_logits)
+
+        pi_logits = np.concatenate(all_pi_logits)
+        val_logits = np.concatenate(all_val_logits)
+        if mode == 'critic':
+            return val_logits
+        elif mode == 'actor':
+            return pi_logits
+        else:
+            assert mode == 'actor_critic'
+            return pi_logits, val_logits
+
+    def request(self, states, mode):
+        header = self.arrays['headers'][self.slot]
+        count = len(states)
+        self.arrays['states'][self.slot, :count] = states
+        header[COUNT] = count
+        header[MODE] = MODES.index(mode)
+        header[REQUEST] += 1
+
+        # Wait for the response, as long as the server is alive. It may still be loading its model when the first
+        # request arrives, so the timeout runs from the request until the server's first heartbeat
+        start = time.time()
+        while header[RESPONSE] != header[REQUEST]:
+            time.sleep(1e-5)
+            heartbeat = self.arrays['server'][HEARTBEAT]
+            if heartbeat < 0:
+                raise RuntimeError('Inference server stopped before answering the request')
+            if time.time() - max(start, heartbeat / 1000) > self.timeout:
+                raise RuntimeError(f'Inference server sent no heartbeat for {self.timeout} seconds')
+
+        pi_logits = self.arrays['pi_logits'][self.slot, :count].copy()
+        val_logits = self.arrays['val_logits'][self.slot, :count].copy()
+        return pi_logits, val_logits
+
+    def reload(self):
+        """
+        Tells the server to reload the weights of the checkpoint before its next forward pass
+        """
+        self.arrays['server'][VERSION] += 1
+
+
+def serve(args, handle, maxbatch, wait):
+    """
+    Server process loop
+    """
+    # Spawned processes import data with the default engine
+    data.set_engine(args.engine)
+    name, size, clients, capacity = handle
+    shm = shared_memory.SharedMemory(name=name)
+    arrays = map_arrays(shm.buf, size, clients, capacity)
+
+    # Clients fail instead of waiting forever if the server stops, even if it couldn't load its model
+    try:
+        _, net = baselines.create_policy(args)
+        net.to(torch.device(args.device))
+        serve_requests(args, arrays, net, clients, maxbatch, wait)
+    finally:
+        arrays['server'][HEARTBEAT] = -1
+        del arrays
+        shm.close()
+
+
+def serve_requests(args, arrays, net, clients, maxbatch, wait):
+    """
+    Answers the pending requests until the server is shut down
+    """
+    headers = arrays['headers']
+    version = 0
+    while arrays['server'][SHUTDOWN] == 0:
+        arrays['server'][HEARTBEAT] = int(time.time() * 1000)
+        pending = np.nonzero(headers[:, REQUEST] != headers[:, RESPONSE])[0]
+        if len(pending) <= 0:
+            time.sleep(1e-4)
+            continue
+
+        # Micro-batch until there are enough states, every client is waiting or the deadline passes
+        deadline = time.time() + wait
+        while headers[pending, COUNT].sum() < maxbatch and len(pending) < clients and time.time() < deadline:
+            time.sleep(1e-5)
+            pending = np.nonzero(headers[:, REQUEST] != headers[:, RESPONSE])[0]
+
+        if arrays['server'][VERSION] != version:
+            version = arrays['server'][VERSION]
+            net.load_state_dict(torch.load(args.checkpath, args.device))
+
+        for mode_id, mode in enumerate(MODES):
+            slots = pending[headers[pending, MODE] == mode_id]
+            if len(slots) <= 0:
+                continue
+            counts = headers[slots, COUNT]
+            states = np.concatenate([arrays['states'][slot, :count] for slot, count in zip(slots, counts)])
+            outputs = net.create_numpy(mode)(states)
+            pi_logits = outputs[0] if mode == 'actor_critic' else (outputs if mode == 'actor' else None)
+            val_logits = outputs[1] if mode == 'actor_critic' else (outputs if mode == 'critic' else None)
+
+            start = 0
+            for slot, count in zip(slots, counts):
+                if pi_logits is not None:
+                    arrays['pi_logits'][slot, :count] = pi_logits[start:start + count]
+                if val_logits is not None:
+                    arrays['val_logits'][slot, :count] = val_logits[start:start + count]
+                start += count
+                headers[slot, RESPONSE] = headers[slot, REQUEST]
@@ -8,10 +8,11 @@ import torch
 from matplotlib import pyplot as plt
 from tqdm import tqdm
 
+import go_ai.models
 import go_ai.policies
 import go_ai.policies.actorcritic
 import go_ai.policies.value
-from go_ai import data, game
+from go_ai import data, engine, game
 
 
 def state_matplot_format(state):
@@ -66,7 +67,7 @@ def action_1d_to_2d(action_1d, board_width):
 
 
 def state_responses(policy: go_ai.policies.Policy, traj: game.Trajectory):
-    states = np.array(traj.states)
+    states = traj.get_states()
 
     all_qs_list, state_vals = measure_vals(traj.actions, policy, states)
     all_qs = np.array(all_qs_list)
@@ -104,14 +105,14 @@ def state_responses(policy: go_ai.policies.Policy, traj: game.Trajectory):
 def plot_traj_index(traj, i, black_won, mode='state'):
     n = len(traj)
     terminal = int(i == n - 1)
-    board_size = traj.states[0].shape[1]
+    board_size = traj.size
     if mode == 'state':
-        state = traj.states[i]
+        state = traj.get_state(i)
         action_took = action_1d_to_2d(traj.actions[i], board_size)
         board_title = 'Action: {}\n'.format(action_took)
     else:
         assert mode == 'next_state'
-        state = traj.children[i][traj.actions[i]]
+        state = traj.get_next_state(i)
         board_title = 'Next State\n'
 
     plt.axis('off')
@@ -128,7 +129,10 @@ def measure_vals(actions, policy, states):
     go_env = gym.make('gym_go:go-v0', size=size)
     for step, (state, prev_action) in tqdm(enumerate(zip(states, actions)), desc='Heat Maps'):
         pi, qs, rootnode = policy(go_env, step=step, debug=True)
-        if hasattr(policy, 'val_func'):
+        if rootnode.val is not None:
+            # The policy already evaluated the state
+            state_val = rootnode.val
+        elif hasattr(policy, 'val_func'):
             state_val = policy.val_func(state[np.newaxis]).item()
         elif hasattr(policy, 'ac_func'):
             _, state_val = policy.ac_func(state[np.newaxis])
@@ -141,18 +145,128 @@ def measure_vals(actions, policy, states):
     return all_qs, state_vals
 
 
+def random_states(size, n):
+    """
+    :return: n canonical states of games of random moves
+    """
+    go_env = gym.make('gym_go:go-v0', size=size)
+    states = []
+    done = True
+    while len(states) < n:
+        if done:
+            go_env.reset()
+        states.append(go_env.canonical_state())
+        valid_moves = go_env.valid_moves()
+        _, _, done, _ = go_env.step(np.random.choice(np.nonzero(valid_moves)[0]))
+    return np.array(states, dtype=np.float32)
+
+
+def compare_export(model, scripted, samples=256, batchsizes=(1, 8, 64), reps=16):
+    """
+    Compares the export of a model, whose linear layers are dynamically quantized to int8 and whose convolutions stay
+    fp32, to the fp32 model on the CPU
+    :return: Dataframe of the accuracy of the export on random states, and of the latencies of both per batch size
+    """
+    states = random_states(model.size, samples)
+    modes = ['critic']
+    if type(model).pt_actor is not go_ai.models.RLNet.pt_actor:
+        modes.append('actor')
+
+    def timed(func, batch):
+        start = time.time()
+        for _ in range(reps):
+            func(batch)
+        return (time.time() - start) / reps * 1000
+
+    rows = []
+    original, model.scripted = model.scripted, None
+    try:
+        for mode in modes:
+            # Bypasses the cache and the inference server
+            def func(batch):
+                return model._numpy(batch, mode)
+
+            model.scripted = None
+            fp32_out = func(states)
+            fp32_times = [timed(func, states[:bsz]) for bsz in batchsizes]
+            model.scripted = scripted
+            export_out = func(states)
+            export_times = [timed(func, states[:bsz]) for bsz in batchsizes]
+
+            row = {'mode': mode, 'size': model.size, 'max_err': np.abs(export_out - fp32_out).max()}
+            if mode == 'actor':
+                valid = data.batch_valid_moves(states) > 0
+                row['max_err'] = np.abs(export_out - fp32_out)[valid].max()
+                row['argmax_agree'] = np.mean(np.argmax(export_out, axis=1) == np.argmax(fp32_out, axis=1))
+            else:
+                row['sign_agree'] = np.mean(np.sign(export_out) == np.sign(fp32_out))
+            for bsz, fp32_ms, export_ms in zip(batchsizes, fp32_times, export_times):
+                row[f'fp32_ms@{bsz}'] = fp32_ms
+                row[f'dynamic_int8_linear_ms@{bsz}'] = export_ms
+            rows.append(row)
+    finally:
+        model.scripted = original
+    return pd.DataFrame(rows)
+
+
+def compare_engines(size=9, samples=64, reps=4):
+    """
+    Times the rules of gym_go against the native engine on random states. 'native' plays the moves on copies of the
+    boards of the states, like the search tree and the lockstep games do. 'native_from_state' builds the board from the
+    state on every call, like the module functions of engine do
+    :return: Dataframe of the milliseconds per state of next_state and children for every implementation
+    """
+    states = random_states(size, samples)
+    actions = [np.random.choice(np.flatnonzero(engine.valid_moves(state))) for state in states]
+    boards = [engine.Board.from_state(state) for state in states]
+
+    def board_next_state(board, action):
+        board = board.copy()
+        board.play(int(action))
+        return board.state(canonical=True)
+
+    def board_children(board, state):
+        return [board_next_state(board, action) for action in np.flatnonzero(engine.valid_moves(state))]
+
+    funcs = {
+        'next_state': {
+            'gym': lambda i: engine.GymGoGame.next_state(states[i], actions[i], canonical=True),
+            'native': lambda i: board_next_state(boards[i], actions[i]),
+            'native_from_state': lambda i: engine.next_state(states[i], actions[i], canonical=True),
+        },
+        'children': {
+            'gym': lambda i: engine.GymGoGame.children(states[i], canonical=True, padded=True),
+            'native': lambda i: board_children(boards[i], states[i]),
+            'native_from_state': lambda i: engine.children(states[i], canonical=True, padded=True),
+        },
+    }
+
+    rows = []
+    for operation, impls in funcs.items():
+        row = {'operation': operation, 'size': size}
+        for name, func in impls.items():
+            start = time.time()
+            for _ in range(reps):
+                for i in range(samples):
+                    func(i)
+            row[f'{name}_ms'] = (time.time() - start) / (reps * samples) * 1000
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
 def plot_go_understanding(go_env, policy: go_ai.policies.Policy, outpath):
     go_env.reset()
     _, _, traj = game.pit(go_env, black_policy=policy, white_policy=policy)
     n = len(traj)
     ncols = 3
     fig = plt.figure(figsize=(ncols * 2.5, n * 2))
-    states = np.array(traj.states)
+    states = traj.get_states()
 
     model = policy.pt_model
     with torch.no_grad():
         torch_states = torch.tensor(states).type(model.dtype())
-        all_preds = torch.sigmoid(model.pt_game(torch_states)).numpy()
+        all_preds, = model.pt_heads(torch_states, ('game',))
+        all_preds = torch.sigmoid(all_preds).numpy()
     for i, (a, pred) in enumerate(zip(traj.actions, all_preds)):
         plt.subplot(n, 3, 3 * i + 1)
         plot_traj_index(traj, i, 0)
@@ -1,3 +1,4 @@
+import functools
 import os
 import warnings
 
@@ -5,16 +6,42 @@ import numpy as np
 import torch
 from mpi4py import MPI
 from torch import nn as nn
+from torch import quantization
 from torch.nn import functional as F
+from torch.nn.utils import fusion
 
 from go_ai import data
 
 
+# Heads that each mode of the numpy functions evaluates
+MODE_HEADS = {
+    'critic': ('critic',),
+    'actor': ('actor',),
+    'actor_critic': ('actor', 'critic'),
+}
+
+
 class RLNet(nn.Module):
     def __init__(self, in_c=6):
         super().__init__()
         self.requires_children = False
         self.assist = True
+        # Inference server that evaluates the numpy functions instead of this process
+        self.client = None
+        # Optional cache.OutputCache of the numpy functions
+        self.cache = None
+        # Optional export_model of this model that the numpy functions evaluate instead
+        self.scripted = None
+        # Whether the weights changed since the export, which is then redone on the next evaluation
+        self.scripted_stale = False
+        # Optional GradientAverager for data-parallel training
+        self.grad_averager = None
+        # Float32 input buffers of _numpy by number of dimensions, so that the states and the children of a batch get
+        # their own. nn.Module keeps its registered buffers in _buffers
+        self._input_buffers = {}
+        # Per-sample losses of the current training batch. Only recorded when a prioritized stream consumes them
+        self.track_losses = False
+        self.sample_losses = None
         self.layers = 3
         self.channels = 128
 
@@ -42,67 +69,126 @@ class RLNet(nn.Module):
     def pt_game(self, states):
         raise Exception("Not Implemented")
 
+    def pt_heads(self, states, heads, children=None):
+        """
+        Evaluates the requested heads on one batch. Models whose heads share a trunk override this to compute the
+        trunk once
+        :param heads: Names of the heads out of 'actor', 'critic' and 'game'
+        :param children: Padded children of the states for models that require them
+        :return: Tuple of the outputs of the heads in the requested order
+        """
+        outputs = []
+        for head in heads:
+            if head == 'actor':
+                outputs.append(self.pt_actor(states, children) if self.requires_children else self.pt_actor(states))
+            elif head == 'critic':
+                outputs.append(self.pt_critic(states))
+            elif head == 'game':
+                outputs.append(self.pt_game(states))
+            else:
+                raise Exception(f"Unknown head: {head}")
+        return tuple(outputs)
+
     def create_numpy(self, mode):
         def np_func(states):
+            if self.client is not None:
+                return self.client.numpy(states, mode)
+            if self.cache is not None:
+                return self.cache.numpy(states, mode, self._numpy)
             return self._numpy(states, mode)
 
         return np_func
 
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        ret = super().load_state_dict(state_dict, *args, **kwargs)
+        self.weights_changed()
+        return ret
+
+    def weights_changed(self):
+        """
+        Drops everything that was computed from the old weights
+        """
+        if self.cache is not None:
+            self.cache.clear()
+        if self.scripted is not None:
+            self.scripted_stale = True
+
     def dtype(self):
         return next(self.parameters()).type()
 
+    def _to_tensor(self, array):
+        """
+        Wraps a numpy batch as a tensor of the model's dtype and device. Float32 arrays are shared without copying.
+        Other arrays like uint8 or bool states are converted into a view of a buffer that is reused across batches and
+        only grows when a batch doesn't fit
+        """
+        array = np.asarray(array)
+        if array.dtype != np.float32 or not array.flags.c_contiguous or not array.flags.writeable:
+            buffer = self._input_buffers.get(array.ndim)
+            if buffer is None or len(buffer) < array.size:
+                buffer = self._input_buffers[array.ndim] = np.empty(array.size, dtype=np.float32)
+            view = buffer[:array.size].reshape(array.shape)
+            np.copyto(view, array, casting='unsafe')
+            array = view
+        if self.scripted is not None:
+            # Exports run on the CPU
+            return torch.from_numpy(array)
+        param = next(self.parameters())
+        return torch.from_numpy(array).to(device=param.device, dtype=param.dtype)
+
     def _numpy(self, states, mode, children=None):
         """
         :param states: Numpy batch of states
         :return:
         """
-        invalid_values = data.batch_invalid_values(states)
-        dtype = self.dtype()
+        states = np.asarray(states)
 
         # Execute on PyTorch
-        pi_logits, val_logits = None, None
+        if mode not in MODE_HEADS:
+            raise Exception(f"Unknown mode: {mode}")
+        heads = MODE_HEADS[mode]
+        if self.scripted is not None and self.scripted_stale:
+            self.scripted = export_model(self)
+            self.scripted_stale = False
         self.eval()
         with torch.no_grad():
-            tensor_states = torch.tensor(states).type(dtype)
-
-            # Determine which pytorch function to call
-            if mode == 'critic':
-                val_logits = self.pt_critic(tensor_states)
-            elif mode == 'actor' or mode == 'actor_critic':
-                args = [tensor_states]
-                # Compute children if needed
+            tensor_states = self._to_tensor(states)
+
+            # Compute children if needed
+            tensor_children = None
+            if 'actor' in heads:
                 if children is None and (self.requires_children or self.assist):
                     children = data.batch_padded_children(states)
-
-                # Add it to args if requires children
                 if self.requires_children:
-                    tensor_ns = torch.tensor(children).type(dtype)
-                    args.append(tensor_ns)
+                    tensor_children = self._to_tensor(children)
 
-                if mode == 'actor':
-                    pi_logits = self.pt_actor(*args)
-                else:
-                    assert mode == 'actor_critic'
-                    pi_logits, val_logits = self.pt_actor_critic(*args)
+            if self.scripted is None:
+                outputs = self.pt_heads(tensor_states, heads, tensor_children)
             else:
-                raise Exception(f"Unknown mode: {mode}")
-
-        # Process PyTorch results
+                # Exports only have the pt_* functions
+                args = [tensor_states] if tensor_children is None else [tensor_states, tensor_children]
+                outputs = getattr(self.scripted, f'pt_{mode}')(*args)
+                outputs = outputs if isinstance(outputs, tuple) else (outputs,)
+        outputs = dict(zip(heads, outputs))
+        pi_logits, val_logits = outputs.get('actor'), outputs.get('critic')
+
+        # Outputs of the network on the CPU are already fresh arrays, so they're processed in place
         if pi_logits is not None:
-            pi_logits = pi_logits.detach().cpu().numpy()
-            pi_logits += invalid_values
+            pi_logits = pi_logits.cpu().numpy()
+            invalid_moves = states[:, data.GoVars.INVD_CHNL].reshape(len(states), -1) > 0
+            np.copyto(pi_logits[:, :-1], np.finfo(np.float32).min, where=invalid_moves)
             if self.assist:
                 # Set obvious moves
                 # A child loss means we win and vice versa
-                pi_logits += -100 * data.batch_win_children(children)
+                pi_logits -= 100 * data.batch_win_children(children)
 
         if val_logits is not None:
-            val_logits = val_logits.detach().cpu().numpy()
+            val_logits = val_logits.cpu().numpy()
             if self.assist:
                 # Set obvious values
-                for i, state in enumerate(states):
-                    if data.GoGame.game_ended(state):
-                        val_logits[i] = 100 * data.GoGame.winning(state)
+                ended = data.batch_game_ended(states)
+                if ended.any():
+                    val_logits[ended] = 100 * data.batch_winning(states[ended])[:, np.newaxis]
 
         # Return
         if pi_logits is None:
@@ -115,18 +201,17 @@ class RLNet(nn.Module):
     def critic_step(self, imgs, wins):
         dtype = self.dtype()
 
-        # Preprocess
-        imgs = data.batch_random_symmetries(imgs)
-
         # To tensors
-        imgs = torch.tensor(imgs).type(dtype)
-        wins = torch.tensor(wins[:, np.newaxis]).type(dtype)
+        imgs = torch.as_tensor(imgs).type(dtype)
+        wins = torch.as_tensor(wins[:, np.newaxis]).type(dtype)
 
         # Critic Loss
-        val_logits = self.pt_critic(imgs)
+        val_logits, = self.pt_heads(imgs, ('critic',))
         vals = torch.tanh(val_logits)
 
-        critic_loss = F.mse_loss(vals, wins)
+        critic_losses = F.mse_loss(vals, wins, reduction='none').flatten()
+        self.record_losses(critic_losses)
+        critic_loss = torch.mean(critic_losses)
 
         # Predict wins
         pred_wins = torch.sign(vals)
@@ -138,18 +223,17 @@ class RLNet(nn.Module):
         bsz = len(states)
 
         # To tensors
-        # Do not augment with random symmetries. Otherwise it invalidates the actions
-        states = torch.tensor(states).type(dtype)
-        children = torch.tensor(children).type(dtype)
-        wins = torch.tensor(wins[:, np.newaxis]).type(dtype)
+        states = torch.as_tensor(states).type(dtype)
+        children = torch.as_tensor(children).type(dtype)
+        wins = torch.as_tensor(wins[:, np.newaxis]).type(dtype)
 
         # Value for baseline
         with torch.no_grad():
-            val_logits = self.pt_critic(states)
+            val_logits, = self.pt_heads(states, ('critic',))
             vals = torch.tanh(val_logits)
 
         # Forward pass
-        pi_logits = self.pt_actor(states, children)
+        pi_logits, = self.pt_heads(states, ('actor',), children)
 
         # Log probability of taken actions
         logpi_logits = torch.log_softmax(pi_logits, dim=1)
@@ -160,6 +244,7 @@ class RLNet(nn.Module):
         advantages = wins - vals
         assert log_pis.shape == advantages.shape
         expected_reward = log_pis * advantages
+        self.record_losses(expected_reward.flatten())
         actor_loss = -torch.mean(expected_reward)
 
         return actor_loss, 0
@@ -167,17 +252,17 @@ class RLNet(nn.Module):
     def actor_step(self, states, pi):
         dtype = self.dtype()
 
-        # Do not augment with random symmetries because it will invalidate the actions
-        states = torch.tensor(states).type(dtype)
-
         # To tensors
-        target_pis = torch.tensor(pi).type(dtype)
+        states = torch.as_tensor(states).type(dtype)
+        target_pis = torch.as_tensor(pi).type(dtype)
         greedy_actions = torch.argmax(target_pis, dim=1)
 
         # Compute losses
-        pi_logits = self.pt_actor(states)
+        pi_logits, = self.pt_heads(states, ('actor',))
         assert pi_logits.shape == target_pis.shape
-        loss = F.cross_entropy(pi_logits, greedy_actions)
+        losses = F.cross_entropy(pi_logits, greedy_actions, reduction='none')
+        self.record_losses(losses)
+        loss = torch.mean(losses)
 
         # Actor accuracy
         pred_greedy_actions = torch.argmax(pi_logits, dim=1)
@@ -191,12 +276,12 @@ class RLNet(nn.Module):
         size = states[0].shape[-1]
 
         # To tensors
-        states = torch.tensor(states).type(dtype)
+        states = torch.as_tensor(states).type(dtype)
         children = children.reshape(bsz, -1, size, size)
-        children = torch.tensor(children).type(dtype)
+        children = torch.as_tensor(children).type(dtype)
 
         # Critic Loss
-        pred = self.pt_game(states)
+        pred, = self.pt_heads(states, ('game',))
         pred = torch.sigmoid(pred)
 
         critic_loss = 50 * F.mse_loss(pred, children)
@@ -204,18 +289,49 @@ class RLNet(nn.Module):
         # Predict wins
         return critic_loss
 
-    def train_step(self, optimizer, states, actions, reward, children, terminal, wins, pi):
+    def train_step(self, optimizer, states, actions, reward, next_states, terminal, wins, pi):
+        """
+        :param states: Batch of data.prepare_batch, which is already augmented with random symmetries
+        """
         raise Exception("Not Implemented")
 
+    def record_losses(self, losses):
+        """
+        Adds the per-sample losses of a step to the magnitudes of the current batch, which are the priorities of
+        its positions under prioritized sampling
+        """
+        if not self.track_losses:
+            return
+        # Stays on the model's device until the batch is done
+        losses = losses.detach().abs()
+        self.sample_losses = losses if self.sample_losses is None else self.sample_losses + losses
+
+    def optimizer_step(self, optimizer):
+        """
+        Steps the optimizer after backward, with the gradients averaged across workers in data-parallel training
+        """
+        if self.grad_averager is not None:
+            self.grad_averager.synchronize()
+        optimizer.step()
+
     def optimize(self, comm: MPI.Intracomm, batched_data, optimizer):
         raw_metrics = []
         self.train()
-        for states, actions, reward, children, terminal, wins, pi in batched_data:
-            metrics = self.train_step(optimizer, states, actions, reward, children, terminal, wins, pi)
+        self.track_losses = hasattr(batched_data, 'update_priorities')
+        for states, actions, reward, next_states, terminal, wins, pi in batched_data:
+            self.sample_losses = None
+            metrics = self.train_step(optimizer, states, actions, reward, next_states, terminal, wins, pi)
             raw_metrics.append(metrics)
 
-        # Sync Parameters
-        average_model(comm, self)
+            # Prioritized sampling
+            if self.sample_losses is not None:
+                batched_data.update_priorities(self.sample_losses.cpu().numpy())
+        self.track_losses = False
+
+        # Sync Parameters. With averaged gradients, every worker takes the same steps from the same parameters
+        if self.grad_averager is None:
+            average_model(comm, self)
+        self.weights_changed()
 
         # Sync Metrics
         world_size = comm.Get_size()
@@ -276,19 +392,207 @@ class ModelMetrics:
         return self.__str__()
 
 
-def average_model(comm, model):
-    world_size = comm.Get_size()
-    for params in model.parameters():
-        params.data = comm.allreduce(params.data, op=MPI.SUM) / world_size
+# Size of the flat buffers that parameters and gradients are reduced in
+BUCKET_BYTES = 2 ** 22
+
 
+def make_buckets(tensors, bucket_bytes=BUCKET_BYTES):
+    """
+    Groups consecutive tensors into buckets of about bucket_bytes of float32 values
+    :return: List of lists of indices into tensors
+    """
+    buckets = [[]]
+    size = 0
+    for i, tensor in enumerate(tensors):
+        if size > 0 and size + 4 * tensor.numel() > bucket_bytes:
+            buckets.append([])
+            size = 0
+        buckets[-1].append(i)
+        size += 4 * tensor.numel()
+    return [bucket for bucket in buckets if len(bucket) > 0]
 
-def get_modelpath(args, savetype):
+
+def average_model(comm, model):
+    """
+    Averages the parameters across workers. The parameters are flattened into a few contiguous buffers,
+    which are reduced in place with the buffer-based Allreduce
+    """
+    world_size = comm.Get_size()
+    if world_size <= 1:
+        return
+    params = list(model.parameters())
+    with torch.no_grad():
+        for bucket in make_buckets(params):
+            flat = torch.cat([params[i].detach().reshape(-1).float().cpu() for i in bucket])
+            buffer = flat.numpy()
+            comm.Allreduce(MPI.IN_PLACE, buffer, op=MPI.SUM)
+            buffer /= world_size
+
+            offset = 0
+            for i in bucket:
+                n = params[i].numel()
+                params[i].copy_(flat[offset:offset + n].view_as(params[i]))
+                offset += n
+
+
+def broadcast_model(comm, model, root=0):
+    """
+    Sets the parameters of every worker to those of the root worker, in flat buckets like average_model
+    """
+    if comm.Get_size() <= 1:
+        return
+    params = list(model.parameters())
+    with torch.no_grad():
+        for bucket in make_buckets(params):
+            flat = torch.cat([params[i].detach().reshape(-1).float().cpu() for i in bucket])
+            comm.Bcast(flat.numpy(), root=root)
+
+            offset = 0
+            for i in bucket:
+                n = params[i].numel()
+                params[i].copy_(flat[offset:offset + n].view_as(params[i]))
+                offset += n
+
+
+def broadcast_state_dict(comm, state_dict, root=0):
+    """
+    Broadcasts the state dict of the root worker with one flat Bcast per dtype
+    :param state_dict: State dict of every worker with the same keys and shapes, which is only read on the root
+    :return: The state dict of the root as CPU tensors
+    """
+    keys_by_dtype = {}
+    for key, tensor in state_dict.items():
+        keys_by_dtype.setdefault(tensor.dtype, []).append(key)
+
+    new_state_dict = {}
+    for dtype, keys in keys_by_dtype.items():
+        flat = torch.cat([state_dict[key].detach().reshape(-1).cpu() for key in keys])
+        comm.Bcast(flat.numpy(), root=root)
+        offset = 0
+        for key in keys:
+            n = state_dict[key].numel()
+            new_state_dict[key] = flat[offset:offset + n].view_as(state_dict[key])
+            offset += n
+    return new_state_dict
+
+
+class GradientAverager:
+    """
+    Data-parallel training. Averages the gradients of every step across workers in flat buckets. Each bucket is
+    reduced asynchronously as soon as backward has produced all of its gradients, which overlaps the communication
+    with the rest of backward. Every worker must take the same number of steps
+    """
+
+    def __init__(self, comm, model, bucket_bytes=BUCKET_BYTES):
+        self.comm = comm
+        # Gradients arrive roughly in reverse order of the parameters
+        self.params = [param for param in model.parameters() if param.requires_grad][::-1]
+        self.buckets = make_buckets(self.params, bucket_bytes)
+        self.buffers = [np.zeros(sum(self.params[i].numel() for i in bucket), dtype=np.float32)
+                        for bucket in self.buckets]
+        self.slots = {}
+        for b, bucket in enumerate(self.buckets):
+            offset = 0
+            for i in bucket:
+                self.slots[i] = (b, offset)
+                offset += self.params[i].numel()
+
+        self.ready = np.zeros(len(self.params), dtype=bool)
+        self.requests = [None for _ in self.buckets]
+
+        # Workers start from the same parameters, so averaged gradients keep them in sync
+        broadcast_model(comm, model)
+        for i, param in enumerate(self.params):
+            param.register_hook(functools.partial(self._on_grad, i))
+
+    def _on_grad(self, i, grad):
+        b, offset = self.slots[i]
+        self.buffers[b][offset:offset + grad.numel()] = grad.detach().reshape(-1).float().cpu().numpy()
+        self.ready[i] = True
+        if self.ready[self.buckets[b]].all():
+            self._reduce(b)
+
+    def _reduce(self, b):
+        self.requests[b] = self.comm.Iallreduce(MPI.IN_PLACE, self.buffers[b], op=MPI.SUM)
+
+    def synchronize(self):
+        """
+        Waits for the reductions and sets the gradients to their averages. Parameters that got no gradient this
+        step contribute zeros
+        """
+        for b, bucket in enumerate(self.buckets):
+            if self.requests[b] is None:
+                for i in bucket:
+                    if not self.ready[i]:
+                        _, offset = self.slots[i]
+                        self.buffers[b][offset:offset + self.params[i].numel()] = 0
+                self._reduce(b)
+        MPI.Request.Waitall(self.requests)
+
+        world_size = self.comm.Get_size()
+        for i, param in enumerate(self.params):
+            b, offset = self.slots[i]
+            grad = torch.from_numpy(self.buffers[b][offset:offset + param.numel()] / world_size)
+            param.grad = grad.view_as(param).to(device=param.device, dtype=param.dtype)
+
+        self.ready[:] = False
+        self.requests = [None for _ in self.buckets]
+
+
+def fuse_conv_bn(module):
+    """
+    Folds every batch norm that follows a convolution in a sequential into the convolution. Only valid in eval mode
+    """
+    for name, child in module.named_children():
+        if isinstance(child, nn.Sequential):
+            layers = []
+            for layer in child:
+                if isinstance(layer, nn.BatchNorm2d) and len(layers) > 0 and isinstance(layers[-1], nn.Conv2d):
+                    layers[-1] = fusion.fuse_conv_bn_eval(layers[-1], layer)
+                else:
+                    fuse_conv_bn(layer)
+                    layers.append(layer)
+            setattr(module, name, nn.Sequential(*layers))
+        else:
+            fuse_conv_bn(child)
+
+
+def export_model(net):
+    """
+    TorchScript copy of the model for inference on the CPU. The batch norms are folded into the convolutions and
+    the linear layers are quantized to int8 with dynamic quantization. Convolutions stay in fp32,
+    since they would need static quantization with calibration data
+    :return: Traced module with the pt_* functions of the model
+    """
+    model = type(net)(net.size)
+    model.load_state_dict({key: value.cpu() for key, value in net.state_dict().items()})
+    model.eval()
+    fuse_conv_bn(model)
+    model = quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+    states = torch.zeros(1, 6, net.size, net.size)
+    inputs = {'pt_critic': (states,)}
+    if type(net).pt_actor is not RLNet.pt_actor:
+        actor_inputs = (states,)
+        if net.requires_children:
+            actor_inputs += (torch.zeros(1, net.size ** 2 + 1, 6, net.size, net.size),)
+        inputs['pt_actor'] = actor_inputs
+        inputs['pt_actor_critic'] = actor_inputs
+
+    with torch.no_grad():
+        return torch.jit.trace_module(model, inputs)
+
+
+def get_modelpath(args, savetype, scripted=False):
+    """
+    :param scripted: Path of the export_model of the model instead of its weights
+    """
     if savetype == 'checkpoint':
         dir = args.checkdir
     elif savetype == 'baseline':
         dir = 'bin/baselines/'
     else:
         raise Exception(f"Unknown location type: {savetype}")
-    path = os.path.join(dir, f'{args.model}{args.size}.pt')
+    path = os.path.join(dir, f'{args.model}{args.size}.script.pt' if scripted else f'{args.model}{args.size}.pt')
 
     return path
@@ -1,4 +1,3 @@
-import numpy as np
 import torch.nn as nn
 
 from go_ai import data
@@ -9,6 +8,7 @@ class ActorCriticNet(RLNet):
     def __init__(self, size):
         action_size = data.GoGame.action_size(board_size=size)
         super().__init__(6)
+        self.size = size
 
         self.action_size = action_size
 
@@ -38,38 +38,39 @@ class ActorCriticNet(RLNet):
         )
 
     def forward(self, states):
+        return self.pt_heads(states, ('actor', 'critic'))
+
+    def pt_heads(self, states, heads, children=None):
+        # One trunk pass for all the heads
         x = states - 0.5
         x = self.main(x)
-        policy_scores = self.act_head(x)
-        vals = self.crit_head(x)
-        return policy_scores, vals
+        outputs = []
+        for head in heads:
+            if head == 'actor':
+                outputs.append(self.act_head(x))
+            elif head == 'critic':
+                outputs.append(self.crit_head(x))
+            elif head == 'game':
+                outputs.append(self.game_head(x))
+            else:
+                raise Exception(f"Unknown head: {head}")
+        return tuple(outputs)
 
     # Numpy Calls
     def pt_actor(self, states):
-        x = states - 0.5
-        x = self.main(x)
-        return self.act_head(x)
+        return self.pt_heads(states, ('actor',))[0]
 
     def pt_game(self, states):
-        x = states - 0.5
-        x = self.main(x)
-        return self.game_head(x)
+        return self.pt_heads(states, ('game',))[0]
 
     def pt_critic(self, states):
-        x = states - 0.5
-        x = self.main(x)
-        return self.crit_head(x)
+        return self.pt_heads(states, ('critic',))[0]
 
     def pt_actor_critic(self, states):
         return self.forward(states)
 
     # Optimization
-    def train_step(self, optimizer, states, actions, reward, children, terminal, wins, pi):
-        # Process next states
-        bsz = len(children)
-        next_states = children[np.arange(bsz), actions]
-        next_states = data.batch_random_symmetries(next_states)
-
+    def train_step(self, optimizer, states, actions, reward, next_states, terminal, wins, pi):
         optimizer.zero_grad()
 
         # Critic
@@ -80,7 +81,7 @@ class ActorCriticNet(RLNet):
 
         loss = 2 * cl + al
         loss.backward()
-        optimizer.step()
+        self.optimizer_step(optimizer)
 
         # Return metrics
         return cl.item(), ca, al.item(), aa
@@ -1,4 +1,7 @@
+import collections
+
 import numpy as np
+import torch
 import torch.nn as nn
 
 from go_ai import data
@@ -8,6 +11,7 @@ from go_ai.models import RLNet
 class AttnNet(RLNet):
     def __init__(self, size):
         super().__init__()
+        self.size = size
         self.requires_children = True
 
         self.d_model = 64
@@ -31,6 +35,10 @@ class AttnNet(RLNet):
 
         self.crit_head = nn.Linear(self.d_model, 1)
 
+        # Inference encodings of states by their hashes, in least recently used order
+        self.encodings = collections.OrderedDict()
+        self.encodings_capacity = 2 ** 16
+
     def forward(self, states, next_states):
         vals = self.pt_critic(states)
         policy_scores = self.pt_actor(states, next_states)
@@ -39,12 +47,12 @@ class AttnNet(RLNet):
 
     # Numpy Calls
     def pt_actor(self, _, next_states):
-        bsz = len(next_states)
+        # Traceable batch size for export_model
+        bsz = next_states.shape[0]
         state_shape = next_states.shape[2:]
         next_states = next_states.view(-1, *state_shape)
 
-        x = self.main(next_states)
-        z = self.encoder(x)
+        z = self.encode(next_states)
         z = z.view(bsz, self.action_size, self.d_model)
         out = self.transformer(z.transpose(0, 1))
         policy_scores = self.act_head(out.transpose(0, 1))
@@ -52,31 +60,66 @@ class AttnNet(RLNet):
         return policy_scores
 
     def pt_critic(self, states):
-        x = self.main(states)
-        s = self.encoder(x)
+        s = self.encode(states)
         vals = self.crit_head(s)
         return vals
 
+    def encode(self, states):
+        """
+        Trunk and encoder of a flat batch of states. In eval mode, every distinct state in the batch is encoded once,
+        so the padded children of invalid moves cost a single pass. In inference, the encodings of earlier calls are
+        reused too. The children of a search node are encoded when it's expanded and then reused when they're
+        evaluated as leaves. In training, every state is encoded, since the batch norms compute their statistics over
+        the whole batch
+        """
+        if torch.jit.is_tracing() or self.training:
+            return self.encoder(self.main(states))
+
+        flat = states.reshape(len(states), -1)
+        if torch.is_grad_enabled():
+            uniques, inverse = torch.unique(flat, dim=0, return_inverse=True)
+            z = self.encoder(self.main(uniques.view(-1, *states.shape[1:])))
+            return z[inverse]
+
+        # Zobrist hashes of the states, without their symmetries
+        hashes = (flat.cpu().numpy() > 0).astype(np.uint64) @ data.position_keys(self.size)[:, 0]
+        keys, firsts, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+        keys = keys.tolist()
+        missing = [i for i, key in enumerate(keys) if key not in self.encodings]
+        if len(missing) > 0:
+            idcs = torch.tensor(firsts[missing], device=states.device)
+            z = self.encoder(self.main(states[idcs]))
+            # Copies, so that the cache doesn't keep the whole batch alive
+            for i, encoding in zip(missing, z):
+                self.encodings[keys[i]] = encoding.clone()
+        for key in keys:
+            self.encodings.move_to_end(key)
+        z = torch.stack([self.encodings[key] for key in keys])[torch.tensor(inverse, device=states.device)]
+
+        while len(self.encodings) > self.encodings_capacity:
+            self.encodings.popitem(last=False)
+        return z
+
+    def weights_changed(self):
+        super().weights_changed()
+        self.encodings.clear()
+
     def pt_actor_critic(self, states, next_states):
         return self.forward(states, next_states)
 
     # Optimization
-    def train_step(self, optimizer, states, actions, reward, children, terminal, wins, pi):
-        # Process next states
-        bsz = len(children)
-        next_states = children[np.arange(bsz), actions]
-        next_states = data.batch_random_symmetries(next_states)
-
+    def train_step(self, optimizer, states, actions, reward, next_states, terminal, wins, pi):
         optimizer.zero_grad()
 
         # Critic
         cl, ca = self.critic_step(next_states, -wins)
 
         # Actor
+        children = data.batch_padded_children(states.numpy())
         al, aa = self.reinforce_step(states, children, actions, wins)
 
         loss = cl + al
         loss.backward()
-        optimizer.step()
+        self.optimizer_step(optimizer)
 
         return cl.item(), ca, al.item(), aa
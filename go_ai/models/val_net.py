@@ -1,13 +1,12 @@
-import numpy as np
 import torch.nn as nn
 
-from go_ai import data
 from go_ai.models import RLNet
 
 
 class ValueNet(RLNet):
     def __init__(self, size):
         super().__init__()
+        self.size = size
 
         self.convs = nn.Sequential(
             nn.Conv2d(self.channels, 1, 1),
@@ -26,18 +25,13 @@ class ValueNet(RLNet):
     def pt_critic(self, states):
         return self.forward(states)
 
-    def train_step(self, optimizer, _, actions, rewards, children, terminal, wins, pi):
-        # Process next states
-        bsz = len(children)
-        next_states = children[np.arange(bsz), actions]
-        next_states = data.batch_random_symmetries(next_states)
-
+    def train_step(self, optimizer, _, actions, rewards, next_states, terminal, wins, pi):
         optimizer.zero_grad()
 
         # Critic
         cl, ca = self.critic_step(next_states, -wins)
 
         cl.backward()
-        optimizer.step()
+        self.optimizer_step(optimizer)
 
         return cl.item(), ca, None, None
@@ -1,3 +1,10 @@
+import time
+
+import numpy as np
+
+from go_ai.search import mct
+
+
 class Policy:
     """
     Interface for all types of policies
@@ -8,6 +15,17 @@ class Policy:
         self.temp = temp
         self.pt_model = None
 
+        # Search latency
+        self.search_time = 0
+        self.num_searches = 0
+
+        # Transposition table lookups
+        self.tt_hits = 0
+        self.tt_misses = 0
+
+        # Search trees kept between moves, keyed by environment
+        self.trees = {}
+
     def __call__(self, go_env, **kwargs):
         """
         :param go_env: Go environment
@@ -16,5 +34,90 @@ class Policy:
         """
         pass
 
+    def batch_call(self, go_envs, **kwargs):
+        """
+        :param go_envs: Go environments that are all waiting on this policy
+        :return: Action probabilities of every environment
+        """
+        return [self(go_env, **kwargs) for go_env in go_envs]
+
+    def search(self, go_envs, num_searches, **kwargs):
+        """
+        Searches every environment in lockstep, continuing from the trees kept for them and keeping the new trees
+        :param kwargs: Arguments for mct.batch_mct_search
+        :return: The root nodes
+        """
+        start = time.time()
+        searchtrees = [self.get_tree(go_env) for go_env in go_envs]
+        rootnodes = mct.batch_mct_search(go_envs, num_searches, searchtrees=searchtrees, **kwargs)
+        duration = (time.time() - start) / len(go_envs)
+        for go_env, rootnode in zip(go_envs, rootnodes):
+            self.keep_tree(go_env, rootnode.tree)
+            self.record_search(duration, rootnode.tree)
+
+        return rootnodes
+
+    def step(self, go_env, action):
+        """
+        Called after action was played in go_env. Promotes the subtree of the action to be the root of the next search
+        :param go_env:
+        :param action:
+        """
+        searchtree = self.trees.get(id(go_env))
+        if searchtree is not None and not searchtree.reroot(action):
+            del self.trees[id(go_env)]
+
+    def reset(self, go_env=None):
+        """
+        Frees the search tree kept for go_env, or all of them if go_env is None
+        """
+        if go_env is None:
+            self.trees.clear()
+        else:
+            self.trees.pop(id(go_env), None)
+
+    def get_tree(self, go_env):
+        """
+        :return: The tree kept for go_env if it's rooted at the current state, otherwise None
+        """
+        searchtree = self.trees.pop(id(go_env), None)
+        if searchtree is not None and not np.array_equal(searchtree.state(0), go_env.canonical_state()):
+            searchtree = None
+        return searchtree
+
+    def keep_tree(self, go_env, searchtree):
+        self.trees[id(go_env)] = searchtree
+
+    def record_search(self, duration, searchtree=None):
+        self.search_time += duration
+        self.num_searches += 1
+        if searchtree is not None:
+            hits, misses = searchtree.pop_tt_stats()
+            self.tt_hits += hits
+            self.tt_misses += misses
+
+    def avg_search_time(self):
+        """
+        :return: Average number of seconds spent searching per move since the last reset
+        """
+        if self.num_searches <= 0:
+            return 0
+        return self.search_time / self.num_searches
+
+    def tt_hit_rate(self):
+        """
+        :return: Fraction of the transposition table lookups since the last reset that found a position
+        """
+        lookups = self.tt_hits + self.tt_misses
+        if lookups <= 0:
+            return 0
+        return self.tt_hits / lookups
+
+    def reset_search_time(self):
+        self.search_time = 0
+        self.num_searches = 0
+        self.tt_hits = 0
+        self.tt_misses = 0
+
     def __str__(self):
         return "{} {}".format(self.__class__.__name__, self.name)
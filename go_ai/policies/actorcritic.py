@@ -2,7 +2,7 @@ import numpy as np
 
 from go_ai import search, data
 from go_ai.policies import Policy
-from go_ai.search import mct, tree
+from go_ai.search import tree
 
 
 class ActorCritic(Policy):
@@ -18,6 +18,8 @@ class ActorCritic(Policy):
         self.val_func = model.create_numpy('critic')
         self.pi_func = model.create_numpy('actor')
         self.mcts = args.mcts
+        self.mcts_batch = args.mcts_batch
+        self.transpositions = args.transpositions
 
     def __call__(self, go_env, **kwargs):
         """
@@ -25,48 +27,69 @@ class ActorCritic(Policy):
         :param step: Parameter used for getting the temperature
         :return:
         """
+        pis, all_qs, rootnodes = self.get_pis([go_env])
 
+        if 'debug' in kwargs:
+            debug = kwargs['debug']
+        else:
+            debug = False
+        if debug:
+            return pis[0], all_qs[0], rootnodes[0]
+
+        return pis[0]
+
+    def batch_call(self, go_envs, **kwargs):
+        pis, _, _ = self.get_pis(go_envs)
+        return pis
+
+    def get_pis(self, go_envs):
+        """
+        :return: Action probabilities, qs and root nodes of every environment
+        """
+        pis, all_qs = [], []
         if self.mcts > 0:
-            rootnode = mct.mct_search(go_env, self.mcts, actor_critic=self.ac_func)
-            qs = self.tree_to_qs(rootnode)
+            rootnodes = self.search(go_envs, self.mcts, actor_critic=self.ac_func, batchsize=self.mcts_batch,
+                                    transpositions=self.transpositions)
+            for go_env, rootnode in zip(go_envs, rootnodes):
+                qs = self.tree_to_qs(rootnode)
 
-            # Raise to temperature
-            pi = (qs[1] ** (1 / self.temp))
-            pi = pi / np.sum(pi)
+                # Raise to temperature
+                pi = (qs[1] ** (1 / self.temp))
+                pi = pi / np.sum(pi)
 
-            # Noise to guarantee all moves may be explored
-            valid_moves = go_env.valid_moves()
-            noise = valid_moves / valid_moves.sum()
-            pi = 0.98 * pi + 0.02 * noise
+                # Noise to guarantee all moves may be explored
+                valid_moves = go_env.valid_moves()
+                noise = valid_moves / valid_moves.sum()
+                pi = 0.98 * pi + 0.02 * noise
 
-            assert np.allclose(np.sum(pi), 1), np.sum(pi)
+                assert np.allclose(np.sum(pi), 1), np.sum(pi)
+                pis.append(pi)
+                all_qs.append(qs)
 
         elif self.mcts == 0:
             # Just use value function to get policy
-            rootnode = mct.mct_search(go_env, self.mcts, critic=self.val_func)
-            q_logits = rootnode.inverted_children_values()
-            pi = search.temp_norm(np.exp(q_logits), self.temp, rootnode.valid_moves())
-            qs = [q_logits]
+            rootnodes = self.search(go_envs, self.mcts, critic=self.val_func)
+            for rootnode in rootnodes:
+                q_logits = rootnode.inverted_children_values()
+                pi = search.temp_norm(np.exp(q_logits), self.temp, rootnode.valid_moves())
+                pis.append(pi)
+                all_qs.append([q_logits])
         else:
             # Just use policy function and don't search
             assert self.mcts < 0
-            # Get tree node for debugging purposes
-            rootnode = tree.Node(go_env.state, go_env.group_map)
-            state = go_env.canonical_state()
-            policy_scores = self.pi_func(state[np.newaxis])
-            policy_scores = policy_scores[0]
-            valid_moves = data.GoGame.valid_moves(state)
-            pi = search.temp_softmax(policy_scores, self.temp, valid_moves)
-            qs = [pi]
-
-        if 'debug' in kwargs:
-            debug = kwargs['debug']
-        else:
-            debug = False
-        if debug:
-            return pi, qs, rootnode
+            states = np.array([go_env.canonical_state() for go_env in go_envs])
+            # Get tree nodes for debugging purposes. The values come from the same network call
+            rootnodes = [tree.Tree(state).node() for state in states]
+            all_policy_scores, all_vals = self.ac_func(states)
+            for rootnode, val in zip(rootnodes, all_vals):
+                rootnode.tree.vals[rootnode.index] = val.item()
+            for state, policy_scores in zip(states, all_policy_scores):
+                valid_moves = data.GoGame.valid_moves(state)
+                pi = search.temp_softmax(policy_scores, self.temp, valid_moves)
+                pis.append(pi)
+                all_qs.append([pi])
 
-        return pi
+        return pis, all_qs, rootnodes
 
     def tree_to_qs(self, rootnode):
         qs = np.empty((2, rootnode.actionsize()))
@@ -3,7 +3,6 @@ import numpy as np
 
 from go_ai import search, models
 from go_ai.policies import Policy
-from go_ai.search import mct
 
 GoGame = gym.make('gym_go:go-v0', size=0).gogame
 
@@ -21,6 +20,7 @@ class Attn(Policy):
         self.val_func = model.create_numpy('critic')
         self.pi_func = model.create_numpy('actor')
         self.mcts = args.mcts
+        self.mcts_batch = args.mcts_batch
 
     def __call__(self, go_env, **kwargs):
         """
@@ -29,7 +29,7 @@ class Attn(Policy):
         :return:
         """
 
-        rootnode = mct.mct_search(go_env, self.mcts, critic=self.val_func)
+        rootnode = self.search([go_env], self.mcts, critic=self.val_func, batchsize=self.mcts_batch)[0]
         state = go_env.canonical_state()
         policy_scores = self.pi_func(state[np.newaxis])
         policy_scores = policy_scores[0]
@@ -1,7 +1,9 @@
+import os
+
 import numpy as np
 import torch
 
-from go_ai import data
+from go_ai import cache, data, models
 from go_ai.models import val_net, ac_net, attn_net
 from go_ai.policies import Policy
 from go_ai.policies.actorcritic import ActorCritic
@@ -11,47 +13,30 @@ from go_ai.policies.value import Value
 def greedy_val_func(states):
     if len(states) <= 0:
         return np.array([])
-    board_area = data.GoGame.action_size(states[0]) - 1
-
-    vals = []
-    for state in states:
-        black_area, white_area = data.GoGame.areas(state)
-        if data.GoGame.game_ended(state):
-            if black_area > white_area:
-                val = 100
-            elif black_area < white_area:
-                val = -100
-            else:
-                val = 0
-        else:
-            val = (black_area - white_area) / (board_area)
-        vals.append(val)
-    vals = np.array(vals, dtype=np.float)
+    states = np.asarray(states)
+    board_area = states.shape[-1] ** 2
+
+    black_area, white_area = data.batch_areas(states)
+    ended = data.batch_game_ended(states)
+    area_diff = black_area - white_area
+    vals = np.where(ended, 100 * np.sign(area_diff), area_diff / board_area)
+    vals = vals.astype(np.float)
     return vals[:, np.newaxis]
 
 
 def smart_greedy_val_func(states):
     if len(states) <= 0:
         return np.array([])
-    board_area = data.GoGame.action_size(states[0]) - 1
-
-    vals = []
-    for state in states:
-        black_area, white_area = data.GoGame.areas(state)
-        blacklibs, whitelibs = data.GoGame.get_num_liberties(state)
-        if data.GoGame.game_ended(state):
-            if black_area > white_area:
-                val = 1
-            elif black_area < white_area:
-                val = -1
-            else:
-                val = 0
-        else:
-            area_val = (black_area - white_area) / (board_area)
-            libs_val = (blacklibs - whitelibs) / (board_area)
-            val = (6 * area_val + libs_val) / 7
-        vals.append(val)
-    vals = np.array(vals, dtype=np.float)
+    states = np.asarray(states)
+    board_area = states.shape[-1] ** 2
+
+    black_area, white_area = data.batch_areas(states)
+    blacklibs, whitelibs = data.batch_liberties(states)
+    ended = data.batch_game_ended(states)
+    area_val = (black_area - white_area) / board_area
+    libs_val = (blacklibs - whitelibs) / board_area
+    vals = np.where(ended, np.sign(area_val), (6 * area_val + libs_val) / 7)
+    vals = vals.astype(np.float)
     return vals[:, np.newaxis]
 
 
@@ -126,7 +111,10 @@ SMART_GREEDY_PI = Value('Smart Greedy', smart_greedy_val_func)
 HUMAN_PI = Human('terminal')
 
 
-def create_policy(args, name=''):
+def create_policy(args, name='', client=None):
+    """
+    :param client: Inference client to evaluate the model with. The weights are then left to the server
+    """
     model = args.model
     size = args.size
     if model == 'val':
@@ -152,21 +140,47 @@ def create_policy(args, name=''):
     else:
         raise Exception("Unknown model argument", model)
 
-    load_weights(args, net)
+    if client is not None:
+        net.client = client
+    else:
+        if args.cache > 0:
+            net.cache = cache.OutputCache(args.cache)
+        path = load_weights(args, net)
+        if args.quantize:
+            net.scripted = load_exported(path, net)
 
     return pi, net
 
 
 def load_weights(args, net):
+    """
+    :return: Path of the weights that were loaded, if any
+    """
+    path = None
     if args.baseline:
         assert not args.latest_checkpoint
         assert args.customdir == ''
-        net.load_state_dict(torch.load(args.basepath, args.device))
+        path = args.basepath
     elif args.latest_checkpoint:
         assert not args.baseline
         assert args.customdir == ''
-        net.load_state_dict(torch.load(args.checkpath, args.device))
+        path = args.checkpath
     elif args.customdir != '':
         assert not args.latest_checkpoint
         assert not args.baseline
-        net.load_state_dict(torch.load(args.custompath, args.device))
+        path = args.custompath
+    if path is not None:
+        net.load_state_dict(torch.load(path, args.device))
+    return path
+
+
+def load_exported(path, net):
+    """
+    Loads the export of the weights at path that export.py saved next to them, unless it's older than the weights.
+    Otherwise it exports the model in memory
+    """
+    if path is not None:
+        exported_path = path[:-len('.pt')] + '.script.pt'
+        if os.path.exists(exported_path) and os.path.getmtime(exported_path) >= os.path.getmtime(path):
+            return torch.jit.load(exported_path, 'cpu')
+    return models.export_model(net)
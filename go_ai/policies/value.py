@@ -3,7 +3,6 @@ import numpy as np
 from go_ai import models
 from go_ai import search
 from go_ai.policies import Policy
-from go_ai.search import mct
 
 
 class Value(Policy):
@@ -15,6 +14,8 @@ class Value(Policy):
         else:
             self.val_func = engine
         self.mcts = args.mcts if args is not None else 0
+        self.mcts_batch = args.mcts_batch if args is not None else 1
+        self.transpositions = args.transpositions if args is not None else False
 
     def __call__(self, go_env, **kwargs):
         """
@@ -27,22 +28,37 @@ class Value(Policy):
         else:
             debug = False
 
-        rootnode = mct.mct_search(go_env, self.mcts, critic=self.val_func)
-        if self.mcts > 0:
-            qs = rootnode.get_visit_counts()
-            assert np.sum(qs) > 0, rootnode
-        else:
-            q_logits = rootnode.inverted_children_values()
-            qs = np.exp(q_logits)
-        pi = search.temp_norm(qs, self.temp, rootnode.valid_moves())
+        pis, rootnodes = self.get_pis([go_env])
+        pi, rootnode = pis[0], rootnodes[0]
 
         if debug:
             qs = rootnode.inverted_children_values()
             return pi, [qs, qs], rootnode
         else:
-            rootnode.destroy()
-            del rootnode
             return pi
 
+    def batch_call(self, go_envs, **kwargs):
+        pis, _ = self.get_pis(go_envs)
+        return pis
+
+    def get_pis(self, go_envs):
+        """
+        :return: Action probabilities and root nodes of every environment
+        """
+        rootnodes = self.search(go_envs, self.mcts, critic=self.val_func, batchsize=self.mcts_batch,
+                                transpositions=self.transpositions)
+        pis = []
+        for rootnode in rootnodes:
+            if self.mcts > 0:
+                qs = rootnode.get_visit_counts()
+                assert np.sum(qs) > 0, rootnode
+            else:
+                q_logits = rootnode.inverted_children_values()
+                qs = np.exp(q_logits)
+            pi = search.temp_norm(qs, self.temp, rootnode.valid_moves())
+            pis.append(pi)
+
+        return pis, rootnodes
+
     def __str__(self):
         return f"{self.__class__.__name__}[{self.mcts}S {self.temp:.2f}T]-{self.name}"
@@ -1,5 +1,4 @@
 import gym
-import numpy as np
 from scipy import special
 
 from go_ai.search import tree
@@ -7,56 +6,143 @@ from go_ai.search import tree
 GoGame = gym.make('gym_go:go-v0', size=0).gogame
 
 
-def find_next_node(node):
+def find_next_node(searchtree, node=0):
+    """
+    :return: The leaf to expand and the path of (node, action) pairs that leads to it
+    """
+    path = []
     curr = node
-    while curr.visits > 0 and not curr.terminal():
-        ucbs = curr.get_ucbs()
-        move = np.nanargmax(ucbs)
-        curr = curr.step(move)
-
-    return curr
-
-
-def mct_step(rootnode, actor_critic, critic):
-    # Next node to expand
-    node = find_next_node(rootnode)
+    seen = {node}
+    while searchtree.visits[curr] > 0 and not searchtree.terminals[curr]:
+        move = searchtree.select(curr)
+        path.append((curr, move))
+        curr = searchtree.step(curr, move)
+        if curr in seen:
+            # Transpositions led back into the path. Treat the repeated position as a leaf
+            break
+        seen.add(curr)
+
+    return curr, path
+
+
+def find_next_nodes(searchtree, batchsize):
+    """
+    Selects up to batchsize distinct leaves to evaluate together.
+    Virtual losses are placed on each selected path so the following selections explore other paths
+    :param searchtree:
+    :param batchsize:
+    :return: List of (leaf, path) pairs
+    """
+    selections = []
+    for _ in range(batchsize):
+        node, path = find_next_node(searchtree)
+        if any(node == other for other, _ in selections):
+            # The search keeps collapsing onto a pending leaf. Evaluate what we have
+            break
+        searchtree.add_virtual_loss(path)
+        selections.append((node, path))
+
+    for _, path in selections:
+        searchtree.remove_virtual_loss(path)
+
+    return selections
+
+
+def mct_step(searchtree, actor_critic, critic, batchsize=1):
+    """
+    Expands and backprops a batch of leaves with a single network call
+    :return: Number of leaves that were evaluated
+    """
+    return batch_mct_step([searchtree], actor_critic, critic, [batchsize])[0]
+
+
+def batch_mct_step(searchtrees, actor_critic, critic, batchsizes):
+    """
+    Expands and backprops a batch of leaves from each tree. The leaves of all trees share a single network call
+    :return: Number of leaves that were evaluated in each tree
+    """
+    # Next nodes to expand
+    selections = []
+    for searchtree, batchsize in zip(searchtrees, batchsizes):
+        for node, path in find_next_nodes(searchtree, batchsize):
+            selections.append((searchtree, node, path))
+    leaves = [(searchtree, node) for searchtree, node, _ in selections]
+
+    # Don't need to calculate pi for terminal nodes
+    internal = [i for i, (searchtree, node) in enumerate(leaves) if not searchtree.terminals[node]]
 
     # Compute values on internal nodes
     if actor_critic is not None:
-        pi_logits, val_logits = actor_critic(node.state[np.newaxis])
+        pi_logits, val_logits = actor_critic(tree.get_states(leaves))
     else:
         assert critic is not None
         pi_logits = None
-        val_logits = critic(node.state[np.newaxis])
+        # The children of the internal leaves that have no value yet are evaluated in the same network call as the
+        # leaves. Leaves of the same tree can share children through transpositions
+        next_nodes = []
+        pending = {(id(searchtree), node) for searchtree, node in leaves}
+        for i in internal:
+            searchtree, node = leaves[i]
+            for child in searchtree.make_children(node):
+                if (id(searchtree), child) not in pending:
+                    pending.add((id(searchtree), child))
+                    next_nodes.append((searchtree, child))
+        all_vals = tree.set_state_vals(critic, leaves + next_nodes)
+        val_logits = all_vals[:len(leaves)]
 
     # Backprop value
-    node.backprop(val_logits.item())
-
-    # Don't need to calculate pi
-    if node.terminal():
-        return
+    for (searchtree, node, path), val in zip(selections, val_logits):
+        searchtree.vals[node] = val.item()
+        searchtree.backprop(node, path, val.item())
 
     # Prior Pi
-    if pi_logits is not None:
-        pi = special.softmax(pi_logits.flatten())
-        node.set_prior_pi(pi)
-    else:
-        node.make_children()
-        next_nodes = node.get_child_nodes()
-        tree.set_state_vals(critic, next_nodes)
-        node.set_prior_pi(None)
-
-
-def mct_search(go_env, num_searches, actor_critic=None, critic=None):
-    # Setup the root
-    rootstate = go_env.canonical_state()
-    rootnode = tree.Node(rootstate)
-
-    # The first iteration doesn't count towards the number of searches
-    mct_step(rootnode, actor_critic, critic)
-
-    # MCT Search
-    for i in range(0, num_searches):
-        mct_step(rootnode, actor_critic, critic)
-
-    return rootnode
+    for i in internal:
+        searchtree, node = leaves[i]
+        if pi_logits is not None:
+            searchtree.set_prior_pi(node, special.softmax(pi_logits[i].flatten()))
+        else:
+            searchtree.set_prior_pi(node, None)
+
+    return [sum(1 for searchtree, _, _ in selections if searchtree is t) for t in searchtrees]
+
+
+def mct_search(go_env, num_searches, actor_critic=None, critic=None, batchsize=1, searchtree=None,
+               transpositions=False):
+    """
+    :param batchsize: Number of leaves evaluated per network call. Leaves in the same batch are selected with virtual
+    loss, so a batchsize of 1 is the classic sequential search
+    :param searchtree: Tree rooted at the current state that was kept from the previous move. Its visits count
+    towards the number of searches
+    :param transpositions: Whether a new tree shares nodes between transposed positions
+    :return: The root node
+    """
+    return batch_mct_search([go_env], num_searches, actor_critic, critic, batchsize, [searchtree], transpositions)[0]
+
+
+def batch_mct_search(go_envs, num_searches, actor_critic=None, critic=None, batchsize=1, searchtrees=None,
+                     transpositions=False):
+    """
+    Searches every environment in lockstep. Each round selects up to batchsize leaves per tree and evaluates the
+    leaves of all trees together
+    :return: The root nodes
+    """
+    if searchtrees is None:
+        searchtrees = [None for _ in go_envs]
+
+    # Setup the roots
+    searchtrees = list(searchtrees)
+    for i, (go_env, searchtree) in enumerate(zip(go_envs, searchtrees)):
+        if searchtree is None:
+            rootstate = go_env.canonical_state()
+            searchtrees[i] = tree.Tree(rootstate, transpositions=transpositions)
+
+    # MCT Search. The first visit of the root doesn't count towards the number of searches
+    while True:
+        remaining = [num_searches + 1 - searchtree.visits[0] for searchtree in searchtrees]
+        searching = [i for i, r in enumerate(remaining) if r > 0]
+        if len(searching) <= 0:
+            break
+        batch_mct_step([searchtrees[i] for i in searching], actor_critic, critic,
+                       [min(batchsize, remaining[i]) for i in searching])
+
+    return [searchtree.node() for searchtree in searchtrees]
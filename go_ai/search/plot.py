@@ -41,10 +41,10 @@ def register_nodes(treenode, graph, imgdir):
     plt.axis('off')
     plt.title(str(treenode))
     plt.imshow(state_matplot_format(treenode.state))
-    imgpath = os.path.join(imgdir, f'{str(id(treenode))}.jpg')
+    imgpath = os.path.join(imgdir, f'{treenode.index}.jpg')
     plt.savefig(imgpath, bbox_inches='tight')
     plt.close()
-    graph.node(str(id(treenode)), image=imgpath, label='')
+    graph.node(str(treenode.index), image=imgpath, label='')
     for child in treenode.child_nodes:
         if child is not None:
             register_nodes(child, graph, imgdir)
@@ -57,5 +57,5 @@ def register_edges(treenode, graph):
             label = ''
             if treenode.prior_pi is not None:
                 label = f'{treenode.prior_pi[a]:.2f}'
-            graph.edge(str(id(treenode)), str(id(child)), label=label)
+            graph.edge(str(treenode.index), str(child.index), label=label)
             register_edges(child, graph)
\ No newline at end of file
@@ -1,194 +1,488 @@
 import numpy as np
 from scipy import special
 
-from go_ai import search
-from go_ai.data import GoGame
+from go_ai import search, data, engine
+from go_ai.search import zobrist
 
 
-def get_state_vals(val_func, nodes):
-    states = list(map(lambda node: node.state, nodes))
-    vals = val_func(np.array(states))
+def get_states(tree_nodes):
+    """
+    :param tree_nodes: List of (tree, node) pairs from trees of the same board size
+    :return: The unpacked states of the nodes
+    """
+    packed = np.array([tree.states[node] for tree, node in tree_nodes])
+    return data.unpack_states(packed, tree_nodes[0][0].size)
+
+
+def get_state_vals(val_func, tree_nodes):
+    """
+    :param tree_nodes: List of (tree, node) pairs
+    """
+    vals = val_func(get_states(tree_nodes))
     return vals
 
 
-def set_state_vals(val_func, nodes):
-    vals = get_state_vals(val_func, nodes)
-    for val, node in zip(vals, nodes):
-        node.set_value(val.item())
+def set_state_vals(val_func, tree_nodes):
+    vals = get_state_vals(val_func, tree_nodes)
+    for val, (tree, node) in zip(vals, tree_nodes):
+        tree.vals[node] = val.item()
 
     return vals
 
 
-class Node:
-    def __init__(self, state, parent=None):
-        '''
-        Args:
-            parent (?Node): parent Node
-            prior_value (?float): the state value of this node
-            state: state of the game as a numpy array
-        '''
-
-        # Go
-        self.state = state
-        self.child_states = None
-
-        # Links
-        self.parent = parent
-        self.child_nodes = np.empty(self.actionsize(), dtype=object)
-
-        # Level
-        if parent is None:
-            self.level = 0
+class Tree:
+    """
+    Search tree backed by contiguous arrays.
+
+    Nodes are integer ids with the root always at id 0. Per-node scalars are indexed by node id. Statistics of the
+    edges leaving a node are stored in a row of the edge arrays, which is only allocated once the node is expanded.
+
+    With transpositions enabled, nodes are keyed by the Zobrist hash of their state so that positions reached by
+    different move orders share one node, along with its statistics and network outputs. The native engine's boards
+    keep that hash up to date themselves, so the tree only hashes the states itself with gym_go.
+
+    With the native engine, the nodes that aren't expanded yet keep the engine.Board of their state, and their children
+    play their moves on copies of it
+    """
+
+    # Arrays that are resized together and the value new entries start with
+    NODE_ARRAYS = {'states': 0, 'parents': -1, 'levels': 0, 'terminals': False, 'vals': np.nan, 'visits': 0,
+                   'virtual_losses': 0, 'val_sums': 0, 'expanded': False, 'edge_rows': -1, 'hashes': 0,
+                   'stone_hashes': 0}
+    EDGE_ARRAYS = {'valid': False, 'priors': 0, 'edge_visits': 0, 'edge_vlosses': 0, 'edge_qsums': 0,
+                   'children': -1}
+
+    def __init__(self, rootstate, capacity=64, transpositions=False):
+        self.actionsize = data.GoGame.action_size(rootstate)
+        self.size = rootstate.shape[-1]
+        self.num_nodes = 0
+        self.num_edge_rows = 0
+
+        # Transposition table
+        self.transpositions = transpositions
+        self.table = {}
+        self.tt_hits = 0
+        self.tt_misses = 0
+
+        # Boards of the native engine by node
+        self.boards = {}
+
+        # Nodes. States are bit-packed
+        self.states = np.zeros((capacity, data.packed_size(self.size)), dtype=np.uint8)
+        self.parents = np.full(capacity, -1, dtype=np.int64)
+        self.levels = np.zeros(capacity, dtype=np.int64)
+        self.terminals = np.zeros(capacity, dtype=bool)
+        self.vals = np.full(capacity, np.nan)
+        self.visits = np.zeros(capacity, dtype=np.int64)
+        self.virtual_losses = np.zeros(capacity, dtype=np.int64)
+        self.val_sums = np.zeros(capacity)
+        self.expanded = np.zeros(capacity, dtype=bool)
+        self.edge_rows = np.full(capacity, -1, dtype=np.int64)
+        self.hashes = np.zeros(capacity, dtype=np.uint64)
+        self.stone_hashes = np.zeros((capacity, 2), dtype=np.uint64)
+
+        # Edges
+        edge_shape = (capacity, self.actionsize)
+        self.valid = np.zeros(edge_shape, dtype=bool)
+        self.priors = np.zeros(edge_shape)
+        self.edge_visits = np.zeros(edge_shape, dtype=np.int64)
+        self.edge_vlosses = np.zeros(edge_shape, dtype=np.int64)
+        self.edge_qsums = np.zeros(edge_shape)
+        self.children = np.full(edge_shape, -1, dtype=np.int64)
+
+        root = self.add_node(rootstate)
+        if self.transpositions:
+            if data.GoGame is engine:
+                self.hashes[root] = self.board(root).position_hash()
+            else:
+                self.stone_hashes[root] = zobrist.stone_hashes(rootstate)
+                self.hashes[root] = self.stone_hashes[root, 0] ^ zobrist.flag_hash(rootstate)
+            self.table[self.hashes[root]] = root
+
+    # =================
+    # Storage
+    # =================
+    def _grow(self, arrays):
+        for name, fill in arrays.items():
+            array = getattr(self, name)
+            extension = np.full((max(len(array), 1), *array.shape[1:]), fill, dtype=array.dtype)
+            setattr(self, name, np.concatenate([array, extension]))
+
+    def add_node(self, state, parent=-1):
+        if self.num_nodes >= len(self.visits):
+            self._grow(Tree.NODE_ARRAYS)
+
+        node = self.num_nodes
+        self.num_nodes += 1
+
+        self.states[node] = data.pack_states(state)
+        self.parents[node] = parent
+        self.levels[node] = 0 if parent < 0 else self.levels[parent] + 1
+        self.terminals[node] = data.GoGame.game_ended(state)
+
+        return node
+
+    def add_child(self, node, action, state, board=None):
+        """
+        Links the state reached by action to the node. Reuses a transposition of the state if there is one
+        :param board: engine.Board of the state, whose hash is used instead of hashing the state
+        :return: The child node
+        """
+        row = self.edge_row(node)
+        if self.transpositions:
+            if board is not None:
+                stone_hashes = 0
+                state_hash = board.position_hash()
+            else:
+                parent_hashes = tuple(self.stone_hashes[node])
+                stone_hashes = zobrist.child_stone_hashes(parent_hashes, self.state(node), state, action)
+                state_hash = stone_hashes[0] ^ zobrist.flag_hash(state)
+            child = self.table.get(state_hash, -1)
+            if child >= 0:
+                self.tt_hits += 1
+            else:
+                self.tt_misses += 1
+                child = self.add_node(state, node)
+                self.stone_hashes[child] = stone_hashes
+                self.hashes[child] = state_hash
+                self.table[state_hash] = child
         else:
-            self.level = self.parent.level + 1
+            child = self.add_node(state, node)
 
-        # Value
-        self.val = None
-        self.first_action = None
+        self.children[row, action] = child
+        return child
 
-        # MCT
-        self.visits = 0
-        self.prior_pi = None
-        self.post_vals = []
+    def edge_row(self, node):
+        """
+        :return: Row of the edge arrays that belongs to the node. Allocates it if needed
+        """
+        row = self.edge_rows[node]
+        if row >= 0:
+            return row
 
-    def destroy(self):
-        for child in self.child_nodes:
-            if child is not None:
-                child.destroy()
-        del self.state
-        del self.parent
-        del self.child_nodes
+        if self.num_edge_rows >= len(self.valid):
+            self._grow(Tree.EDGE_ARRAYS)
+
+        row = self.num_edge_rows
+        self.num_edge_rows += 1
+
+        self.edge_rows[node] = row
+        self.valid[row] = data.GoGame.valid_moves(self.state(node)) > 0
+
+        return row
+
+    def reroot(self, action):
+        """
+        Promotes the root's child under action to be the new root and frees all other nodes
+        :return: False if the root has no such child, in which case the tree is left untouched
+        """
+        root_row = self.edge_rows[0]
+        newroot = -1 if root_row < 0 else self.children[root_row, action]
+        if newroot < 0:
+            return False
+
+        # Nodes reachable from the new root in breadth first order, so that the new root becomes node 0
+        reachable = np.zeros(self.num_nodes, dtype=bool)
+        reachable[newroot] = True
+        frontier = np.array([newroot])
+        keep = [frontier]
+        while len(frontier) > 0:
+            rows = self.edge_rows[frontier]
+            children = self.children[rows[rows >= 0]].flatten()
+            children = np.unique(children[children >= 0])
+            frontier = children[~reachable[children]]
+            reachable[frontier] = True
+            keep.append(frontier)
+        # Depths from the new root. With transpositions, a node can be shallower through the new root than through
+        # the path that created it
+        levels = np.concatenate([np.full(len(nodes), depth, dtype=np.int64) for depth, nodes in enumerate(keep)])
+        keep = np.concatenate(keep)
+
+        remap = np.full(self.num_nodes, -1, dtype=np.int64)
+        remap[keep] = np.arange(len(keep))
+
+        # Compact the node arrays
+        parents = self.parents[keep]
+        rows = self.edge_rows[keep]
+        for name in Tree.NODE_ARRAYS:
+            setattr(self, name, getattr(self, name)[keep])
+        self.parents = np.where(parents >= 0, remap[parents], -1)
+        self.parents[0] = -1
+        self.levels = levels
+        self.num_nodes = len(keep)
+
+        # Compact the edge arrays
+        expanded = rows >= 0
+        for name in Tree.EDGE_ARRAYS:
+            setattr(self, name, getattr(self, name)[rows[expanded]])
+        self.children = np.where(self.children >= 0, remap[self.children], -1)
+        self.boards = {remap[node]: board for node, board in self.boards.items() if remap[node] >= 0}
+        self.edge_rows[expanded] = np.arange(np.sum(expanded))
+        self.num_edge_rows = int(np.sum(expanded))
+
+        if self.transpositions:
+            self.table = dict(zip(self.hashes[:self.num_nodes], range(self.num_nodes)))
+
+        return True
 
     # =================
     # Basic Tree API
     # =================
-    def terminal(self):
-        return GoGame.game_ended(self.state)
+    def state(self, node):
+        return data.unpack_states(self.states[node], self.size)
 
-    def winning(self):
-        return GoGame.winning(self.state)
+    def valid_moves(self, node):
+        return self.valid[self.edge_row(node)].astype(int)
 
-    def isleaf(self):
-        # Not the same as whether the state is terminal or not
-        return (self.child_nodes == None).all()
+    def child_indices(self, node):
+        row = self.edge_rows[node]
+        if row < 0:
+            return np.array([], dtype=np.int64)
+        children = self.children[row]
+        return children[children >= 0]
 
-    def isroot(self):
-        return self.parent is None
+    def board(self, node):
+        """
+        :return: The engine.Board of the node. Only the root's is built from its state
+        """
+        board = self.boards.get(node)
+        if board is None:
+            board = self.boards[node] = engine.Board.from_state(self.state(node))
+        return board
+
+    def step(self, node, move):
+        row = self.edge_row(node)
+        child = self.children[row, move]
+        if child < 0:
+            if data.GoGame is engine:
+                board = self.board(node).copy()
+                board.play(int(move))
+                child = self.add_child(node, move, board.state(canonical=True), board)
+                self.boards.setdefault(child, board)
+            else:
+                next_state = data.GoGame.next_state(self.state(node), move, canonical=True)
+                child = self.add_child(node, move, next_state)
+        return child
 
-    def make_childnode(self, action, state):
-        child_node = Node(state, self)
-        self.child_nodes[action] = child_node
-        if child_node.level == 1:
-            child_node.first_action = action
+    def make_children(self, node):
+        """
+        Adds every valid child of the node that isn't in the tree yet
+        :return: Indices of the children nodes that have no value yet. Transpositions that were already evaluated
+        through another parent are left out
+        """
+        row = self.edge_row(node)
+        missing = [action for action in np.flatnonzero(self.valid[row]) if self.children[row, action] < 0]
+        if data.GoGame is engine:
+            # Every child of the node exists from now on, so its board isn't needed anymore
+            board = self.board(node)
+            del self.boards[node]
+            for action in missing:
+                child_board = board.copy()
+                child_board.play(int(action))
+                child = self.add_child(node, action, child_board.state(canonical=True), child_board)
+                self.boards.setdefault(child, child_board)
+        elif len(missing) > 0:
+            child_states = data.GoGame.children(self.state(node), canonical=True, padded=True)
+            for action in missing:
+                self.add_child(node, action, child_states[action])
+
+        children = np.unique(self.child_indices(node))
+        return children[np.isnan(self.vals[children])]
+
+    # =====================
+    # Value
+    # =====================
+    def inverted_children_values(self, node):
+        row = self.edge_row(node)
+        children = self.children[row]
+        where_children = children >= 0
+        inverted_vals = np.zeros(self.actionsize)
+        inverted_vals[where_children] = search.invert_vals(self.vals[children[where_children]])
+        return inverted_vals
+
+    # =====================
+    # MCT API
+    # =====================
+    def set_prior_pi(self, node, prior_pi):
+        row = self.edge_row(node)
+        if prior_pi is not None:
+            self.priors[row] = prior_pi
         else:
-            assert self.first_action is not None
-            child_node.first_action = self.first_action
-        return child_node
+            # Uses children state values to make prior pi
+            self.priors[row] = 0
+            where_valid = np.argwhere(self.valid[row]).flatten()
+            q_logits = self.inverted_children_values(node)
+            self.priors[row, where_valid] = special.softmax(q_logits[where_valid])
+
+            assert not np.isnan(self.priors[row]).any()
+        self.expanded[node] = True
 
-    def make_children(self):
+    def get_ucbs(self, node):
+        """
+        PUCT scores of every action of an expanded node. Pending virtual losses count as visits that we lost.
+        Invalid moves are nan
+        """
+        row = self.edge_rows[node]
+        n = self.edge_visits[row] + self.edge_vlosses[row]
+        qsums = self.edge_qsums[row] - self.edge_vlosses[row]
+        avg_q = np.divide(qsums, n, out=np.zeros(self.actionsize), where=n > 0)
+        u = 1.5 * self.priors[row] * np.sqrt(self.visits[node] + self.virtual_losses[node]) / (1 + n)
+        return np.where(self.valid[row], avg_q + u, np.nan)
+
+    def select(self, node):
+        return np.nanargmax(self.get_ucbs(node))
+
+    def get_visit_counts(self, node):
+        row = self.edge_rows[node]
+        if row < 0:
+            return np.zeros(self.actionsize, dtype=np.int64)
+        return self.edge_visits[row].copy()
+
+    def add_virtual_loss(self, path):
+        """
+        Marks a path as pending evaluation so that other searches in the same batch are steered away from it
+        :param path: List of (node, action) pairs from the root
         """
-        :return: Padded children numpy states
+        if len(path) <= 0:
+            return
+        nodes, actions = map(np.array, zip(*path))
+        self.edge_vlosses[self.edge_rows[nodes], actions] += 1
+        self.virtual_losses[nodes] += 1
+
+    def remove_virtual_loss(self, path):
+        if len(path) <= 0:
+            return
+        nodes, actions = map(np.array, zip(*path))
+        self.edge_vlosses[self.edge_rows[nodes], actions] -= 1
+        self.virtual_losses[nodes] -= 1
+
+    def backprop(self, leaf, path, val):
         """
-        child_states = GoGame.children(self.state, canonical=True, padded=True)
-        actions = np.argwhere(self.valid_moves()).flatten()
-        for action in actions:
-            self.make_childnode(action, child_states[action])
-        self.child_states = child_states
+        :param leaf: Node that was evaluated
+        :param path: List of (node, action) pairs from the root to the leaf
+        :param val: Value logit of the leaf from the leaf's perspective
+        """
+        self.visits[leaf] += 1
+        self.val_sums[leaf] += val
+        if len(path) <= 0:
+            return
+
+        nodes, actions = map(np.array, zip(*path))
+        # Values flip sign at every level going up
+        signs = (-1.0) ** (len(path) - np.arange(len(path)))
+        self.edge_visits[self.edge_rows[nodes], actions] += 1
+        self.edge_qsums[self.edge_rows[nodes], actions] += signs * np.tanh(val)
+        self.visits[nodes] += 1
+        self.val_sums[nodes] += signs * val
+
+    def pop_tt_stats(self):
+        """
+        :return: Transposition table hits and misses since the last call
+        """
+        stats = self.tt_hits, self.tt_misses
+        self.tt_hits, self.tt_misses = 0, 0
+        return stats
+
+    def node(self, index=0):
+        return Node(self, index)
+
 
-        return child_states
+class Node:
+    """
+    View of a single node of a Tree
+    """
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    @property
+    def state(self):
+        return self.tree.state(self.index)
+
+    @property
+    def parent(self):
+        parent = self.tree.parents[self.index]
+        return None if parent < 0 else Node(self.tree, parent)
+
+    @property
+    def child_nodes(self):
+        child_nodes = np.empty(self.actionsize(), dtype=object)
+        row = self.tree.edge_rows[self.index]
+        if row >= 0:
+            for action, child in enumerate(self.tree.children[row]):
+                if child >= 0:
+                    child_nodes[action] = Node(self.tree, child)
+        return child_nodes
+
+    @property
+    def level(self):
+        return self.tree.levels[self.index]
+
+    @property
+    def visits(self):
+        return self.tree.visits[self.index]
+
+    @property
+    def val(self):
+        val = self.tree.vals[self.index]
+        return None if np.isnan(val) else val
+
+    @property
+    def prior_pi(self):
+        if not self.tree.expanded[self.index]:
+            return None
+        return self.tree.priors[self.tree.edge_rows[self.index]]
+
+    def destroy(self):
+        del self.tree
+
+    # =================
+    # Basic Tree API
+    # =================
+    def terminal(self):
+        return self.tree.terminals[self.index]
+
+    def winning(self):
+        return data.GoGame.winning(self.state)
+
+    def isleaf(self):
+        # Not the same as whether the state is terminal or not
+        return len(self.tree.child_indices(self.index)) <= 0
+
+    def isroot(self):
+        return self.tree.parents[self.index] < 0
 
     def get_child_nodes(self):
-        real_nodes = list(filter(lambda node: node is not None, self.child_nodes))
-        return real_nodes
+        return [Node(self.tree, child) for child in self.tree.child_indices(self.index)]
 
     def actionsize(self):
-        return GoGame.action_size(self.state)
+        return self.tree.actionsize
 
     def valid_moves(self):
-        return GoGame.valid_moves(self.state)
+        return self.tree.valid_moves(self.index)
 
     def step(self, move):
-        child = self.child_nodes[move]
-        if child is not None:
-            return child
-        else:
-            next_state = GoGame.next_state(self.state, move, canonical=True)
-            child = self.make_childnode(move, next_state)
-            return child
-
-    # =====================
-    # Value
-    # =====================
-    def set_value(self, val):
-        self.val = val
+        return Node(self.tree, self.tree.step(self.index, move))
 
     def get_value(self):
         return self.val
 
     def inverted_children_values(self):
-        inverted_vals = []
-        for child in self.child_nodes:
-            if child is not None:
-                inverted_vals.append(search.invert_vals(child.val))
-            else:
-                inverted_vals.append(0)
-        return np.array(inverted_vals)
-
-    # =====================
-    # MCT API
-    # =====================
-
-    def backprop(self, val):
-        self.post_vals.append(val)
-        self.visits += 1
-        if self.parent is not None:
-            inverted_val = search.invert_vals(val)
-            self.parent.backprop(inverted_val)
-
-    def set_prior_pi(self, prior_pi):
-        if prior_pi is not None:
-            self.prior_pi = prior_pi
-        else:
-            # Uses children state values to make prior pi
-            self.prior_pi = np.zeros(self.actionsize())
-            valid_moves = self.valid_moves()
-            where_valid = np.argwhere(valid_moves).flatten()
-            q_logits = self.inverted_children_values()
-            self.prior_pi[where_valid] = special.softmax(q_logits[where_valid])
-
-            assert not np.isnan(self.prior_pi).any()
+        return self.tree.inverted_children_values(self.index)
 
     def get_visit_counts(self):
-        move_visits = []
-        for child in self.child_nodes:
-            if child is None:
-                move_visits.append(0)
-            else:
-                move_visits.append(child.visits)
-        return np.array(move_visits)
+        return self.tree.get_visit_counts(self.index)
 
     def get_ucbs(self):
-        ucbs = np.full(self.actionsize(), np.nan, dtype=np.float)
-        valid_moves = np.argwhere(self.valid_moves()).flatten()
-        for a in valid_moves:
-            avg_q, n = 0, 0
-            prior_q = self.prior_pi[a]
-            child = self.child_nodes[a]
-            if child is not None and child.visits > 0:
-                n = child.visits
-                assert len(child.post_vals) > 0, (child.post_vals, n)
-                avg_q = search.invert_vals(np.mean(np.tanh(child.post_vals)))
-
-            u = 1.5 * prior_q * np.sqrt(self.visits) / (1 + n)
-            ucbs[a] = avg_q + u
-        return np.array(ucbs)
+        return self.tree.get_ucbs(self.index)
 
     def __str__(self):
         result = ''
         if self.val is not None:
             result += f'{self.val:.2f}V'
-        if len(self.post_vals) > 0:
-            result += f' {np.mean(self.post_vals):.2f}AV'
+        if self.visits > 0:
+            result += f' {self.tree.val_sums[self.index] / self.visits:.2f}AV'
 
         result += f' {self.level}L {self.visits}N'
 
@@ -0,0 +1,74 @@
+import functools
+
+import numpy as np
+
+from go_ai.data import GoVars
+
+
+@functools.lru_cache(maxsize=None)
+def zobrist_keys(size):
+    """
+    Random keys for every feature of a canonical state
+    :param size: Board size
+    :return: Keys for the stones of the player to move and of the opponent (2 x size^2), keys for the invalid empty
+    points (size^2,), a key for the pass flag and a key for the game over flag
+    """
+    rng = np.random.RandomState(size)
+    high = np.iinfo(np.uint64).max
+    stones = rng.randint(0, high, size=(2, size ** 2), dtype=np.uint64)
+    invalids = rng.randint(0, high, size=size ** 2, dtype=np.uint64)
+    flags = rng.randint(0, high, size=2, dtype=np.uint64)
+    return stones, invalids, flags[0], flags[1]
+
+
+def xor_keys(keys, where):
+    return np.bitwise_xor.reduce(keys[where.flatten() > 0])
+
+
+def stone_hashes(state):
+    """
+    Hashes the stones of a canonical state from scratch
+    :return: The hash of the stones and the hash of the stones with the roles of the players swapped
+    """
+    stones, _, _, _ = zobrist_keys(state.shape[-1])
+    ours, theirs = state[GoVars.BLACK], state[GoVars.WHITE]
+    stone_hash = xor_keys(stones[0], ours) ^ xor_keys(stones[1], theirs)
+    swapped_hash = xor_keys(stones[1], ours) ^ xor_keys(stones[0], theirs)
+    return stone_hash, swapped_hash
+
+
+def child_stone_hashes(parent_hashes, parent_state, child_state, action):
+    """
+    Incrementally updates the stone hashes from a canonical state to its canonical child.
+    The child swaps the roles of the players, so only the placed stone and the captured stones change the hashes
+    """
+    stones, _, _, _ = zobrist_keys(parent_state.shape[-1])
+    stone_hash, swapped_hash = parent_hashes
+    stone_hash, swapped_hash = swapped_hash, stone_hash
+
+    size = parent_state.shape[-1]
+    if action < size ** 2:
+        # Placed stone now belongs to the opponent of the player to move
+        stone_hash ^= stones[1, action]
+        swapped_hash ^= stones[0, action]
+
+        # Captured stones belonged to the player who moves next
+        captured = parent_state[GoVars.WHITE] * (1 - child_state[GoVars.BLACK])
+        stone_hash ^= xor_keys(stones[0], captured)
+        swapped_hash ^= xor_keys(stones[1], captured)
+
+    return stone_hash, swapped_hash
+
+
+def flag_hash(state):
+    """
+    Hashes the parts of the state that aren't stones. Empty points that are invalid capture ko
+    """
+    _, invalids, pass_key, done_key = zobrist_keys(state.shape[-1])
+    empties = 1 - state[GoVars.BLACK] - state[GoVars.WHITE]
+    flags = xor_keys(invalids, state[GoVars.INVD_CHNL] * empties)
+    if state[GoVars.PASS_CHNL].any():
+        flags ^= pass_key
+    if state[GoVars.DONE_CHNL].any():
+        flags ^= done_key
+    return flags
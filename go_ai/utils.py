@@ -4,7 +4,7 @@ import logging
 import math
 import multiprocessing as mp
 import os
-import pickle
+import threading
 import time
 from datetime import datetime as dt
 
@@ -13,7 +13,7 @@ import numpy as np
 import torch
 from mpi4py import MPI
 
-from go_ai import data, game
+from go_ai import data, game, inference, models
 from go_ai.models import get_modelpath
 from go_ai.policies import baselines
 
@@ -26,9 +26,18 @@ def hyperparameters(args_encoding=None):
     # Go Environment
     parser.add_argument('--size', type=int, default=9, help='board size')
     parser.add_argument('--reward', type=str, choices=['real', 'heuristic'], default='real', help='reward system')
+    parser.add_argument('--engine', type=str, choices=list(data.ENGINES), default='gym',
+                        help='implementation of the go rules behind the search trees and the replay data')
 
     # Monte Carlo Tree Search
     parser.add_argument('--mcts', type=int, default=0, help='monte carlo searches (actor critic)')
+    parser.add_argument('--mcts-batch', type=int, default=1,
+                        help='leaves evaluated together per network call in monte carlo search. '
+                             'Above 1, the leaves of a batch are selected with virtual loss')
+    parser.add_argument('--transpositions', action='store_true',
+                        help='share search nodes between transposed positions in monte carlo search')
+    parser.add_argument('--lockstep', type=int, default=1,
+                        help='games played in lockstep per worker, sharing network calls')
     parser.add_argument('--width', type=int, default=4, help='width of beam search (value)')
     parser.add_argument('--depth', type=int, default=0, help='depth of beam search (value)')
     parser.add_argument('--gamma', type=float, default=0.99,
@@ -36,6 +45,8 @@ def hyperparameters(args_encoding=None):
 
     # Learning Parameters
     parser.add_argument('--lr', type=float, default=1e-3, help='learning rate')
+    parser.add_argument('--data-parallel', action='store_true',
+                        help='average the gradients of every training step across workers')
 
     # Exploration
     parser.add_argument('--temp', type=float, default=1, help='initial temperature')
@@ -44,6 +55,10 @@ def hyperparameters(args_encoding=None):
     parser.add_argument('--batchsize', type=int, default=32, help='batch size')
     parser.add_argument('--replaysize', type=int, default=256, help='max number of games to store')
     parser.add_argument('--batches', type=int, default=1000, help='number of batches to train on for one iteration')
+    parser.add_argument('--loaders', type=int, default=2,
+                        help='threads that prepare training batches in the background')
+    parser.add_argument('--prioritized', type=float, default=None,
+                        help='sample replay positions proportionally to their loss to this power (alpha)')
 
     # Loading
     parser.add_argument('--baseline', action='store_true', help='load baseline model')
@@ -57,7 +72,10 @@ def hyperparameters(args_encoding=None):
     parser.add_argument('--eval-interval', type=int, default=2, help='iterations per evaluation')
 
     # Disk Data
-    parser.add_argument('--replay-path', type=str, default='bin/replay.pickle', help='path to store replay')
+    parser.add_argument('--replay-dir', type=str, default='bin/replay/', help='directory of the sharded replay store')
+    parser.add_argument('--merge-workers', action='store_true',
+                        help='merge duplicate positions across the games of all workers on the first worker before '
+                             'appending them to the replay store')
     parser.add_argument('--checkdir', type=str, default=f'bin/checkpoints/{today}/')
 
     # Model
@@ -66,6 +84,16 @@ def hyperparameters(args_encoding=None):
 
     # Hardware
     parser.add_argument('--device', type=str, choices=['cpu', 'cuda'], default='cpu', help='device for pytorch models')
+    parser.add_argument('--server', action='store_true',
+                        help='evaluate the self-play model of all local workers in one inference process')
+    parser.add_argument('--server-batch', type=int, default=256, help='states per forward pass of the inference server')
+    parser.add_argument('--server-wait', type=float, default=1,
+                        help='milliseconds the inference server waits to fill a batch')
+    parser.add_argument('--cache', type=int, default=0,
+                        help='positions whose network outputs are cached per model, up to symmetry')
+    parser.add_argument('--quantize', action='store_true',
+                        help='evaluate the models with their TorchScript exports on the cpu, which are dynamic-int8 '
+                             '(linear layers only)')
 
     # Other
     parser.add_argument('--render', type=str, choices=['terminal', 'human'], default='terminal',
@@ -143,14 +171,73 @@ def mpi_log_debug(comm: MPI.Intracomm, s):
         log_debug(s)
 
 
+# Thread of the first worker that writes the latest checkpoint to disk
+checkpoint_writer = None
+
+
+def save_checkpoint(state_dict, checkpath):
+    """
+    Writes to a temporary file first so readers never see a partial checkpoint
+    """
+    torch.save(state_dict, checkpath + '.tmp')
+    os.replace(checkpath + '.tmp', checkpath)
+
+
+def wait_checkpoint():
+    """
+    Waits until the latest checkpoint is on disk
+    """
+    global checkpoint_writer
+    if checkpoint_writer is not None:
+        checkpoint_writer.join()
+        checkpoint_writer = None
+
+
 def mpi_sync_checkpoint(comm: MPI.Intracomm, args, new_pi, old_pi):
+    """
+    Distributes the weights of the first worker's new model to the old models of every worker with a broadcast.
+    The first worker writes them to disk in a background thread
+    """
+    global checkpoint_writer
     rank = comm.Get_rank()
     checkpath = get_modelpath(args, 'checkpoint')
+    state_dict = models.broadcast_state_dict(comm, new_pi.pt_model.state_dict())
+
     if rank == 0:
-        torch.save(new_pi.pt_model.state_dict(), checkpath)
-    comm.Barrier()
+        wait_checkpoint()
+        # The broadcast tensors are copies, so training can continue while they're written
+        checkpoint_writer = threading.Thread(target=save_checkpoint, args=(state_dict, checkpath))
+        checkpoint_writer.start()
+        if old_pi.pt_model.client is not None:
+            # The inference server loads the checkpoint from disk
+            wait_checkpoint()
+            old_pi.pt_model.client.reload()
+
+    if old_pi.pt_model.cache is not None:
+        mpi_log_debug(comm, f'Checkpoint cache {old_pi.pt_model.cache.stats()}')
     # Update other policy
-    old_pi.pt_model.load_state_dict(torch.load(checkpath, args.device))
+    old_pi.pt_model.load_state_dict(state_dict)
+    if old_pi.pt_model.client is not None:
+        # Every worker evaluates through the server, so none may continue before it has the new weights
+        comm.Barrier()
+
+
+def mpi_start_server(comm: MPI.Intracomm, args, model):
+    """
+    Starts an inference server on the first worker and points the model of every worker to it.
+    The server reloads the weights on every mpi_sync_checkpoint
+    :return: The server on the first worker, None on the other workers
+    """
+    rank = comm.Get_rank()
+    server = None
+    handle = None
+    if rank == 0:
+        server = inference.InferenceServer(args, comm.Get_size())
+        handle = server.handle()
+    handle = comm.bcast(handle, root=0)
+    # Other workers were not spawned by the first worker
+    model.client = inference.InferenceClient(handle, rank, untrack=rank != 0)
+    return server
 
 
 def mpi_sync_data(comm: MPI.Intracomm, args):
@@ -176,15 +263,16 @@ def mpi_sync_data(comm: MPI.Intracomm, args):
     comm.Barrier()
 
 
-def mpi_play(comm: MPI.Intracomm, go_env, pi1, pi2, requested_episodes):
+def mpi_play(comm: MPI.Intracomm, go_env, pi1, pi2, requested_episodes, lockstep=1):
     """
-    Plays games in parallel
+    Plays games in parallel. Every worker steps its games in lockstep on one BatchGoEnv
     :param comm:
-    :param go_env:
+    :param go_env: Gym environment with the board size and the reward method of the games
     :param pi1:
     :param pi2:
     :param gettraj:
     :param requested_episodes:
+    :param lockstep: Number of games each worker plays at the same time
     :return:
     """
     world_size = comm.Get_size()
@@ -193,64 +281,89 @@ def mpi_play(comm: MPI.Intracomm, go_env, pi1, pi2, requested_episodes):
     episodes = worker_episodes * world_size
     single_worker = comm.Get_size() <= 1
 
+    pi1.reset_search_time()
+    pi2.reset_search_time()
+
     timestart = time.time()
-    p1wr, black_wr, replay, steps = game.play_games(go_env, pi1, pi2, worker_episodes, progress=single_worker)
+    p1wr, black_wr, replay, steps = game.play_games(go_env, pi1, pi2, worker_episodes, progress=single_worker,
+                                                    lockstep=lockstep)
     timeend = time.time()
 
     duration = timeend - timestart
     avg_time = comm.allreduce(duration / worker_episodes, op=MPI.SUM) / world_size
+    pi1_search = comm.allreduce(pi1.avg_search_time(), op=MPI.SUM) / world_size
+    pi2_search = comm.allreduce(pi2.avg_search_time(), op=MPI.SUM) / world_size
+    policies = [pi1] if pi1 is pi2 else [pi1, pi2]
+    tt_hits = comm.allreduce(sum(pi.tt_hits for pi in policies), op=MPI.SUM)
+    tt_lookups = tt_hits + comm.allreduce(sum(pi.tt_misses for pi in policies), op=MPI.SUM)
     p1wr = comm.allreduce(p1wr, op=MPI.SUM) / world_size
     black_wr = comm.allreduce(black_wr, op=MPI.SUM) / world_size
     avg_steps = comm.allreduce(sum(steps), op=MPI.SUM) / episodes
 
+    tt_info = f'{100 * tt_hits / tt_lookups:.1f}% TT_HITS, ' if tt_lookups > 0 else ''
     mpi_log_debug(comm, f'{pi1} V {pi2} | {episodes} GAMES, {avg_time:.1f} SEC/GAME, {avg_steps:.0f} STEPS/GAME, '
+                        f'{1000 * pi1_search:.1f}/{1000 * pi2_search:.1f} MS/SEARCH, {tt_info}'
                         f'{100 * p1wr:.1f}% WIN({100 * black_wr:.1f}% BLACK_WIN)')
     return p1wr, black_wr, replay
 
 
 def multi_proc_play(args1, args2, requested_episodes, workers=4):
+    """
+    Plays games in parallel processes. The games replace the contents of the replay store in args1.replay_dir
+    :return: Win rate of the first policy, win rate of black and the games
+    """
     world_size = workers
 
     worker_episodes = int(math.ceil(requested_episodes / world_size))
     episodes = worker_episodes * world_size
 
-    # Clear replay on disk
-    assert args1.replay_path == args2.replay_path
-    if os.path.exists(args1.replay_path):
-        os.remove(args1.replay_path)
+    # Inference servers for the models
+    servers = []
+    for args in [args1, args2]:
+        if args.server and args.model in ['val', 'ac', 'attn']:
+            servers.append(inference.InferenceServer(args, workers))
+        else:
+            servers.append(None)
+    handles = [server.handle() if server is not None else None for server in servers]
 
     context = mp.get_context('spawn')
-    barrier = context.Barrier(workers)
     queue = context.Queue()
     processes = []
     for rank in range(workers):
-        p = context.Process(target=worker_play, args=(rank, queue, barrier, args1, args2, worker_episodes))
+        p = context.Process(target=worker_play, args=(rank, queue, args1, args2, worker_episodes, handles))
         p.start()
         processes.append(p)
 
+    # Drain the queue before joining so that workers aren't blocked on putting their games
+    results = [queue.get() for _ in range(workers)]
+
     for p in processes:
         p.join()
 
+    for server in servers:
+        if server is not None:
+            server.close()
+
     p1wrs = []
     black_wrs = []
     total_durations = []
     total_steps = []
-    while not queue.empty():
-        p1wr, black_wr, steps, duration = queue.get()
+    replay = []
+    for _, p1wr, black_wr, steps, duration, worker_replay in sorted(results, key=lambda result: result[0]):
         p1wrs.append(p1wr)
         black_wrs.append(black_wr)
         total_durations.append(duration)
         total_steps.append(steps)
-
-    assert len(p1wrs) == workers, (len(p1wrs), workers)
+        replay.extend(worker_replay)
 
     p1wr = np.mean(p1wrs)
     black_wr = np.mean(black_wrs)
     avg_time = np.sum(total_durations) / episodes
     avg_steps = np.sum(total_steps) / episodes
 
-    # Load replay data
-    replay = data.load_replay(args1.replay_path)
+    # Save the games in the replay store
+    data.reset_replay(args1)
+    data.append_replay(args1, replay)
 
     print(f'{episodes} GAMES, {avg_time:.1f} SEC/GAME, {avg_steps:.0f} STEPS/GAME, '
           f'{100 * p1wr:.1f}% WIN({100 * black_wr:.1f}% BLACK_WIN)')
@@ -258,36 +371,27 @@ def multi_proc_play(args1, args2, requested_episodes, workers=4):
     return p1wr, black_wr, replay
 
 
-def worker_play(rank, queue, barrier, args1, args2, worker_episodes):
-    pi1, net1 = baselines.create_policy(args1)
-    pi2, net2 = baselines.create_policy(args2)
+def worker_play(rank, queue, args1, args2, worker_episodes, handles=(None, None)):
+    # Spawned processes import data with the default engine
+    data.set_engine(args1.engine)
+    clients = [inference.InferenceClient(handle, rank) if handle is not None else None for handle in handles]
+    pi1, net1 = baselines.create_policy(args1, client=clients[0])
+    pi2, net2 = baselines.create_policy(args2, client=clients[1])
 
     size = args1.size
     assert size == args2.size
     go_env = gym.make('gym_go:go-v0', size=size)
 
     timestart = time.time()
-    p1wr, black_wr, replay, steps = game.play_games(go_env, pi1, pi2, worker_episodes)
+    p1wr, black_wr, replay, steps = game.play_games(go_env, pi1, pi2, worker_episodes, lockstep=args1.lockstep)
     timeend = time.time()
 
     duration = timeend - timestart
     total_steps = sum(steps)
 
-    queue.put((p1wr, black_wr, total_steps, duration))
-
-    # Dump replay data into temporary file
-    for i in range(barrier.parties):
-        if i == rank:
-            if os.path.exists(args1.replay_path):
-                all_replays = data.load_replay(args1.replay_path)
-                all_replays.extend(replay)
-            else:
-                all_replays = replay
-
-            with open(args1.replay_path, 'wb') as f:
-                pickle.dump(all_replays, f)
+    # Trajectories hold bit-packed states, so they're cheap to send back
+    queue.put((rank, p1wr, black_wr, total_steps, duration, replay))
 
-        barrier.wait()
 
 def get_iter_header():
     return "TIME\tITR\tREPLAY\tC_ACC\tC_LOSS\tA_ACC\tA_LOSS\tG_LOSS\tC_WR\tR_WR\tG_WR"
@@ -1,9 +1,10 @@
 import gym
 
 import go_ai.policies.baselines
-from go_ai import game, utils
+from go_ai import data, game, utils
 
 args = utils.hyperparameters(['customdir=bin/baselines/'])
+data.set_engine(args.engine)
 
 # Environment
 go_env = gym.make('gym_go:go-v0', size=args.size)
@@ -0,0 +1,10 @@
+from go_ai import measurements, utils
+
+utils.config_log()
+
+# The search trees and the lockstep games play their moves on the boards they keep ('native')
+for size in [5, 9]:
+    timings = measurements.compare_engines(size)
+    utils.log_info(f'\n{timings.to_string()}')
+    for _, row in timings.iterrows():
+        assert row['native_ms'] < row['gym_ms'], f"native {row['operation']} is slower than gym_go on {size}x{size}"
@@ -0,0 +1,65 @@
+import unittest
+
+import numpy as np
+import torch
+
+from go_ai import data
+from go_ai.models import attn_net
+
+
+class AttnNetEncodings(unittest.TestCase):
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+        self.size = 5
+        self.model = attn_net.AttnNet(self.size)
+        state = data.GoGame.init_state(self.size)
+        state = data.GoGame.next_state(state, 7)
+        children = data.GoGame.children(state, canonical=True, padded=True)
+        self.states = torch.tensor(np.concatenate([children, children[:4]]), dtype=torch.float32)
+
+    def full_encoding(self, states):
+        return self.model.encoder(self.model.main(states))
+
+    def test_inference_encodings(self):
+        self.model.eval()
+        with torch.no_grad():
+            expected = self.full_encoding(self.states)
+            z = self.model.encode(self.states)
+            self.assertTrue(torch.allclose(z, expected, atol=1e-5))
+
+            # Every distinct state is cached once and encoded from the cache on the next call
+            distinct = np.unique(self.states.reshape(len(self.states), -1).numpy(), axis=0)
+            self.assertEqual(len(self.model.encodings), len(distinct))
+            # Cached encodings are copies rather than views of the batch
+            self.assertTrue(all(encoding._base is None for encoding in self.model.encodings.values()))
+            for encoding in self.model.encodings.values():
+                encoding.fill_(0)
+            self.assertTrue(torch.all(self.model.encode(self.states) == 0))
+
+    def test_weights_changed(self):
+        self.model.eval()
+        with torch.no_grad():
+            self.model.encode(self.states)
+            self.assertGreater(len(self.model.encodings), 0)
+
+            for param in self.model.encoder.parameters():
+                param.add_(1)
+            self.model.weights_changed()
+            self.assertEqual(len(self.model.encodings), 0)
+            self.assertTrue(torch.allclose(self.model.encode(self.states), self.full_encoding(self.states), atol=1e-5))
+
+            self.model.encode(self.states)
+            self.model.load_state_dict(self.model.state_dict())
+            self.assertEqual(len(self.model.encodings), 0)
+
+    def test_training_encodes_every_state(self):
+        # The batch norms of the training batch see the duplicate children
+        self.model.train()
+        z = self.model.encode(self.states)
+        expected = self.full_encoding(self.states)
+        self.assertTrue(torch.allclose(z, expected, atol=1e-5))
+        self.assertEqual(len(self.model.encodings), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
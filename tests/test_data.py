@@ -0,0 +1,227 @@
+import argparse
+import os
+import tempfile
+import unittest
+
+import gym
+import numpy as np
+
+from go_ai import data, game
+
+
+class Packing(unittest.TestCase):
+    def test_round_trip(self):
+        for size in [5, 7, 9]:
+            states = np.random.randint(2, size=(3, 4, data.GoVars.NUM_CHNLS, size, size)).astype(np.float32)
+            packed = data.pack_states(states)
+            self.assertEqual(packed.shape, (3, 4, data.packed_size(size)))
+            self.assertEqual(packed.dtype, np.uint8)
+            self.assertTrue(np.array_equal(data.unpack_states(packed, size), states))
+
+
+class Symmetries(unittest.TestCase):
+    def setUp(self) -> None:
+        self.size = 5
+        self.gogame = gym.make('gym_go:go-v0', size=0).gogame
+
+    def test_states(self):
+        states = np.random.randint(2, size=(16, data.GoVars.NUM_CHNLS, self.size, self.size)).astype(np.float32)
+        for state in states:
+            syms = data.batch_symmetric_states(np.repeat(state[np.newaxis], 8, axis=0), np.arange(8))
+            expected = self.gogame.get_symmetries(state)
+            self.assertEqual({sym.tobytes() for sym in syms},
+                             {np.asarray(sym, dtype=np.float32).tobytes() for sym in expected})
+
+    def test_actions(self):
+        # A stone on an action moves to the symmetric action
+        for action in range(self.size ** 2):
+            state = np.zeros((8, data.GoVars.NUM_CHNLS, self.size, self.size), dtype=np.float32)
+            state[:, data.GoVars.BLACK, action // self.size, action % self.size] = 1
+            syms = data.batch_symmetric_states(state, np.arange(8))
+            sym_actions = data.batch_symmetric_actions(np.full(8, action), np.arange(8), self.size)
+            self.assertTrue(np.array_equal(np.argmax(syms[:, data.GoVars.BLACK].reshape(8, -1), axis=1), sym_actions))
+        passes = data.batch_symmetric_actions(np.full(8, self.size ** 2), np.arange(8), self.size)
+        self.assertTrue(np.all(passes == self.size ** 2))
+
+    def test_pis(self):
+        pis = np.random.rand(8, self.size ** 2 + 1)
+        syms = np.arange(8)
+        sym_pis = data.batch_symmetric_pis(pis, syms)
+        self.assertTrue(np.array_equal(data.batch_inverse_symmetric_pis(sym_pis, syms), pis))
+        actions = np.random.randint(self.size ** 2 + 1, size=8)
+        sym_actions = data.batch_symmetric_actions(actions, syms, self.size)
+        self.assertTrue(np.array_equal(sym_pis[np.arange(8), sym_actions], pis[np.arange(8), actions]))
+
+
+class BatchEvaluators(unittest.TestCase):
+    def setUp(self) -> None:
+        self.gogame = gym.make('gym_go:go-v0', size=0).gogame
+
+    def random_positions(self, size, num_games=8):
+        rng = np.random.RandomState(size)
+        states = []
+        for _ in range(num_games):
+            state = self.gogame.init_state(size)
+            for _ in range(rng.randint(size ** 2)):
+                state = self.gogame.next_state(state, rng.choice(np.flatnonzero(self.gogame.valid_moves(state))))
+                states.append(state)
+                if self.gogame.game_ended(state):
+                    break
+        return np.array(states, dtype=np.float32)
+
+    def test_same_as_gogame(self):
+        for size in [5, 7, 9]:
+            states = self.random_positions(size)
+            black_areas, white_areas = data.batch_areas(states)
+            black_libs, white_libs = data.batch_liberties(states)
+            for i, state in enumerate(states):
+                self.assertEqual((black_areas[i], white_areas[i]), tuple(self.gogame.areas(state)))
+                self.assertEqual((black_libs[i], white_libs[i]), tuple(self.gogame.get_num_liberties(state)))
+
+            # Leading dimensions are kept
+            black_areas, _ = data.batch_areas(states[:6].reshape(2, 3, *states.shape[1:]))
+            self.assertEqual(black_areas.shape, (2, 3))
+
+
+class DedupRecords(unittest.TestCase):
+    def setUp(self) -> None:
+        self.size = 5
+
+    def make_records(self, states, actions, wins):
+        records = np.zeros(len(states), dtype=data.replay_dtype(self.size))
+        records['state'] = data.pack_states(states)
+        records['next_state'] = data.pack_states(states)
+        records['action'] = actions
+        records['win'] = wins
+        records['black_won'] = wins
+        records['weight'] = 1
+        pis = np.zeros((len(states), self.size ** 2 + 1))
+        pis[np.arange(len(states)), actions] = 1
+        records['pi'] = pis
+        return records
+
+    def test_merge_symmetries(self):
+        state = np.zeros((data.GoVars.NUM_CHNLS, self.size, self.size), dtype=np.float32)
+        state[data.GoVars.BLACK, 0, 1] = 1
+        state[data.GoVars.WHITE, 2, 3] = 1
+        syms = np.arange(8)
+        states = data.batch_symmetric_states(np.repeat(state[np.newaxis], 8, axis=0), syms)
+        actions = data.batch_symmetric_actions(np.full(8, 7), syms, self.size)
+        wins = np.array([1, 1, 1, -1, -1, -1, -1, -1])
+
+        # The same position and action in every symmetry, another action and another position
+        other_state = state.copy()
+        other_state[data.GoVars.BLACK, 4, 4] = 1
+        records = self.make_records(np.concatenate([states, states[:1], other_state[np.newaxis]]),
+                                    np.concatenate([actions, [8, 7]]), np.concatenate([wins, [1, -1]]))
+        merged, black_wins = data.dedup_records(records, self.size)
+
+        self.assertEqual(len(merged), 3)
+        self.assertEqual(black_wins, 1)
+        self.assertTrue(np.all(merged['black_won'][:black_wins] > 0))
+        self.assertEqual(sorted(merged['weight']), [1, 1, 8])
+        symmetric = merged[merged['weight'] == 8][0]
+        self.assertAlmostEqual(symmetric['win'], np.mean(wins))
+        self.assertAlmostEqual(symmetric['pi'].sum(), 1)
+        self.assertEqual(np.argmax(symmetric['pi']), symmetric['action'])
+
+        # Merging again only adds up the weights
+        remerged, _ = data.dedup_records(np.concatenate([merged, merged]), self.size)
+        self.assertEqual(len(remerged), 3)
+        self.assertEqual(sorted(remerged['weight']), [2, 2, 16])
+        # Merged records are already canonical
+        again, _ = data.dedup_records(merged, self.size)
+        for field in merged.dtype.names:
+            self.assertTrue(np.allclose(again[field], merged[field]))
+
+
+class ReplayStore(unittest.TestCase):
+    def setUp(self) -> None:
+        self.size = 5
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.args = argparse.Namespace(replay_dir=self.tempdir.name, replaysize=4, size=self.size)
+        data.reset_replay(self.args)
+
+    def tearDown(self) -> None:
+        self.tempdir.cleanup()
+
+    def random_game(self, seed, moves=6):
+        go_env = gym.make('gym_go:go-v0', size=self.size)
+        go_env.reset()
+        rng = np.random.RandomState(seed)
+        traj = game.Trajectory()
+        for _ in range(moves):
+            valid_moves = go_env.valid_moves()
+            action = rng.choice(np.flatnonzero(valid_moves[:-1]))
+            traj.add_event(go_env.canonical_state(), action, 0, valid_moves / valid_moves.sum())
+            go_env.step(action)
+        traj.set_win(1)
+        return traj
+
+    def test_appends(self):
+        # The same game twice merges within the append, but not with the games already in the store
+        replay = [self.random_game(0), self.random_game(0)]
+        for _ in range(3):
+            data.append_replay(self.args, replay)
+
+        # The oldest shard was evicted with its files
+        manifest = data.load_manifest(self.args.replay_dir)
+        self.assertEqual([shard['name'] for shard in manifest['shards']], ['000001.npy', '000002.npy'])
+        self.assertEqual(sorted(name for name in os.listdir(self.args.replay_dir) if name.startswith('000000')), [])
+        self.assertEqual(sum(shard['games'] for shard in manifest['shards']), 4)
+
+        index = data.load_index(self.args.replay_dir, manifest)
+        self.assertEqual(len(index), sum(shard['positions'] for shard in manifest['shards']))
+        self.assertEqual(manifest['black_wins'], sum(shard['black_wins'] for shard in manifest['shards']))
+        self.assertTrue(np.all(index['weight'] == 2))
+        for shard_num, shard in enumerate(manifest['shards']):
+            records = np.load(os.path.join(self.args.replay_dir, shard['name']))
+            entries = index[index['shard'] == shard_num]
+            self.assertTrue(np.array_equal(records['weight'][entries['offset']], entries['weight']))
+
+    def test_black_wins_first(self):
+        white_won = self.random_game(1)
+        white_won.set_win(-1)
+        data.append_replay(self.args, [self.random_game(0), white_won])
+        data.append_replay(self.args, [white_won, self.random_game(2)])
+
+        manifest = data.load_manifest(self.args.replay_dir)
+        index = data.load_index(self.args.replay_dir, manifest)
+        num_black_wins = manifest['black_wins']
+        records = [np.load(os.path.join(self.args.replay_dir, shard['name'])) for shard in manifest['shards']]
+        black_won = np.array([records[entry['shard']][entry['offset']]['black_won'] for entry in index])
+        self.assertTrue(np.all(black_won[:num_black_wins] > 0))
+        self.assertTrue(np.all(black_won[num_black_wins:] <= 0))
+
+
+class SumTreeSampling(unittest.TestCase):
+    def test_prefix_and_find(self):
+        priorities = np.array([1, 0, 3, 2, 0.5, 4, 0, 1.5, 2.5])
+        sumtree = data.SumTree(priorities)
+        cumsum = np.cumsum(priorities)
+        self.assertAlmostEqual(sumtree.total(), priorities.sum())
+        for n in range(len(priorities) + 1):
+            self.assertAlmostEqual(sumtree.prefix(n), priorities[:n].sum())
+
+        # Every mass lands on the priority whose range contains it, and empty priorities are never found
+        masses = np.linspace(0, priorities.sum(), 1000, endpoint=False)
+        expected = np.searchsorted(cumsum, masses, side='right')
+        self.assertTrue(np.array_equal(sumtree.find(masses), expected))
+
+    def test_update(self):
+        priorities = np.random.rand(37)
+        sumtree = data.SumTree(priorities)
+        idcs = np.array([0, 5, 36, 12])
+        priorities[idcs] = [2, 0, 1, 3]
+        sumtree.update(idcs, priorities[idcs])
+        self.assertAlmostEqual(sumtree.total(), priorities.sum())
+
+        np.random.seed(0)
+        samples = sumtree.find(np.random.rand(100000) * sumtree.total())
+        self.assertEqual(np.sum(samples == 5), 0)
+        frequencies = np.bincount(samples, minlength=len(priorities)) / len(samples)
+        self.assertTrue(np.allclose(frequencies, priorities / priorities.sum(), atol=0.01))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+import gym
+import numpy as np
+
+from go_ai import data, engine
+
+
+class EngineVersusGymGo(unittest.TestCase):
+    def setUp(self) -> None:
+        self.num_games = 32
+        self.gogame = gym.make('gym_go:go-v0', size=0).gogame
+
+    def play_random_games(self, size):
+        """
+        Plays random games with gym_go and checks the engine, which plays along incrementally, at every move
+        """
+        rng = np.random.RandomState(size)
+        for _ in range(self.num_games):
+            state = self.gogame.init_state(size)
+            board = engine.Board(size)
+            for _ in range(2 * size ** 2):
+                valid_moves = self.gogame.valid_moves(state)
+                self.assertTrue(np.array_equal(engine.valid_moves(state), valid_moves))
+                self.assertTrue(np.array_equal(board.valid_moves(), valid_moves))
+                self.assertEqual(engine.winning(state), self.gogame.winning(state))
+                yield state
+
+                action = rng.choice(np.flatnonzero(valid_moves))
+                state = self.gogame.next_state(state, action)
+                board.play(action)
+                self.assertTrue(np.array_equal(board.state(), state))
+                self.assertEqual(board.hash, engine.Board.from_state(state).hash)
+                if self.gogame.game_ended(state):
+                    break
+
+    def test_next_state(self):
+        for size in [5, 9]:
+            for state in self.play_random_games(size):
+                for action in np.flatnonzero(self.gogame.valid_moves(state))[:4]:
+                    for canonical in [False, True]:
+                        expected = self.gogame.next_state(state, action, canonical=canonical)
+                        self.assertTrue(np.array_equal(engine.next_state(state, action, canonical), expected))
+
+    def test_children(self):
+        for state in self.play_random_games(7):
+            expected = self.gogame.children(state, canonical=True, padded=True)
+            self.assertTrue(np.array_equal(engine.children(state, canonical=True, padded=True), expected))
+
+    def test_batch_next_states(self):
+        rng = np.random.RandomState(0)
+        for size in [5, 9]:
+            states = np.array(list(self.play_random_games(size)))
+            actions = [rng.choice(np.flatnonzero(self.gogame.valid_moves(state))) for state in states]
+            for canonical in [False, True]:
+                expected = [self.gogame.next_state(state, action, canonical) for state, action in zip(states, actions)]
+                self.assertTrue(np.array_equal(data.batch_next_states(states, actions, canonical), expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
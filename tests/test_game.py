@@ -0,0 +1,64 @@
+import unittest
+
+import gym
+import numpy as np
+
+from go_ai import data, game
+from go_ai.policies import Policy
+
+
+class HashPolicy(Policy):
+    """
+    Deterministic policy that picks a valid move by the hash of the state, so games don't depend on the random state
+    """
+
+    def __call__(self, go_env, **kwargs):
+        valid_moves = go_env.valid_moves()
+        moves = np.flatnonzero(valid_moves)
+        key = data.pack_states(go_env.canonical_state()).tobytes()
+        pi = np.zeros(len(valid_moves))
+        pi[moves[hash(key) % len(moves)]] = 1
+        return pi
+
+
+class BatchPitVersusPit(unittest.TestCase):
+    def setUp(self) -> None:
+        self.size = 5
+        self.num_games = 8
+        self.go_env = gym.make('gym_go:go-v0', size=self.size)
+        self.black_pi = HashPolicy('Black')
+        self.white_pi = HashPolicy('White')
+
+    def test_same_games(self):
+        boards = game.BatchGoEnv.like(self.go_env, self.num_games)
+        # Different games on every board
+        openings = np.arange(self.num_games)
+        boards.step(openings, openings)
+        batch_results = game.batch_pit(boards, self.black_pi, self.white_pi)
+
+        for opening, (black_won, steps, traj) in zip(openings, batch_results):
+            self.go_env.reset()
+            self.go_env.step(opening)
+            expected_won, expected_steps, expected_traj = game.pit(self.go_env, self.black_pi, self.white_pi)
+
+            self.assertEqual(black_won, expected_won)
+            self.assertEqual(steps, expected_steps)
+            self.assertEqual(traj.actions, expected_traj.actions)
+            self.assertEqual(traj.rewards, expected_traj.rewards)
+            self.assertTrue(np.array_equal(traj.get_states(), expected_traj.get_states()))
+            for event, expected_event in zip(traj.get_events(), expected_traj.get_events()):
+                for value, expected_value in zip(event, expected_event):
+                    self.assertTrue(np.array_equal(value, expected_value))
+
+    def test_game_ended(self):
+        # Two passes end the first game
+        boards = game.BatchGoEnv(self.size, 2)
+        boards.step([0], [self.size ** 2])
+        boards.step([0], [self.size ** 2])
+        self.assertTrue(boards.envs[0].game_ended())
+        self.assertFalse(boards.envs[1].game_ended())
+        self.assertEqual(np.shape(boards.envs[0].game_ended()), ())
+
+
+if __name__ == '__main__':
+    unittest.main()
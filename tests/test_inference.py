@@ -0,0 +1,51 @@
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from go_ai import data, inference, utils
+from go_ai.policies import baselines
+
+
+class ServerRoundTrip(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.args = utils.hyperparameters(['--size=5', '--model=ac', f'--customdir={self.tempdir.name}'])
+        torch.manual_seed(0)
+        _, self.net = baselines.create_policy(utils.hyperparameters(['--size=5', '--model=ac']))
+        torch.save(self.net.state_dict(), self.args.custompath)
+        self.net.eval()
+
+        self.server = inference.InferenceServer(self.args, clients=2, capacity=4, maxbatch=8, wait=0)
+
+    def tearDown(self) -> None:
+        self.server.close()
+        self.tempdir.cleanup()
+
+    def test_matches_model(self):
+        client = self.server.client(0)
+        # More states than fit in one request
+        states = np.random.randint(2, size=(10, data.GoVars.NUM_CHNLS, 5, 5)).astype(np.float32)
+        for mode in inference.MODES:
+            expected = self.net.create_numpy(mode)(states)
+            outputs = client.numpy(states, mode)
+            if mode == 'actor_critic':
+                for output, expected_output in zip(outputs, expected):
+                    self.assertTrue(np.allclose(output, expected_output, atol=1e-5))
+            else:
+                self.assertTrue(np.allclose(outputs, expected, atol=1e-5))
+
+    def test_dead_server(self):
+        client = inference.InferenceClient(self.server.handle(), 1, timeout=1)
+        client.numpy(np.zeros((1, data.GoVars.NUM_CHNLS, 5, 5), dtype=np.float32), 'critic')
+
+        # Killed servers can't say they stopped, so the client waits out the timeout
+        self.server.process.kill()
+        self.server.process.join()
+        with self.assertRaises(RuntimeError):
+            client.numpy(np.zeros((1, data.GoVars.NUM_CHNLS, 5, 5), dtype=np.float32), 'critic')
+
+
+if __name__ == '__main__':
+    unittest.main()
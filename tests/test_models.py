@@ -0,0 +1,197 @@
+import copy
+import tempfile
+import time
+import types
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+from mpi4py import MPI
+from torch import nn
+
+from go_ai import cache, data, models, utils
+from go_ai.models import val_net
+
+
+def random_states(n, size):
+    states = np.random.randint(2, size=(n, data.GoVars.NUM_CHNLS, size, size)).astype(np.float32)
+    states[:, data.GoVars.WHITE] *= 1 - states[:, data.GoVars.BLACK]
+    return states
+
+
+def randomize_batch_norms(model):
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, nn.BatchNorm2d):
+                module.running_mean.uniform_(-1, 1)
+                module.running_var.uniform_(0.5, 2)
+                module.weight.uniform_(0.5, 2)
+                module.bias.uniform_(-1, 1)
+
+
+class FakeComm:
+    """
+    Two workers, where the other worker holds the parameters of another model
+    """
+
+    def __init__(self, other):
+        params = list(other.parameters())
+        self.flats = [torch.cat([params[i].detach().reshape(-1) for i in bucket]).numpy()
+                      for bucket in models.make_buckets(params)]
+
+    def Get_size(self):
+        return 2
+
+    def Allreduce(self, sendbuf, recvbuf, op):
+        assert sendbuf is MPI.IN_PLACE and op is MPI.SUM
+        recvbuf += self.flats.pop(0)
+
+
+class FuseConvBN(unittest.TestCase):
+    def test_same_outputs(self):
+        torch.manual_seed(0)
+        model = val_net.ValueNet(5)
+        randomize_batch_norms(model)
+        model.eval()
+        fused = copy.deepcopy(model)
+        models.fuse_conv_bn(fused)
+
+        self.assertFalse(any(isinstance(module, nn.BatchNorm2d) for module in fused.modules()))
+        states = torch.tensor(random_states(16, 5))
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(fused.pt_critic(states), model.pt_critic(states), atol=1e-4))
+
+
+class Buckets(unittest.TestCase):
+    def test_make_buckets(self):
+        tensors = [torch.zeros(n) for n in [10, 30, 5, 100, 1, 1, 20]]
+        bucket_bytes = 4 * 32
+        buckets = models.make_buckets(tensors, bucket_bytes)
+
+        # Every tensor once and in order
+        self.assertEqual([i for bucket in buckets for i in bucket], list(range(len(tensors))))
+        for bucket in buckets:
+            num_bytes = sum(4 * tensors[i].numel() for i in bucket)
+            self.assertTrue(num_bytes <= bucket_bytes or len(bucket) == 1)
+        self.assertEqual(buckets, [[0], [1], [2], [3], [4, 5, 6]])
+
+    def test_average_model(self):
+        torch.manual_seed(0)
+        model, other = val_net.ValueNet(5), val_net.ValueNet(5)
+        expected = [(param + other_param).detach() / 2
+                    for param, other_param in zip(model.parameters(), other.parameters())]
+
+        comm = FakeComm(other)
+        models.average_model(comm, model)
+        self.assertEqual(len(comm.flats), 0)
+        for param, expected_param in zip(model.parameters(), expected):
+            self.assertTrue(torch.allclose(param, expected_param))
+
+
+class OutputCacheInvalidation(unittest.TestCase):
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+        self.size = 5
+        self.model = val_net.ValueNet(self.size)
+        self.model.cache = cache.OutputCache(capacity=64)
+        self.critic = self.model.create_numpy('critic')
+        self.states = random_states(8, self.size)
+
+    def test_hits(self):
+        vals = self.critic(self.states)
+        self.assertEqual(self.model.cache.stats()['misses'], len(self.states))
+        self.assertTrue(np.allclose(self.critic(self.states), vals))
+        self.assertEqual(self.model.cache.stats()['hits'], len(self.states))
+
+        # Symmetries share the entry of their position
+        syms = data.batch_symmetric_states(self.states, np.full(len(self.states), 3))
+        self.assertTrue(np.allclose(self.critic(syms), vals))
+        self.assertEqual(self.model.cache.stats()['hits'], 2 * len(self.states))
+
+    def test_weights_changed(self):
+        vals = self.critic(self.states)
+        state_dict = {key: value + 1 if value.is_floating_point() else value
+                      for key, value in self.model.state_dict().items()}
+        self.model.load_state_dict(state_dict)
+        self.assertEqual(self.model.cache.stats()['entries'], 0)
+
+        new_vals = self.critic(self.states)
+        self.assertTrue(np.allclose(new_vals, self.model._numpy(self.states, 'critic')))
+        self.assertFalse(np.allclose(new_vals, vals))
+        self.assertEqual(self.model.cache.stats()['misses'], 2 * len(self.states))
+
+    def test_evictions(self):
+        self.model.cache = cache.OutputCache(capacity=4)
+        self.critic(self.states)
+        self.assertEqual(self.model.cache.stats()['entries'], 4)
+        self.assertEqual(self.model.cache.stats()['evictions'], len(self.states) - 4)
+
+
+class InputBuffers(unittest.TestCase):
+    def test_reused_across_shapes(self):
+        torch.manual_seed(0)
+        model = val_net.ValueNet(5)
+        critic = model.create_numpy('critic')
+        for n in [8, 3, 16, 1]:
+            states = random_states(n, 5)
+            vals = critic(states.astype(np.uint8))
+            self.assertTrue(np.allclose(vals, critic(states)))
+
+        # One buffer, as big as the biggest batch
+        self.assertEqual(list(model._input_buffers), [4])
+        self.assertEqual(len(model._input_buffers[4]), 16 * data.GoVars.NUM_CHNLS * 5 * 5)
+        # The registered buffers of the module are untouched
+        model.to('cpu')
+        self.assertTrue(all(isinstance(value, torch.Tensor) for value in model.state_dict().values()))
+
+
+class CheckpointSync(unittest.TestCase):
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+        self.new_model = val_net.ValueNet(5)
+        randomize_batch_norms(self.new_model)
+        self.old_model = val_net.ValueNet(5)
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.args = types.SimpleNamespace(checkdir=self.tempdir.name, model='val', size=5)
+
+    def tearDown(self) -> None:
+        self.tempdir.cleanup()
+
+    def assert_same(self, state_dict, expected):
+        self.assertEqual(list(state_dict), list(expected))
+        for key in expected:
+            self.assertEqual(state_dict[key].dtype, expected[key].dtype)
+            self.assertTrue(torch.equal(state_dict[key], expected[key]))
+
+    def test_broadcast(self):
+        state_dict = self.new_model.state_dict()
+        broadcast = models.broadcast_state_dict(MPI.COMM_WORLD, state_dict)
+        self.assert_same(broadcast, state_dict)
+
+        # The broadcast weights are copies
+        with torch.no_grad():
+            for param in self.new_model.parameters():
+                param.add_(1)
+        self.assertFalse(torch.equal(broadcast['main.0.weight'], self.new_model.state_dict()['main.0.weight']))
+
+    def test_background_save(self):
+        def slow_save(state_dict, checkpath):
+            time.sleep(0.2)
+            save_checkpoint(state_dict, checkpath)
+
+        save_checkpoint = utils.save_checkpoint
+        new_pi = types.SimpleNamespace(pt_model=self.new_model)
+        old_pi = types.SimpleNamespace(pt_model=self.old_model)
+        with mock.patch.object(utils, 'save_checkpoint', slow_save):
+            utils.mpi_sync_checkpoint(MPI.COMM_WORLD, self.args, new_pi, old_pi)
+            expected = self.new_model.state_dict()
+            self.assert_same(self.old_model.state_dict(), expected)
+
+            utils.wait_checkpoint()
+            self.assertIsNone(utils.checkpoint_writer)
+            self.assert_same(torch.load(models.get_modelpath(self.args, 'checkpoint')), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
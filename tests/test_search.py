@@ -0,0 +1,115 @@
+import unittest
+
+import gym
+import numpy as np
+
+from go_ai.policies import baselines
+from go_ai.search import mct, tree
+
+
+def sequential_search(rootstate, num_searches, critic):
+    """
+    Classic search that selects, expands and evaluates one leaf at a time, with one state per network call
+    """
+    searchtree = tree.Tree(rootstate)
+    while searchtree.visits[0] < num_searches + 1:
+        node, path = mct.find_next_node(searchtree)
+        terminal = searchtree.terminals[node]
+        if not terminal:
+            for child in searchtree.make_children(node):
+                searchtree.vals[child] = critic(searchtree.state(child)[np.newaxis]).item()
+        val = critic(searchtree.state(node)[np.newaxis]).item()
+        searchtree.vals[node] = val
+        searchtree.backprop(node, path, val)
+        if not terminal:
+            searchtree.set_prior_pi(node, None)
+    return searchtree
+
+
+class BatchedSearch(unittest.TestCase):
+    def setUp(self) -> None:
+        self.size = 5
+        self.num_searches = 32
+        self.critic = baselines.greedy_val_func
+        # Different positions for every environment
+        self.go_envs = []
+        for opening in range(4):
+            go_env = gym.make('gym_go:go-v0', size=self.size)
+            go_env.reset()
+            go_env.step(6 * opening)
+            self.go_envs.append(go_env)
+
+    def test_batch_of_one_is_sequential(self):
+        rootnodes = mct.batch_mct_search(self.go_envs, self.num_searches, critic=self.critic, batchsize=1)
+        for go_env, rootnode in zip(self.go_envs, rootnodes):
+            expected = sequential_search(go_env.canonical_state(), self.num_searches, self.critic)
+            self.assertTrue(np.array_equal(rootnode.get_visit_counts(), expected.get_visit_counts(0)))
+
+            single = mct.mct_search(go_env, self.num_searches, critic=self.critic, batchsize=1)
+            self.assertTrue(np.array_equal(rootnode.get_visit_counts(), single.get_visit_counts()))
+
+    def test_actor_critic_lockstep(self):
+        def actor_critic(states):
+            pi_logits = np.zeros((len(states), self.size ** 2 + 1))
+            pi_logits[:, 0] = 1
+            return pi_logits, self.critic(states)
+
+        rootnodes = mct.batch_mct_search(self.go_envs, self.num_searches, actor_critic=actor_critic, batchsize=1)
+        for go_env, rootnode in zip(self.go_envs, rootnodes):
+            single = mct.mct_search(go_env, self.num_searches, actor_critic=actor_critic, batchsize=1)
+            self.assertTrue(np.array_equal(rootnode.get_visit_counts(), single.get_visit_counts()))
+            self.assertEqual(rootnode.visits, self.num_searches + 1)
+
+
+class Reroot(unittest.TestCase):
+    def setUp(self) -> None:
+        go_env = gym.make('gym_go:go-v0', size=5)
+        go_env.reset()
+        self.rootstate = go_env.canonical_state()
+        self.searchtree = mct.mct_search(go_env, 64, critic=baselines.greedy_val_func).tree
+
+    def subtree(self, node):
+        """
+        :return: States and visits of the nodes under the node by the path of actions from it
+        """
+        nodes = {(): node}
+        frontier = [()]
+        while len(frontier) > 0:
+            path = frontier.pop()
+            row = self.searchtree.edge_rows[nodes[path]]
+            if row < 0:
+                continue
+            for action in np.flatnonzero(self.searchtree.children[row] >= 0):
+                nodes[path + (action,)] = self.searchtree.children[row, action]
+                frontier.append(path + (action,))
+        return {path: (self.searchtree.states[node].tobytes(), self.searchtree.visits[node])
+                for path, node in nodes.items()}
+
+    def test_reroot(self):
+        visits = self.searchtree.get_visit_counts(0)
+        action = np.argmax(visits)
+        child = self.searchtree.children[self.searchtree.edge_rows[0], action]
+        expected = self.subtree(child)
+
+        self.assertTrue(self.searchtree.reroot(action))
+        self.assertEqual(self.subtree(0), expected)
+        self.assertEqual(self.searchtree.num_nodes, len(expected))
+        self.assertEqual(self.searchtree.visits[0], visits[action])
+
+        # Parents and depths from the new root
+        n = self.searchtree.num_nodes
+        parents = self.searchtree.parents[:n]
+        self.assertEqual(parents[0], -1)
+        self.assertEqual(self.searchtree.levels[0], 0)
+        self.assertTrue(np.all((parents[1:] >= 0) & (parents[1:] < n)))
+        self.assertTrue(np.array_equal(self.searchtree.levels[1:n], self.searchtree.levels[parents[1:]] + 1))
+
+    def test_missing_child(self):
+        searchtree = tree.Tree(self.rootstate)
+        self.assertFalse(searchtree.reroot(0))
+        self.assertEqual(searchtree.num_nodes, 1)
+        self.assertTrue(np.array_equal(searchtree.state(0), self.rootstate))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,7 +6,7 @@ import gym
 import torch
 from mpi4py import MPI
 
-from go_ai import data, utils
+from go_ai import data, models, utils
 from go_ai.policies import baselines
 
 
@@ -16,7 +16,7 @@ def model_eval(comm, args, curr_pi, checkpoint_pi, winrates):
     for opponent in [checkpoint_pi, baselines.RAND_PI, baselines.GREEDY_PI]:
         # Play some games
         utils.mpi_log_debug(comm, f'Pitting {curr_pi} V {opponent}')
-        wr, _, _ = utils.mpi_play(comm, go_env, curr_pi, opponent, args.evaluations)
+        wr, _, _ = utils.mpi_play(comm, go_env, curr_pi, opponent, args.evaluations, args.lockstep)
         winrates[opponent] = wr
 
 
@@ -27,14 +27,15 @@ def train_step(comm, args, curr_pi, optim, checkpoint_pi):
 
     # Play episodes
     utils.mpi_log_debug(comm, f'Self-Playing {checkpoint_pi} V {checkpoint_pi}...')
-    _, _, replays = utils.mpi_play(comm, go_env, checkpoint_pi, checkpoint_pi, args.episodes)
+    _, _, replays = utils.mpi_play(comm, go_env, checkpoint_pi, checkpoint_pi, args.episodes, args.lockstep)
 
     # Write episodes
     data.mpi_disk_append_replay(comm, args, replays)
     utils.mpi_log_debug(comm, 'Added all replay data to disk')
 
-    # Sample data as batches
-    traindata, replay_len = data.mpi_sample_eventdata(comm, args.replay_path, args.batches, args.batchsize)
+    # Stream sampled data as batches
+    traindata, replay_len = data.mpi_stream_eventdata(comm, args.replay_dir, args.batches, args.batchsize,
+                                                      args.loaders, args.prioritized)
 
     # Optimize
     utils.mpi_log_debug(comm, f'Optimizing in {len(traindata)} training steps...')
@@ -82,6 +83,7 @@ if __name__ == '__main__':
 
     # Arguments
     args = utils.hyperparameters()
+    data.set_engine(args.engine)
 
     # Save directory
     if not os.path.exists(args.checkdir):
@@ -107,5 +109,19 @@ if __name__ == '__main__':
     curr_model.to(device)
     checkpoint_model.to(device)
 
+    # Data-parallel training
+    if args.data_parallel:
+        curr_model.grad_averager = models.GradientAverager(comm, curr_model)
+
+    # Self-play inference
+    server = None
+    if args.server:
+        server = utils.mpi_start_server(comm, args, checkpoint_model)
+
     # Train
-    train(comm, args, curr_pi, checkpoint_pi)
\ No newline at end of file
+    train(comm, args, curr_pi, checkpoint_pi)
+    utils.wait_checkpoint()
+
+    comm.Barrier()
+    if server is not None:
+        server.close()
\ No newline at end of file